@@ -0,0 +1,341 @@
+"""
+Indexed in-memory record tables for the journal backend.
+
+JournaledStore used to hold each database as the dicts json.load returned:
+a dict per account with a string key per field, and no way to find an
+account except by its primary key.  Given the dataset description shared
+with the SQLite backend (sqlite_store.DATASETS), it now keeps the records
+in a RecordTable:
+
+* every record is a __slots__ object with one slot per typed column
+  (balance, authorized meter, National ID, ...) plus the history; the
+  remaining fields, which the readers rarely touch, are kept as one
+  compact JSON string and decoded on access;
+* a history is a History: one packed 24-byte row per transaction in a
+  bytearray - epoch-microsecond timestamp, float amount, and interned
+  codes for the type, the counterparty or destination and the key order -
+  decoded back into a dict only when that entry is read, e.g. one page of
+  "View Transaction History" at a time;
+* each column in TableSpec.indexes has a value -> key index (electricity:
+  meter ID -> SIN, voting: National ID -> VoterID) that every write
+  through the table or a record keeps in step.
+
+Tables and records answer the same dict-style reads and writes as before
+(accounts[sin]['balance'], sin in accounts, record.get(...)), so journal
+operations, the readers and snapshot writes are unchanged, and
+table.find(field, value) answers like sqlite_store.RecordView.find.
+"""
+import json  # Untyped fields are kept as compact JSON text
+import struct  # Packed history rows
+import threading  # Guards the shared intern tables
+from datetime import datetime, timedelta  # Timestamp encoding
+from collections.abc import Mapping, Sequence  # Dict interface of the table, list interface of a history
+
+
+def _compact(fields):
+    return json.dumps(fields, separators=(',', ':')) if fields else None
+
+
+# --- History ---
+_ROW = struct.Struct('<qdHIH')  # timestamp (µs since epoch), amount, type code, reference code, shape code
+_MAX_SMALL_CODE = 0xFFFF  # Type and shape codes beyond this keep their entry as-is
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_CORE_FIELDS = ('type', 'amount', 'timestamp')
+
+
+class _Interner:
+    """Maps values to small integer codes shared by every history (types, stations, SINs or key orders)."""
+
+    def __init__(self, *initial):
+        self.values = []
+        self._codes = {}
+        self._lock = threading.Lock()
+        for value in initial:
+            self.code(value)
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = self._codes[value] = len(self.values)
+                    self.values.append(value)
+        return code
+
+
+_types = _Interner(None, 'deposit', 'withdrawal', 'transfer_in', 'transfer_out', 'purchase')
+_strings = _Interner(None)  # Counterparty SINs, destinations: grows with the customers, so apart from the types
+_shapes = _Interner()  # (field names in order, 'Z' suffix on the timestamp, reference field)
+
+
+def _encode_timestamp(text):
+    """Returns (microseconds since epoch, 'Z' suffix) if text decodes back to exactly the same string."""
+    try:
+        moment = datetime.fromisoformat(text)
+    except (TypeError, ValueError):
+        return None
+    zulu = moment.tzinfo is not None
+    if zulu and (moment.utcoffset() or not text.endswith('Z')):
+        return None
+    micros = (moment.replace(tzinfo=None) - _EPOCH) // _MICROSECOND
+    return (micros, zulu) if _decode_timestamp(micros, zulu) == text else None
+
+
+def _decode_timestamp(micros, zulu):
+    text = (_EPOCH + timedelta(microseconds=micros)).isoformat()
+    return text + 'Z' if zulu else text
+
+
+def _pack(entry):
+    """Packs one history entry, or returns None if it has a shape the row cannot hold exactly."""
+    if not isinstance(entry, dict):
+        return None
+    reference_field = None
+    for name, value in entry.items():
+        if name not in _CORE_FIELDS:
+            if reference_field is not None or not isinstance(value, str):
+                return None
+            reference_field = name
+    kind, amount = entry.get('type'), entry.get('amount', 0.0)
+    if (kind is not None and not isinstance(kind, str)) or type(amount) is not float:
+        return None
+    micros, zulu = 0, False
+    if 'timestamp' in entry:
+        encoded = _encode_timestamp(entry['timestamp'])
+        if encoded is None:
+            return None
+        micros, zulu = encoded
+    shape, kind_code = _shapes.code((tuple(entry), zulu, reference_field)), _types.code(kind)
+    if shape > _MAX_SMALL_CODE or kind_code > _MAX_SMALL_CODE:
+        return None
+    reference = _strings.code(entry[reference_field]) if reference_field else 0
+    if reference > 0xFFFFFFFF:
+        return None
+    return _ROW.pack(micros, amount, kind_code, reference, shape)
+
+
+def _unpack(row):
+    micros, amount, kind, reference, shape = _ROW.unpack(row)
+    names, zulu, reference_field = _shapes.values[shape]
+    values = {'type': _types.values[kind], 'amount': amount}
+    if 'timestamp' in names:
+        values['timestamp'] = _decode_timestamp(micros, zulu)
+    if reference_field:
+        values[reference_field] = _strings.values[reference]
+    return {name: values[name] for name in names}
+
+
+class History(Sequence):
+    """
+    A transaction history stored as packed rows; reads like the list of
+    dicts it replaces.  Entries that do not fit a row (unexpected fields or
+    value types) are kept as they are, so nothing is ever lost.
+    """
+
+    __slots__ = ('_rows', '_raw')
+
+    def __init__(self, entries=()):
+        self._rows = bytearray()
+        self._raw = None  # index -> entry kept as-is
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return len(self._rows) // _ROW.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('history index out of range')
+        if self._raw and index in self._raw:
+            return self._raw[index]
+        return _unpack(self._rows[index * _ROW.size:(index + 1) * _ROW.size])
+
+    def __setitem__(self, index, entry):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('history assignment index out of range')
+        self._store(index, entry)
+
+    def append(self, entry):
+        self._rows.extend(bytes(_ROW.size))
+        self._store(len(self) - 1, entry)
+
+    def _store(self, index, entry):
+        row = _pack(entry)
+        if self._raw and index in self._raw:
+            del self._raw[index]
+        if row is None:
+            if self._raw is None:
+                self._raw = {}
+            self._raw[index] = entry
+        else:
+            self._rows[index * _ROW.size:(index + 1) * _ROW.size] = row
+
+    def to_json(self):
+        return list(self)
+
+    def __eq__(self, other):
+        return list(self) == list(other) if isinstance(other, (list, History)) else NotImplemented
+
+    def __repr__(self):
+        return f"History({len(self)} entries)"
+
+
+def _as_history(value):
+    return value if isinstance(value, History) or not isinstance(value, list) else History(value)
+
+
+# --- Records ---
+class Record:
+    """Base of the per-table record classes made by RecordTable; reads and writes like the JSON dict."""
+
+    __slots__ = ('key', '_extra')
+    _table = None  # Owning RecordTable; a class attribute, so it costs nothing per record
+    _slots = {}  # JSON field -> slot for the typed columns and history
+
+    def __getitem__(self, name):
+        slot = self._slots.get(name)
+        if slot is not None:
+            try:
+                return getattr(self, slot)
+            except AttributeError:  # Field absent from this record
+                raise KeyError(name) from None
+        if self._extra is not None:
+            extra = json.loads(self._extra)
+            if name in extra:
+                return extra[name]
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name, self) is not self
+
+    def __setitem__(self, name, value):
+        slot = self._slots.get(name)
+        if slot is None:
+            extra = json.loads(self._extra) if self._extra else {}
+            extra[name] = value
+            self._extra = _compact(extra)
+            return
+        if slot in self._table.indexes:
+            self._table._reindex(self, slot, value)
+        setattr(self, slot, _as_history(value) if slot == 'history' else value)
+
+    def to_json(self):
+        """Returns the record as the dict it was loaded from, fields in file order."""
+        fields = {}
+        for name, slot in self._slots.items():
+            try:
+                fields[name] = getattr(self, slot)
+            except AttributeError:
+                pass
+        if self._extra is not None:
+            fields.update(json.loads(self._extra))
+        order = self._table.field_order
+        return dict(sorted(fields.items(), key=lambda item: order.get(item[0], len(order))))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.key!r}, {self.to_json()!r})"
+
+
+class RecordTable(Mapping):
+    """Dict-like table of slotted records with secondary indexes (see the module docstring)."""
+
+    def __init__(self, spec, records=()):
+        self.spec = spec
+        self._slots = {json_field: column for json_field, column, _ in spec.columns}
+        if spec.history_table:
+            self._slots['history'] = 'history'
+        self.record_class = type(spec.table, (Record,), {'__slots__': tuple(self._slots.values()),
+                                                        '_table': self, '_slots': self._slots})
+        self.indexes = {column: {} for column in spec.indexes}  # column -> {value: record key}
+        self.field_order = {}  # JSON field -> position, as in the loaded file
+        self._records = {}
+        for key, fields in dict(records).items():
+            self[key] = fields
+
+    def __getitem__(self, key):
+        return self._records[key]
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __setitem__(self, key, fields):
+        """Stores a whole record (a new account, or a journaled replacement) given as a dict."""
+        if isinstance(fields, Record):
+            fields = fields.to_json()
+        for name in fields:
+            self.field_order.setdefault(name, len(self.field_order))
+        record = self.record_class()
+        record.key = key
+        extra = {}
+        for name, value in fields.items():
+            slot = self._slots.get(name)
+            if slot is None:
+                extra[name] = value
+            else:
+                setattr(record, slot, _as_history(value) if slot == 'history' else value)
+        record._extra = _compact(extra)
+        previous = self._records.get(key)
+        for column, index in self.indexes.items():
+            old = getattr(previous, column, None)
+            if old is not None and index.get(old) == key:
+                del index[old]
+            value = getattr(record, column, None)
+            if value is not None:
+                index[value] = key
+        self._records[key] = record
+
+    def _reindex(self, record, column, value):
+        index = self.indexes[column]
+        old = getattr(record, column, None)
+        if old is not None and index.get(old) == record.key:
+            del index[old]
+        if value is not None:
+            index[value] = record.key
+
+    def find(self, json_field, value):
+        """Returns the key of a record whose field equals value; indexed fields are a dict lookup."""
+        slot = self._slots.get(json_field)
+        if slot in self.indexes:
+            return self.indexes[slot].get(value)
+        for key, record in self._records.items():
+            if record.get(json_field) == value:
+                return key
+        return None
+
+    def to_json(self):
+        return self._records  # The encoder converts each Record in turn
+
+
+def index_dataset(data, dataset):
+    """Replaces the record collection in freshly loaded JSON data with a RecordTable; returns the data."""
+    if dataset.root_key is None:
+        return RecordTable(dataset.records, data)
+    data[dataset.root_key] = RecordTable(dataset.records, data[dataset.root_key])
+    return data
+
+
+def to_json(obj):
+    """json.dump default= hook for tables, records and histories."""
+    if isinstance(obj, (Record, RecordTable, History)):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
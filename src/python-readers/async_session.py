@@ -0,0 +1,139 @@
+"""
+asyncio variant of the card session API.
+
+The functions mirror reader_core one for one (transmit_and_check,
+run_authentication, retrieve_verify_and_decrypt_data, run_card_session)
+but are coroutines.  Both run reader_core's step generators; only the
+driver differs: here every blocking call a step yields - conn.transmit,
+ECDSA verification - runs on an executor, and so do database updates, so
+a single event loop can drive many readers at once and overlap one
+card's I/O with another card's crypto and storage work.
+
+    card_details = await run_card_session(conn, PROFILE)
+    await commit(USER_DB_STORE, apply_charge, user_db, sin, 100.0)
+
+Every coroutine takes an optional `executor` (default: the loop's default
+thread pool).  The protocol steps - checks, read size fallbacks, logging,
+phase timing and capture_sessions - are reader_core's own, so the two
+APIs cannot drift apart.
+
+    python async_session.py electricity --cards 8 --latency 0.005
+"""
+import os  # /dev/null for the demo's session output
+import sys  # Exit status
+import time  # Session durations and throughput measurement
+import asyncio  # Event loop driving the sessions
+import argparse  # Command line options
+from functools import partial  # Binds arguments for executor calls
+from contextlib import redirect_stdout  # Silences per-APDU output in the demo
+from db_writer import run_update
+from reader_core import (timed_phase, verify_data_signature, transmit_steps, authentication_steps,
+                         public_key_steps, signature_steps, read_card_data_steps, read_chunk_steps, retrieve_steps,
+                         session_steps)
+
+
+async def _in_executor(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args))
+
+
+async def run_steps(steps, executor=None):
+    """reader_core.run_steps for coroutines: every blocking call the step yields runs on the executor."""
+    result, error = None, None
+    while True:
+        try:
+            call = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = await _in_executor(executor, *call), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def transmit_and_check(conn, apdu, description, executor=None):
+    """Transmits an APDU on the executor and checks for a success (90 00) status word."""
+    return await run_steps(transmit_steps(conn, apdu, description), executor)
+
+
+async def run_authentication(conn, profile, executor=None):
+    """Runs the mutual authentication sequence; returns the card ID or None."""
+    return await run_steps(authentication_steps(conn, profile), executor)
+
+
+async def get_public_key(conn, executor=None):
+    """Retrieves and parses the card's ECDSA public key."""
+    return await run_steps(public_key_steps(conn), executor)
+
+
+async def get_data_signature(conn, profile, executor=None):
+    """Retrieves the signature of the service data from the card."""
+    return await run_steps(signature_steps(conn, profile), executor)
+
+
+async def read_card_data(conn, profile, executor=None):
+    """Reads the encrypted service data, chunk by chunk if the applet supports offsets."""
+    return await run_steps(read_card_data_steps(conn, profile), executor)
+
+
+async def read_chunk(conn, profile, offset, size, executor=None):
+    """Reads the chunk at offset, falling back to smaller sizes on 6Cxx / 67 00 (see reader_core.read_chunk)."""
+    return await run_steps(read_chunk_steps(conn, profile, offset, size), executor)
+
+
+async def verify_signature(public_key, encrypted_data, signature, executor=None):
+    """Awaitable ECDSA verification; raises ValueError if the signature is invalid."""
+    await _in_executor(executor, verify_data_signature, public_key, bytes(encrypted_data), signature)
+
+
+async def retrieve_verify_and_decrypt_data(conn, profile, public_key, executor=None):
+    """Retrieves encrypted data, verifies its signature, and then decrypts it."""
+    return await run_steps(retrieve_steps(conn, profile, public_key), executor)
+
+
+async def run_card_session(conn, profile, key_cache=None, executor=None):
+    """Authenticates the card and returns its verified, decrypted details (or None)."""
+    return await run_steps(session_steps(conn, profile, key_cache), executor)
+
+
+async def commit(store, update, *args, executor=None):
+    """Awaitable db_writer.run_update: runs a read-check-write update off the event loop."""
+    with timed_phase('db_commit'):
+        return await _in_executor(executor, run_update, store, update, *args)
+
+
+async def _tap_repeatedly(conn, profile, taps):
+    succeeded = 0
+    for _ in range(taps):
+        if await run_card_session(conn, profile):
+            succeeded += 1
+    return succeeded
+
+
+async def _demo(service, cards, taps, latency):
+    # Imported here so the session API does not load every reader module
+    from reader_daemon import SERVICES
+    from card_emulator import EmulatedCard, CARD_ID
+    profile = SERVICES[service][0].PROFILE
+    conns = [EmulatedCard(services=[service], card_id=CARD_ID[:12] + i.to_bytes(4, 'big'), latency=latency)
+             for i in range(cards)]
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        results = await asyncio.gather(*(_tap_repeatedly(conn, profile, taps) for conn in conns))
+    elapsed = time.perf_counter() - started
+    print(f" {sum(results)}/{cards * taps} sessions on {cards} concurrent cards in {elapsed:.2f}s "
+          f"({sum(results) / elapsed:.1f} taps/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run concurrent async sessions against emulated cards.")
+    parser.add_argument('service', choices=['bank', 'electricity', 'transport', 'voting'])
+    parser.add_argument('--cards', type=int, default=8, help="cards served concurrently by one event loop")
+    parser.add_argument('--taps', type=int, default=20, help="sessions per card")
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds added to every emulated APDU")
+    args = parser.parse_args(argv)
+    asyncio.run(_demo(args.service, args.cards, args.taps, args.latency))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""
+End-to-end session benchmark against the emulated card.
+
+Drives repeated card sessions through each service reader and reports
+p50/p95/p99 latency for every phase of the session (select, nonce,
+mutual_auth, pubkey, data_read, signature, verify, decrypt, db_commit) plus
+the whole session.  Results can be written as JSON or CSV so runs can be
+compared over time.
+
+    python benchmark_sessions.py --sessions 2000 --latency 0.002 --json bench.json
+
+Set READER_DB_BACKEND=sqlite to benchmark the SQLite backend (the JSON files
+are imported into the scratch directory first).
+"""
+import os  # Working directory handling and /dev/null for reader output
+import sys  # Python version recorded with the results
+import csv  # CSV result export
+import json  # JSON result export
+import time  # Session wall-clock timing
+import shutil  # Copies the databases into a scratch directory
+import argparse  # Command line options
+import tempfile  # Scratch directory so benchmark commits never touch data/
+from datetime import datetime  # Timestamps on the synthetic transactions
+from contextlib import redirect_stdout  # Silences per-APDU reader output during the run
+import bank_reader
+import Electricity_reader
+import transport_reader
+import voting_reader
+from card_emulator import EmulatedCard, CARD_ID
+from reader_core import record_phases, timed_phase, run_card_session
+from session_log import configure_logging, MODES as LOG_MODES
+from sqlite_store import import_json_files
+from storage import DEFAULT_SQLITE_DB_FILE
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+PHASES = ['select', 'nonce', 'mutual_auth', 'pubkey', 'data_read', 'signature',
+          'verify', 'decrypt', 'db_commit', 'session']
+PERCENTILES = (50, 95, 99)
+
+
+# --- Per-service database commits (what a tap writes after a good session) ---
+def _commit_bank(accounts, card_details):
+    sin = card_details['SIN']
+    with bank_reader.ACCOUNTS_STORE.transaction() as tx:
+        tx.set([sin, 'balance'], accounts[sin]['balance'] - 1.0)
+        tx.append([sin, 'history'], {"type": "withdrawal", "amount": 1.0, "timestamp": datetime.now().isoformat()})
+
+
+def _commit_transport(db, card_details):
+    sin = card_details['SIN']
+    with transport_reader.USER_DB_STORE.transaction() as tx:
+        tx.set(['users', sin, 'balance'], db['users'][sin]['balance'] - 10.0)
+        tx.append(['users', sin, 'history'], {"type": "purchase", "destination": db['stations'][0],
+                                              "amount": 10.0, "timestamp": datetime.now().isoformat()})
+
+
+def _commit_electricity(user_db, card_details):
+    sin = card_details['SIN']
+    with Electricity_reader.USER_DB_STORE.transaction() as tx:
+        tx.set([sin, 'balance'], user_db[sin]['balance'] - 100.0)
+
+
+SERVICES = {
+    # service: (reader module, database loader, commit function or None for read-only services)
+    'bank': (bank_reader, bank_reader.load_accounts, _commit_bank),
+    'electricity': (Electricity_reader, Electricity_reader.load_user_database, _commit_electricity),
+    'transport': (transport_reader, transport_reader.USER_DB_STORE.load, _commit_transport),
+    'voting': (voting_reader, voting_reader.load_database, None),
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-pct * len(sorted_values) // 100))  # ceil(pct/100 * n)
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples):
+    """Reduces {phase: [seconds]} to per-phase statistics in milliseconds."""
+    summary = {}
+    for phase in PHASES:
+        values = sorted(samples.get(phase, []))
+        if not values:
+            continue
+        stats = {'count': len(values), 'mean_ms': sum(values) / len(values) * 1000}
+        for pct in PERCENTILES:
+            stats[f'p{pct}_ms'] = percentile(values, pct) * 1000
+        stats['max_ms'] = values[-1] * 1000
+        summary[phase] = stats
+    return summary
+
+
+def make_cards(service, count, latency):
+    """Builds `count` emulated cards with distinct card IDs and ECDSA keys."""
+    cards = []
+    for i in range(count):
+        card_id = CARD_ID[:12] + i.to_bytes(4, 'big')
+        cards.append(EmulatedCard(services=[service], card_id=card_id, latency=latency))
+    return cards
+
+
+def benchmark_service(service, sessions, card_count, latency, pipelined=False, log_mode='console'):
+    """Runs `sessions` taps for one service and returns its result record."""
+    reader, load_db, commit = SERVICES[service]
+    samples = {phase: [] for phase in PHASES}
+    recorder = lambda phase, seconds: samples[phase].append(seconds)
+    cards = make_cards(service, card_count, latency)
+    failures = 0
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), record_phases(recorder):
+        configure_logging(log_mode, stream=None if log_mode == 'console' else devnull)
+        database = load_db()
+        started = time.perf_counter()
+        for i in range(sessions):
+            session_start = time.perf_counter()
+            card_details = run_card_session(cards[i % card_count], reader.PROFILE, pipelined=pipelined)
+            if not card_details:
+                failures += 1
+                continue
+            if commit is not None:
+                with timed_phase('db_commit'):
+                    commit(database, card_details)
+            samples['session'].append(time.perf_counter() - session_start)
+        elapsed = time.perf_counter() - started
+        configure_logging('console')  # Flushes the queued records before devnull is closed
+
+    return {
+        'service': service,
+        'sessions': sessions,
+        'failures': failures,
+        'cards': card_count,
+        'apdu_latency_ms': latency * 1000,
+        'pipelined': pipelined,
+        'log_mode': log_mode,
+        'elapsed_s': elapsed,
+        'taps_per_s': (sessions - failures) / elapsed if elapsed else 0.0,
+        'phases': summarize(samples),
+    }
+
+
+def write_csv(results, path):
+    """Writes one row per (service, phase)."""
+    fields = ['service', 'phase', 'count', 'mean_ms'] + [f'p{p}_ms' for p in PERCENTILES] + ['max_ms']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for result in results:
+            for phase, stats in result['phases'].items():
+                writer.writerow({'service': result['service'], 'phase': phase, **stats})
+
+
+def print_summary(results):
+    for result in results:
+        print(f"\n=== {result['service']}: {result['sessions']} sessions, {result['failures']} failed, "
+              f"{result['taps_per_s']:.1f} taps/s ===")
+        print(f"   {'phase':<12} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}  (ms)")
+        for phase, stats in result['phases'].items():
+            print(f"   {phase:<12} {stats['mean_ms']:9.3f} {stats['p50_ms']:9.3f} "
+                  f"{stats['p95_ms']:9.3f} {stats['p99_ms']:9.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark reader sessions against the emulated card.")
+    parser.add_argument('--services', nargs='+', choices=sorted(SERVICES), default=sorted(SERVICES))
+    parser.add_argument('--sessions', type=int, default=1000, help="sessions per service")
+    parser.add_argument('--cards', type=int, default=1, help="distinct emulated cards tapping in rotation")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every APDU")
+    parser.add_argument('--pipelined', action='store_true', help="overlap chunk processing with card I/O")
+    parser.add_argument('--log', choices=LOG_MODES, default='console', help="session logging mode measured")
+    parser.add_argument('--json', dest='json_path', help="write results as JSON to this file")
+    parser.add_argument('--csv', dest='csv_path', help="write per-phase results as CSV to this file")
+    args = parser.parse_args(argv)
+
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    csv_path = os.path.abspath(args.csv_path) if args.csv_path else None
+    results = []
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='reader-bench-') as scratch:
+        for name in os.listdir(DATA_DIR):
+            shutil.copy(os.path.join(DATA_DIR, name), scratch)
+        os.chdir(scratch)  # The readers open their databases relative to the working directory
+        if os.environ.get('READER_DB_BACKEND') == 'sqlite':
+            import_json_files(scratch, os.environ.get('READER_SQLITE_DB', DEFAULT_SQLITE_DB_FILE))
+        try:
+            for service in args.services:
+                results.append(benchmark_service(service, args.sessions, args.cards, args.latency, args.pipelined,
+                                                  args.log))
+        finally:
+            os.chdir(original_cwd)
+
+    print_summary(results)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'generated': datetime.now().isoformat(), 'python': sys.version.split()[0],
+                       'results': results}, f, indent=2)
+    if csv_path:
+        write_csv(results, csv_path)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+In-process emulation of the JavaCard service applets.
+
+EmulatedCard answers the same APDUs as Banking.java, Electrcity.java,
+transport.java and Myvoting1.java (SELECT, GET NONCE 0xCA, MUTUAL AUTH 0x11,
+RESPOND AUTH 0x12, the data read, ECDSA signature 0x51 and public key 0x52)
+with the same status words, so reader throughput can be measured on hosts
+without a PC/SC reader.  An optional per-APDU latency models the card and
+reader link.
+
+Run directly to drive one reader session against the emulator:
+    python card_emulator.py bank
+"""
+import sys  # Command line arguments for the self-test entry point
+import json  # Encodes the emulated card payloads
+import time  # Per-APDU latency simulation
+from dataclasses import dataclass  # Container for the emulated applet images
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS
+from Crypto.Hash import SHA256
+from Crypto.Cipher import AES
+from card_transport import CardTransport, to_bytes
+
+# --- Card Configuration (mirrors the constants in the applets) ---
+CARD_AES_KEY = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0A\x0B\x0C\x0D\x0E\x0F'
+CARD_NONCE = bytes([0x01, 0x02, 0x03, 0x04, 0x05, 0x11, 0x12, 0x13, 0x14, 0x15, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26])
+CARD_ID = bytes([0x01, 0x04, 0x03, 0x02, 0x05, 0x11, 0x12, 0x13, 0x15, 0x14, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26])
+AES_BLOCK_SIZE = 16
+
+# --- ISO 7816 Status Words used by the applets ---
+SW_OK = 0x9000
+SW_WRONG_LENGTH = 0x6700
+SW_SECURITY_STATUS_NOT_SATISFIED = 0x6982
+SW_CONDITIONS_NOT_SATISFIED = 0x6985
+SW_FILE_NOT_FOUND = 0x6A82
+SW_WRONG_P1P2 = 0x6B00
+SW_INS_NOT_SUPPORTED = 0x6D00
+
+# --- Applet Instruction Codes ---
+INS_SELECT = 0xA4
+INS_GET_NONCE = 0xCA
+INS_ENCRYPT_AES_ECB = 0x10
+INS_MUTUAL_AUTH = 0x11
+INS_RESPOND_AUTH = 0x12
+INS_GET_SIGNATURE = 0x51
+INS_GET_PUBLIC_KEY = 0x52
+
+
+@dataclass(frozen=True)
+class AppletImage:
+    """Static description of one service applet installed on the card."""
+    aid: bytes  # Application Identifier the applet registers under
+    data_ins: int  # INS of the data read command
+    card_details: dict  # Plaintext the applet stores (encrypted) in its data array
+    offset_reads: bool = False  # True if the data read honours the P1|P2 offset and Le (sendBytes)
+
+
+# Plaintext payloads taken from the data arrays compiled into the applets
+APPLETS = {
+    "bank": AppletImage(
+        aid=bytes(to_bytes("A0 45 40 20 13 03")), data_ins=0x50, offset_reads=True,
+        card_details={"Card Type": "Credit", "Card Brand": "Visa", "SIN": "1416567895128452",
+                      "Expiry Date": "02/29", "Issuing Bank": "Bank Masr", "CVV": "547"}),
+    "electricity": AppletImage(
+        aid=bytes(to_bytes("A0 32 76 93 94 03")), data_ins=0x13,
+        card_details={"Issuing Authority": "Electricity company", "Meter Type": "Smart",
+                      "Meter ID": "109384756193847", "Location Apartment": "04102-305-12",
+                      "Amount": "100 EGP", "SIN": "54729103847291028"}),
+    "transport": AppletImage(
+        aid=bytes(to_bytes("AB 03 42 E2 20 02")), data_ins=0x13,
+        card_details={"SIN": "38475620394857102", "Subscription Type": "Monthly",
+                      "Last Station in": "Ramses Station", "Last Station out": "Marg Station",
+                      "Transport Mode": "Metro"}),
+    "voting": AppletImage(
+        aid=bytes(to_bytes("AE 33 93 EE 01 02")), data_ins=0x13,
+        card_details={"Name": "Mohamed Ashraf AbouShanab", "Gender": "Male", "VoterID": 789568,
+                      "Nationality": "Egyptian", "National ID": "30208017018016",
+                      "Phone number": "01006001111"}),
+}
+
+
+def encrypt_card_details(card_details, key=CARD_AES_KEY):
+    """Encrypts a payload the way it was provisioned: JSON, zero padded, AES-ECB."""
+    plaintext = json.dumps(card_details).encode('utf-8')
+    plaintext += b'\x00' * (-len(plaintext) % AES_BLOCK_SIZE)
+    return AES.new(key, AES.MODE_ECB).encrypt(plaintext)
+
+
+class _AppletState:
+    """Per-applet runtime state: data array, ECDSA key pair and auth flag."""
+
+    def __init__(self, image, card_details, key):
+        self.image = image
+        self.data = encrypt_card_details(card_details, key)
+        self.ecdsa_key = ECC.generate(curve='P-256')  # genKeyPair() in the applet constructor
+        self.public_point = self.ecdsa_key.public_key().export_key(format='raw')  # 0x04 || X || Y
+        self.authenticated = False
+        self.transient = bytearray(2 * AES_BLOCK_SIZE)  # Decrypted challenge from MUTUAL AUTH
+
+
+class EmulatedCard(CardTransport):
+    """A multi-service card answering APDUs in-process."""
+
+    def __init__(self, services=None, card_details=None, card_id=CARD_ID,
+                 key=CARD_AES_KEY, latency=0.0, extended_length=False):
+        """
+        services: applet names to install (default: all four).
+        card_details: optional {service: payload} overriding the stock payloads.
+        latency: seconds added to every APDU to model the card and reader link.
+        extended_length: accept extended-length APDUs (applets implementing
+        javacardx.apdu.ExtendedLength); otherwise they are rejected with 67 00.
+        """
+        self.name = "Emulated JavaCard"
+        self.card_id = bytes(card_id)
+        self.latency = latency
+        self.extended_length = extended_length
+        self.apdu_count = 0
+        self.cipher = AES.new(key, AES.MODE_ECB)
+        overrides = card_details or {}
+        self.applets = {}
+        for service in services or APPLETS:
+            image = APPLETS[service]
+            state = _AppletState(image, overrides.get(service, image.card_details), key)
+            self.applets[image.aid] = state
+        self.selected = None
+
+    def public_key(self, service):
+        """Returns the ECC key the named applet signs with."""
+        return self.applets[APPLETS[service].aid].ecdsa_key.public_key()
+
+    def transmit(self, apdu):
+        """Processes one command APDU and returns (data, sw1, sw2)."""
+        if self.latency:
+            time.sleep(self.latency)
+        self.apdu_count += 1
+        data, sw = self._process(bytes(apdu))
+        return list(data), sw >> 8, sw & 0xFF
+
+    # --- APDU dispatch (Applet.process) ---
+    def _process(self, apdu):
+        if len(apdu) < 4:
+            return b'', SW_WRONG_LENGTH
+        ins, p1, p2 = apdu[1], apdu[2], apdu[3]
+        lc_data, le, extended = self._split_body(apdu)
+        if extended and not self.extended_length:
+            return b'', SW_WRONG_LENGTH
+
+        if ins == INS_SELECT and p1 == 0x04:
+            self.selected = self.applets.get(lc_data)
+            if self.selected is None:
+                return b'', SW_FILE_NOT_FOUND
+            self.selected.authenticated = False  # Transient state is CLEAR_ON_DESELECT
+            return b'', SW_OK
+
+        applet = self.selected
+        if applet is None:
+            return b'', SW_CONDITIONS_NOT_SATISFIED
+        if ins == INS_GET_NONCE:
+            return CARD_NONCE, SW_OK
+        if ins == INS_ENCRYPT_AES_ECB:
+            if not lc_data or len(lc_data) % AES_BLOCK_SIZE:
+                return b'', SW_WRONG_LENGTH
+            return self.cipher.encrypt(lc_data), SW_OK
+        if ins == INS_MUTUAL_AUTH:
+            return self._mutual_auth(applet, lc_data)
+        if ins == INS_RESPOND_AUTH:
+            if not applet.authenticated:
+                return b'', SW_CONDITIONS_NOT_SATISFIED
+            reader_nonce = bytes(applet.transient[AES_BLOCK_SIZE:])
+            return self.cipher.encrypt(reader_nonce + self.card_id), SW_OK
+        if ins == INS_GET_PUBLIC_KEY:
+            return applet.public_point, SW_OK
+        if ins == INS_GET_SIGNATURE:
+            if not applet.authenticated:
+                return b'', SW_CONDITIONS_NOT_SATISFIED
+            signer = DSS.new(applet.ecdsa_key, 'fips-186-3', encoding='der')
+            return signer.sign(SHA256.new(applet.data)), SW_OK
+        if ins == applet.image.data_ins:
+            if not applet.authenticated:
+                return b'', SW_CONDITIONS_NOT_SATISFIED
+            if not applet.image.offset_reads:
+                return applet.data, SW_OK
+            offset = (p1 << 8) | p2
+            if offset >= len(applet.data):
+                return b'', SW_WRONG_P1P2
+            return applet.data[offset:offset + le], SW_OK
+        return b'', SW_INS_NOT_SUPPORTED
+
+    @staticmethod
+    def _split_body(apdu):
+        """
+        Returns (command data, Le, extended) for APDU cases 1-4.  Short Le=0
+        means 256; extended APDUs start the body with 00 and carry 2-byte
+        Lc/Le, where Le=0000 means 65536.
+        """
+        body = apdu[4:]
+        if not body:
+            return b'', 256, False
+        if len(body) == 1:
+            return b'', body[0] or 256, False
+        if body[0] == 0x00:  # Extended length (a short Lc is never 00)
+            if len(body) == 3:  # Case 2E: 00 Le1 Le2
+                return b'', ((body[1] << 8) | body[2]) or 65536, True
+            lc = (body[1] << 8) | body[2]
+            data = body[3:3 + lc]
+            tail = body[3 + lc:]
+            le = ((tail[0] << 8) | tail[1]) if len(tail) == 2 else 0
+            return data, le or 65536, True
+        lc = body[0]
+        data = body[1:1 + lc]
+        le = body[1 + lc] if len(body) > 1 + lc else 0
+        return data, le or 256, False
+
+    def _mutual_auth(self, applet, lc_data):
+        if not lc_data or len(lc_data) % AES_BLOCK_SIZE or len(lc_data) > 256:
+            return b'', SW_WRONG_LENGTH
+        decrypted = self.cipher.decrypt(lc_data)
+        applet.transient[:] = decrypted[:2 * AES_BLOCK_SIZE].ljust(2 * AES_BLOCK_SIZE, b'\x00')
+        if decrypted[:AES_BLOCK_SIZE] != CARD_NONCE:
+            return b'', SW_SECURITY_STATUS_NOT_SATISFIED  # Nonce mismatch: reader not authentic
+        applet.authenticated = True
+        return b'', SW_OK
+
+
+if __name__ == "__main__":
+    import bank_reader, Electricity_reader, transport_reader, voting_reader
+    from reader_core import run_card_session
+    readers_by_service = {"bank": bank_reader, "electricity": Electricity_reader,
+                          "transport": transport_reader, "voting": voting_reader}
+    service = sys.argv[1] if len(sys.argv) > 1 else "bank"
+    card = EmulatedCard()
+    details = run_card_session(card, readers_by_service[service].PROFILE)
+    print(f"Session {'succeeded' if details else 'failed'} after {card.apdu_count} APDUs.")
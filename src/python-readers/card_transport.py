@@ -0,0 +1,69 @@
+"""
+Card transport interface used by the reader session engine.
+
+The engine only needs two operations from a card link: transmit an APDU and
+disconnect.  PcscTransport wraps a pyscard connection to a physical (or
+jcsdk-simulated) reader; card_emulator.EmulatedCard implements the same
+interface in-process so the Python hot path can run without hardware.
+"""
+import sys  # System-specific parameters and functions for program termination
+
+
+def to_bytes(hex_string):
+    """Converts a spaced hex string ("00 A4 04 00") to a list of ints."""
+    return list(bytes.fromhex(hex_string))
+
+
+def to_hex(data):
+    """Formats a byte sequence as a spaced upper-case hex string."""
+    return bytes(data).hex(' ').upper()
+
+
+class CardTransport:
+    """Minimal APDU link: transmit() returns (data, sw1, sw2) like pyscard."""
+
+    name = "card"
+
+    def transmit(self, apdu):
+        raise NotImplementedError
+
+    def disconnect(self):
+        pass
+
+    def __str__(self):
+        return self.name
+
+
+class PcscTransport(CardTransport):
+    """Transport backed by a pyscard connection on a PC/SC reader."""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.name = str(reader)
+        self.connection = reader.createConnection()  # Create a connection object for the reader
+        self.connection.connect()  # Establish physical connection to the smart card
+
+    def transmit(self, apdu):
+        return self.connection.transmit(list(apdu))
+
+    def disconnect(self):
+        self.connection.disconnect()
+
+
+def list_pcsc_readers():
+    """Returns the PC/SC readers attached to this host."""
+    # Imported here so the emulator path works on hosts without pyscard/pcscd.
+    from smartcard.System import readers
+    return readers()
+
+
+def open_pcsc_transport(index=0):
+    """Connects to the card in the index-th PC/SC reader."""
+    from smartcard.Exceptions import NoCardException
+    try:
+        transport = PcscTransport(list_pcsc_readers()[index])
+        print(f" Connected to: {transport}\n")
+        return transport
+    except (IndexError, NoCardException):  # Handle cases where no reader/card is found
+        print(" Error: No card or reader found.")
+        sys.exit(1)
@@ -0,0 +1,317 @@
+"""
+Caches for the reader's per-card cryptographic state.
+
+A reader process in service mode sees the same cards many times a day.
+PublicKeyCache keeps the parsed ECDSA public key of recently seen cards so
+a returning card skips the GET PUBLIC KEY round trip and ECC.import_key.
+VerificationCache remembers which signed payloads already passed ECDSA
+verification so a returning card skips the P-256 arithmetic, and
+VerificationTableCache keeps precomputed comb tables for keys that verify
+new payloads often (see ecc_tables.py).  CipherCache keeps the AES key
+schedule of each service key instead of rebuilding it with AES.new on
+every session.
+"""
+import time  # Monotonic clock for entry expiry
+import hashlib  # Public key fingerprints
+import threading  # Caches are shared by all sessions of a reader process
+from collections import OrderedDict  # LRU ordering
+from Crypto.Cipher import AES  # Cipher objects held by CipherCache
+from ecc_tables import CombTable, table_bytes  # Per-key tables held by VerificationTableCache
+
+
+class PublicKeyCache:
+    """Thread-safe LRU cache of parsed card public keys with a time-to-live."""
+
+    def __init__(self, max_entries=10000, ttl=12 * 3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl  # Seconds an entry stays valid after it was fetched from the card
+        self.clock = clock
+        self._entries = OrderedDict()  # (card_id, aid) -> (expires_at, public_key)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, card_id, aid):
+        """Returns the cached key for this card and applet, or None."""
+        cache_key = (bytes(card_id), bytes(aid))
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self.clock():
+                del self._entries[cache_key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, card_id, aid, public_key):
+        """Stores a key freshly read from the card."""
+        cache_key = (bytes(card_id), bytes(aid))
+        with self._lock:
+            self._entries[cache_key] = (self.clock() + self.ttl, public_key)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, card_id, aid=None):
+        """
+        Drops the keys of a card, e.g. after it was reissued with a new key pair.
+        Without an aid every applet key of that card is removed.  Returns the count.
+        """
+        card_id = bytes(card_id)
+        with self._lock:
+            stale = [k for k in self._entries if k[0] == card_id and (aid is None or k[1] == bytes(aid))]
+            for cache_key in stale:
+                del self._entries[cache_key]
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class VerificationCache:
+    """
+    Thread-safe LRU set of successful ECDSA verifications.
+
+    An entry is (fingerprint of the public key, SHA-256 of the signed
+    ciphertext), plus the signature bytes when bind_signature is set.  Any
+    changed ciphertext byte or a different key misses and is verified in
+    full.  The applets sign with randomised ECDSA, so the signature bytes
+    differ on every tap while the signed data does not; binding the
+    signature would make every lookup miss.  Leaving it out does not
+    weaken the check: the signature covers static data only and is not
+    tied to the session, so a replayed (ciphertext, signature) pair passes
+    a full verification just the same.  Failed verifications are never
+    cached.
+    """
+
+    def __init__(self, max_entries=50000, bind_signature=False):
+        self.max_entries = max_entries
+        self.bind_signature = bind_signature
+        self._entries = OrderedDict()  # cache key -> None
+        self._fingerprints = {}  # id(public key) -> (public key, fingerprint)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def fingerprint(self, public_key):
+        """SHA-256 of the uncompressed public point, memoised per key object."""
+        entry = self._fingerprints.get(id(public_key))
+        if entry is not None and entry[0] is public_key:
+            return entry[1]
+        fingerprint = hashlib.sha256(public_key.export_key(format='raw')).digest()
+        with self._lock:
+            if len(self._fingerprints) >= self.max_entries:
+                self._fingerprints.clear()
+            self._fingerprints[id(public_key)] = (public_key, fingerprint)
+        return fingerprint
+
+    def key_for(self, public_key, digest, signature):
+        """Builds the cache key for a verification of digest under public_key."""
+        if self.bind_signature:
+            return (self.fingerprint(public_key), bytes(digest), bytes(signature))
+        return (self.fingerprint(public_key), bytes(digest))
+
+    def check(self, cache_key):
+        """True if this verification already succeeded."""
+        with self._lock:
+            if cache_key in self._entries:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, cache_key):
+        """Records a verification that succeeded."""
+        with self._lock:
+            self._entries[cache_key] = None
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._fingerprints.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class VerificationTableCache:
+    """
+    Thread-safe LRU of per-key ECDSA comb tables with a memory cap.
+
+    A table costs about as much to build as 15 DSS verifications, so a key
+    gets one only after build_after full verifications.  Until then, and
+    while another thread is building its table, get returns None and the
+    caller verifies with DSS.  Once the tables fill max_bytes a new key is
+    only admitted if it has been used more often than every table it would
+    evict, so more hot keys than fit do not keep rebuilding each other's
+    tables.  Use counts are halved every `aging` lookups so keys that went
+    quiet make room again.  max_bytes=0 disables the tables.
+    """
+
+    def __init__(self, max_bytes=32 * 2**20, build_after=16, window=6, aging=100000):
+        self.max_bytes = max_bytes
+        self.build_after = build_after
+        self.window = window  # Bits per window; 6 gives ~450 KB tables built in ~50 ms
+        self.aging = aging
+        self._tables = OrderedDict()  # key fingerprint -> CombTable
+        self._uses = OrderedDict()  # key fingerprint -> recent verifications, with or without a table
+        self._building = set()
+        self._lookups = 0
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = self.misses = self.builds = self.evictions = self.rejections = 0
+
+    def get(self, fingerprint, public_key):
+        """Returns the comb table for this key, building it if the key has become hot, or None."""
+        with self._lock:
+            self._lookups += 1
+            if self._lookups >= self.aging:
+                self._age()
+            uses = self._uses.pop(fingerprint, 0) + 1
+            self._uses[fingerprint] = uses
+            table = self._tables.get(fingerprint)
+            if table is not None:
+                self._tables.move_to_end(fingerprint)
+                self.hits += 1
+                return table
+            self.misses += 1
+            while len(self._uses) > len(self._tables) + 10000:  # Only recently seen keys are worth counting
+                stale = next(fp for fp in self._uses if fp not in self._tables)
+                del self._uses[stale]
+            if self.max_bytes <= 0 or uses < self.build_after or fingerprint in self._building:
+                return None
+            if not self._admit(uses):
+                self.rejections += 1
+                return None
+            self._building.add(fingerprint)
+        try:
+            point = public_key.pointQ
+            table = CombTable(int(point.x), int(point.y), self.window)
+        finally:
+            with self._lock:
+                self._building.discard(fingerprint)
+        with self._lock:
+            self._tables[fingerprint] = table
+            self.bytes += table.size_bytes
+            self.builds += 1
+            while self.bytes > self.max_bytes:
+                _, evicted = self._tables.popitem(last=False)
+                self.bytes -= evicted.size_bytes
+                self.evictions += 1
+        return table
+
+    def _admit(self, uses):
+        """True if a new table fits, or every table it would evict has been used less than `uses` times."""
+        size = table_bytes(self.window)
+        if size > self.max_bytes:
+            return False
+        needed = self.bytes + size - self.max_bytes
+        for fingerprint, table in self._tables.items():  # Least recently used first
+            if needed <= 0:
+                return True
+            if self._uses.get(fingerprint, 0) >= uses:
+                return False
+            needed -= table.size_bytes
+        return True
+
+    def _age(self):
+        self._lookups = 0
+        for fingerprint in list(self._uses):
+            self._uses[fingerprint] //= 2
+            if not self._uses[fingerprint] and fingerprint not in self._tables:
+                del self._uses[fingerprint]
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._uses.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'tables': len(self._tables), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                    'builds': self.builds, 'evictions': self.evictions, 'rejections': self.rejections}
+
+    def __len__(self):
+        return len(self._tables)
+
+
+class CipherCache:
+    """
+    Reusable AES-ECB cipher objects, one per key and per thread.
+
+    ECB carries no chaining state, so a cipher object can serve any number
+    of sessions; keeping one per thread means concurrent readers never share
+    an object.  decrypt_batch decrypts many block-aligned payloads with one
+    cipher call.
+    """
+
+    def __init__(self, max_keys=64):
+        self.max_keys = max_keys  # Per thread; one key per service profile in practice
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """Returns this thread's AES-ECB cipher for key."""
+        ciphers = getattr(self._local, 'ciphers', None)
+        if ciphers is None:
+            ciphers = self._local.ciphers = {}
+        key = bytes(key)
+        cipher = ciphers.get(key)
+        if cipher is None:
+            if len(ciphers) >= self.max_keys:
+                ciphers.clear()
+            cipher = ciphers[key] = AES.new(key, AES.MODE_ECB)
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.hits += 1
+        return cipher
+
+    def encrypt(self, key, data):
+        return self.get(key).encrypt(bytes(data))
+
+    def decrypt(self, key, data):
+        return self.get(key).decrypt(bytes(data))
+
+    def decrypt_batch(self, key, payloads):
+        """Decrypts a list of block-aligned payloads in one call; returns the plaintexts in order."""
+        payloads = [bytes(p) for p in payloads]
+        for payload in payloads:
+            if len(payload) % AES.block_size:
+                raise ValueError(f"payload length {len(payload)} is not a multiple of the AES block size")
+        plaintext = self.get(key).decrypt(b''.join(payloads))
+        results, offset = [], 0
+        for payload in payloads:
+            results.append(plaintext[offset:offset + len(payload)])
+            offset += len(payload)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
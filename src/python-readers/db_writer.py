@@ -0,0 +1,108 @@
+"""
+Single writer thread for a database shared by several card readers.
+
+A balance update is a read-check-write: read the balance, make sure it
+covers the charge, commit the new value.  When several readers share one
+store (multi_reader.py) two taps could read the same balance and both
+commit.  DatabaseWriter runs every such update on one thread, in arrival
+order, so the check and the commit of one update never interleave with
+another's.  Readers submit the update and wait for its result.
+
+    store.writer = DatabaseWriter()
+    new_balance = run_update(store, apply_charge, user_db, sin, 100.0)
+
+Without a writer attached, run_update calls the update inline.
+
+Either way the update runs inside store.optimistic(): it first sees the
+transactions other reader processes committed to the same store, and its
+commit raises journal.ConflictError if one of them changed the same row
+in the meantime.  run_update then runs the update again on the fresh
+data, so terminals in separate processes never lose each other's
+updates.  An update must therefore do nothing but read and commit.
+Processes hammering one account can keep beating each other to the
+commit, so after OPTIMISTIC_ATTEMPTS conflicts the update runs once more
+holding the store's write lock (store.exclusive()) from its first read
+to its commit, where nobody else can commit in between.
+
+The update's commit only appends (deferred_sync); the reader then waits
+for the fsync in store.sync() on its own thread, after every lock is
+released.  The writer moves on to the next update meanwhile, and the
+updates appended while one fsync runs are made durable together by the
+next (group commit, see journal.JournaledStore.sync).
+"""
+import queue  # Pending updates in arrival order
+import threading  # The writer thread itself
+from concurrent.futures import Future  # Result handed back to the submitting reader
+from journal import ConflictError  # Raised when another process changed a row first
+
+OPTIMISTIC_ATTEMPTS = 3  # Conflicting attempts before the update runs under the store's write lock
+
+
+class DatabaseWriter:
+    """Applies submitted updates one at a time on a dedicated thread."""
+
+    def __init__(self, name='db-writer'):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self.applied = 0  # Updates run so far
+
+    def submit(self, update, *args, **kwargs):
+        """Queues update(*args, **kwargs); returns a Future with its result."""
+        future = Future()
+        self._queue.put((future, update, args, kwargs))
+        return future
+
+    def call(self, update, *args, **kwargs):
+        """Runs update on the writer thread and waits for it; exceptions are re-raised here."""
+        if threading.current_thread() is self._thread:
+            return update(*args, **kwargs)  # Already on the writer (an update calling another)
+        return self.submit(update, *args, **kwargs).result()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, update, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(update(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            self.applied += 1
+
+    def close(self):
+        """Finishes the queued updates and stops the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def run_update(store, update, *args, **kwargs):
+    """
+    Runs a read-check-write update on the store's writer if one is attached,
+    else inline.  Either way it returns once the update's changes are durable.
+    """
+    if store.writer is None:
+        result, seq = _apply_deferred(store, update, args, kwargs)
+    else:
+        result, seq = store.writer.call(_apply_deferred, store, update, args, kwargs)
+    store.sync(seq)
+    return result
+
+
+def _apply_deferred(store, update, args, kwargs):
+    with store.deferred_sync():
+        return _apply_optimistic(store, update, args, kwargs), store.seq
+
+
+def _apply_optimistic(store, update, args, kwargs):
+    for _ in range(OPTIMISTIC_ATTEMPTS):
+        try:
+            with store.optimistic():
+                return update(*args, **kwargs)
+        except ConflictError:
+            pass
+    with store.exclusive(), store.optimistic():  # Nothing can change between the reads and the commit
+        return update(*args, **kwargs)
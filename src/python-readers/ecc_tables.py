@@ -0,0 +1,152 @@
+"""
+P-256 ECDSA verification with precomputed comb tables.
+
+Verifying a card signature computes u1*G + u2*Q.  pycryptodome multiplies
+the generator G with a built-in table, but the card's public key Q goes
+through the generic scalar multiplication, which is about half of the
+~3 ms DSS.verify.  For a key that keeps coming back, CombTable stores
+d * 2^(w*i) * Q for every w-bit window i and digit d, so u2*Q becomes one
+table lookup and one mixed point addition per window.  The generator gets
+the same kind of table once per process.
+
+Everything here is plain integer arithmetic in Jacobian coordinates; the
+tables themselves are kept in affine form (x, y) so every step is a mixed
+addition.
+"""
+import threading  # The generator table is built once, on first use
+
+# --- NIST P-256 domain parameters (FIPS 186-4, D.1.2.3) ---
+P = 0xFFFFFFFF00000001000000000000000000000000FFFFFFFFFFFFFFFFFFFFFFFF
+N = 0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551
+GX = 0x6B17D1F2E12C4247F8BCE6E563A440F277037D812DEB33A0F4A13945D898C296
+GY = 0x4FE342E2FE1A7F9B8EE7EB4A7C0F9E162BCE33576B315ECECBB6406837BF51F5
+
+INFINITY = (1, 1, 0)  # Jacobian point at infinity (Z = 0)
+G_WINDOW = 8  # Bits per window of the shared generator table
+POINT_BYTES = 170  # Approximate memory of one stored affine point (tuple + two 256-bit ints)
+
+
+def _double(point):
+    """Jacobian doubling for a = -3."""
+    X1, Y1, Z1 = point
+    if Z1 == 0 or Y1 == 0:
+        return INFINITY
+    delta = Z1 * Z1 % P
+    gamma = Y1 * Y1 % P
+    beta = X1 * gamma % P
+    alpha = 3 * (X1 - delta) * (X1 + delta) % P
+    X3 = (alpha * alpha - 8 * beta) % P
+    Z3 = ((Y1 + Z1) ** 2 - gamma - delta) % P
+    Y3 = (alpha * (4 * beta - X3) - 8 * gamma * gamma) % P
+    return X3, Y3, Z3
+
+
+def _add_affine(point, affine):
+    """Jacobian point + affine point (mixed addition), handling the special cases."""
+    X1, Y1, Z1 = point
+    x2, y2 = affine
+    if Z1 == 0:
+        return x2, y2, 1
+    Z1Z1 = Z1 * Z1 % P
+    U2 = x2 * Z1Z1 % P
+    S2 = y2 * Z1 * Z1Z1 % P
+    H = (U2 - X1) % P
+    R = (S2 - Y1) % P
+    if H == 0:
+        return _double(point) if R == 0 else INFINITY
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = Z1 * H % P
+    return X3, Y3, Z3
+
+
+def _to_affine_batch(points):
+    """Converts Jacobian points (none at infinity) to affine with a single inversion."""
+    prefix = []
+    running = 1
+    for _, _, Z in points:
+        running = running * Z % P
+        prefix.append(running)
+    inverse = pow(running, -1, P)
+    affine = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        z_inv = inverse * prefix[i - 1] % P if i else inverse
+        inverse = inverse * Z % P
+        z_inv2 = z_inv * z_inv % P
+        affine[i] = (X * z_inv2 % P, Y * z_inv2 * z_inv % P)
+    return affine
+
+
+def table_bytes(window):
+    """Approximate memory of one CombTable with this window size."""
+    return -(-256 // window) * ((1 << window) - 1) * POINT_BYTES
+
+
+class CombTable:
+    """Precomputed multiples d * 2^(window*i) * Q of one curve point."""
+
+    def __init__(self, x, y, window=6):
+        self.window = window
+        self.windows = -(-256 // window)
+        digits = (1 << window) - 1
+        jacobian = []
+        base = (x, y, 1)
+        for i in range(self.windows):
+            base_affine = _to_affine_batch([base])[0]
+            multiple = base
+            jacobian.append(multiple)
+            for _ in range(digits - 1):
+                multiple = _add_affine(multiple, base_affine)
+                jacobian.append(multiple)
+            for _ in range(window):
+                base = _double(base)
+        affine = _to_affine_batch(jacobian)
+        self.rows = [affine[i * digits:(i + 1) * digits] for i in range(self.windows)]
+        self.size_bytes = table_bytes(window)
+
+    def accumulate(self, point, scalar):
+        """Returns point + scalar * Q."""
+        mask = (1 << self.window) - 1
+        for row in self.rows:
+            digit = scalar & mask
+            if digit:
+                point = _add_affine(point, row[digit - 1])
+            scalar >>= self.window
+        return point
+
+
+_generator_table = None
+_generator_lock = threading.Lock()
+
+
+def generator_table():
+    """The shared table for G, built on first use (about 8000 points)."""
+    global _generator_table
+    if _generator_table is None:
+        with _generator_lock:
+            if _generator_table is None:
+                _generator_table = CombTable(GX, GY, G_WINDOW)
+    return _generator_table
+
+
+def verify(key_table, digest, signature_rs):
+    """
+    Verifies an ECDSA P-256 signature given as raw r||s (64 bytes) over a
+    SHA-256 digest, using the key's CombTable.  Returns True if it is valid.
+    """
+    r = int.from_bytes(signature_rs[:32], 'big')
+    s = int.from_bytes(signature_rs[32:], 'big')
+    if not (0 < r < N and 0 < s < N):
+        return False
+    e = int.from_bytes(digest, 'big')  # SHA-256 matches the 256-bit order, no truncation
+    w = pow(s, -1, N)
+    point = generator_table().accumulate(INFINITY, e * w % N)
+    X, _, Z = key_table.accumulate(point, r * w % N)
+    if Z == 0:
+        return False
+    z_inv = pow(Z, -1, P)
+    return X * z_inv * z_inv % P % N == r
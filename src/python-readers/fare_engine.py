@@ -0,0 +1,88 @@
+"""
+Fare lookup for the transport readers.
+
+purchase_ticket used to print db["stations"] and price a ticket from the
+destination's position in the list, counted from the head of the line,
+with an if/elif chain over db["fares"] on every tap.  FareEngine is built
+once from those two values:
+
+* the fare bands are read from the fare names - "9_stations_or_less",
+  "16_stations_or_less", "more_than_16_stations" - so new bands need no
+  code change;
+* every station gets a code, its 1-based position on the line (the
+  number the station menu shows), and is indexed by code and by name
+  (case-insensitive);
+* the fare of every origin x destination pair is precomputed: a trip
+  counts the stations from entry to exit, both included, and costs the
+  band that count falls in.
+
+A tap is then two dict lookups and one matrix read.  Priced from the head
+of the line (origin code 1) the fares are the ones charged before.
+
+    engine = fare_engine_for(db)
+    fare = engine.fare(engine.station("Sadat"), engine.station("15"))  # Sadat to Mar Girgis
+"""
+import re  # Fare band names
+
+_BAND = re.compile(r'^(?:(\d+)_stations_or_less|more_than_(\d+)_stations)$')
+
+
+class FareEngine:
+    """Station indexes and the precomputed fare matrix of one line (see the module docstring)."""
+
+    def __init__(self, stations, fares):
+        self.stations = list(stations)
+        self.bands = self._parse_bands(fares)  # (most stations, fare), ascending; the last may be unbounded
+        self.by_name = {name.casefold(): index for index, name in enumerate(self.stations)}
+        self.by_code = {str(index + 1): index for index in range(len(self.stations))}
+        fare_by_count = [None] + [self._band_fare(count) for count in range(1, len(self.stations) + 1)]
+        self.matrix = [[fare_by_count[abs(destination - origin) + 1] for destination in range(len(self.stations))]
+                       for origin in range(len(self.stations))]
+
+    @staticmethod
+    def _parse_bands(fares):
+        bands = []
+        for name, fare in fares.items():
+            match = _BAND.match(name)
+            if match is None:
+                raise ValueError(f"unknown fare band '{name}'")
+            at_most, more_than = match.groups()
+            bands.append((int(at_most), fare) if at_most else (float('inf'), fare))
+        return sorted(bands, key=lambda band: band[0])
+
+    def _band_fare(self, count):
+        for at_most, fare in self.bands:
+            if count <= at_most:
+                return fare
+        raise ValueError(f"no fare band covers a {count}-station trip")
+
+    def station(self, text):
+        """Index of the station named or coded by text, or None if there is none."""
+        text = str(text).strip()
+        index = self.by_code.get(text)
+        return index if index is not None else self.by_name.get(text.casefold())
+
+    def fare(self, origin, destination):
+        """Fare from the station at index origin to the one at index destination."""
+        return self.matrix[origin][destination]
+
+
+MAX_ENGINES = 8  # Transport databases whose engines are kept at once
+_engines = {}  # (id(stations), id(fares)) -> (stations, fares, engine); holding the objects keeps the ids unique
+
+
+def fare_engine_for(db):
+    """
+    The FareEngine of a transport database, cached per stations list and
+    fares table object.  The stores apply writes to either on a new object
+    (journal.apply_static_op) and a reload reads new ones, so a change
+    builds a new engine and a tap costs one dict lookup.
+    """
+    stations, fares = db.get("stations", []), db.get("fares", {})
+    key = (id(stations), id(fares))
+    entry = _engines.get(key)
+    if entry is None:
+        if len(_engines) >= MAX_ENGINES:
+            _engines.pop(next(iter(_engines)))  # Oldest first: databases that were reloaded or closed
+        entry = _engines[key] = (stations, fares, FareEngine(stations, fares))
+    return entry[2]
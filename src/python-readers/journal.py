@@ -0,0 +1,572 @@
+"""
+Append-only transaction journal for the reader databases.
+
+The service databases used to be rewritten in full (json.dump with
+indentation) after every transfer, ticket or charge.  JournaledStore keeps
+the JSON file as a snapshot and appends each transaction as one JSON line
+to <snapshot>.journal; commit() returns once the line is fsynced.  Every
+`compact_every` commits the in-memory state is written back as a new
+snapshot and the journal is truncated, so per-tap commit cost no longer
+grows with the size of the database.
+
+Journal operations are idempotent ("set" stores an absolute value, "insert"
+writes a list element at a fixed index), so replaying a journal over a
+snapshot that already contains it - e.g. after a crash between snapshot
+rename and journal truncation - is harmless.
+
+Commits are group committed: commit() appends and applies under a lock,
+then waits in sync() for an fsync that covers it.  The first waiting
+thread issues one fsync for every record appended up to that point and
+the others wait for it, so taps committing while a sync is in flight share
+the next one.  Under a db_writer.DatabaseWriter the writer thread only
+appends (deferred_sync) and each reader waits for durability itself, so
+the writer never idles on the disk.  A change is thus visible in memory
+before it is durable.  If an fsync fails, the store keeps the error in
+sync_failure: its waiters and every later commit raise JournalError until
+load() reads the store back from disk, so no decision is made on changes
+the disk may have lost.
+
+Several reader processes can share one store.  Every commit takes an
+exclusive lock on <journal>.lock, first applies the records other
+processes appended since it last looked (_catch_up), and only then
+appends its own, so all processes agree on one sequence of records.
+Updates are optimistic: each record touching a row bumps that row's
+version, and a transaction whose rows changed after its update began
+(store.optimistic(), used by db_writer.run_update) raises ConflictError
+instead of overwriting them; run_update re-runs the update on the fresh
+data.  Compaction swaps in a new, empty journal rather than truncating
+the old one, so a process still reading the old file finishes it first.
+A seal record (seal()) retires files whose data has moved, e.g. to
+shards: the store still loads, but commits raise JournalError.
+The lock needs fcntl (POSIX); elsewhere only one process may use a store.
+
+Given its dataset description, the store keeps the records in an indexed
+account_store.RecordTable rather than as the parsed JSON dicts.  With
+mapped=True it maps a record_snapshot.SnapshotTable instead and decodes
+only the records that are used.
+"""
+import os  # fsync, atomic rename and file size checks
+import json  # Snapshot and journal record encoding
+import copy  # Static values are replaced, not changed in place
+import time  # Commit latency
+import threading  # Append lock and the group commit hand-off
+from contextlib import contextmanager  # deferred_sync, optimistic
+from datetime import datetime  # Timestamp on every journal record
+import metrics  # reader_db_commit_seconds
+from account_store import index_dataset, to_json  # Slotted, indexed records in place of the JSON dicts
+from record_snapshot import open_snapshot, build_snapshot, fsync_directory  # Memory-mapped tables, durable renames
+
+try:
+    import fcntl  # Cross-process journal lock
+except ImportError:  # Windows: no lock, one process per store
+    fcntl = None
+
+
+class JournalError(Exception):
+    """Raised when a journal record cannot be applied to the snapshot."""
+
+
+class ConflictError(JournalError):
+    """Raised by commit() when another reader changed a row of the transaction after it was read."""
+
+
+def _walk(data, path):
+    """Returns the container addressed by path inside the nested data."""
+    node = data
+    for key in path:
+        node = node[key]
+    return node
+
+
+def apply_static_op(data, op):
+    """
+    Applies an op to a small top-level value (transport's stations, fares)
+    on a copy, so a cache keyed on the old object, like
+    fare_engine.fare_engine_for, sees that it changed.
+    """
+    name = op[1][0]
+    if len(op[1]) > 1:
+        data[name] = copy.deepcopy(data[name])
+    apply_op(data, op)
+
+
+def apply_op(data, op):
+    """Applies one journal operation to the in-memory data."""
+    kind, path = op[0], op[1]
+    if kind == "set":
+        _walk(data, path[:-1])[path[-1]] = op[2]
+    elif kind == "insert":
+        target = _walk(data, path)
+        index, value = op[2], op[3]
+        if index < len(target):
+            target[index] = value  # Already present in the snapshot (replay after compaction)
+        elif index == len(target):
+            target.append(value)
+        else:
+            raise JournalError(f"insert at {index} leaves a gap in {path} (length {len(target)})")
+    else:
+        raise JournalError(f"unknown journal operation '{kind}'")
+
+
+def write_snapshot(path, data, indent=None):
+    """Writes the JSON snapshot atomically: temp file, fsync, rename, fsync of the directory."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent, default=to_json)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path)
+
+
+def _complete_records(reader):
+    """Yields the complete records from reader's position on; leaves it just after the last one."""
+    while True:
+        position = reader.tell()
+        line = reader.readline()
+        try:
+            record = json.loads(line) if line.endswith(b"\n") else None
+        except ValueError:
+            record = None
+        if record is None:  # End, a line still being appended, or a torn tail from a crash
+            reader.seek(position)
+            return
+        yield record
+
+
+def same_file(f, path):
+    """True if the open file f is still the file at path (not replaced by a compaction)."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    own = os.fstat(f.fileno())
+    return (own.st_dev, own.st_ino) == (stat.st_dev, stat.st_ino)
+
+
+class Transaction:
+    """Collects the changes of one business transaction (see JournaledStore.transaction)."""
+
+    def __init__(self, data):
+        self.data = data
+        self.ops = []
+        self._pending_lengths = {}  # list path -> length including inserts queued in this transaction
+
+    def set(self, path, value):
+        """Stores value at path, e.g. tx.set([sin, "balance"], 120.0)."""
+        self.ops.append(["set", list(path), value])
+
+    def append(self, path, value):
+        """Appends value to the list at path, e.g. tx.append([sin, "history"], record)."""
+        key = tuple(path)
+        index = self._pending_lengths.get(key)
+        if index is None:
+            index = len(_walk(self.data, path))
+        self._pending_lengths[key] = index + 1
+        self.ops.append(["insert", list(path), index, value])
+
+
+class JournaledStore:
+    """A JSON snapshot plus an fsynced append-only journal of deltas."""
+
+    def __init__(self, snapshot_path, indent=None, compact_every=1000, fsync=True, dataset=None, mapped=False,
+                 group_commit_delay=0.0):
+        self.snapshot_path = snapshot_path
+        self.journal_path = f"{snapshot_path}.journal"
+        self.lock_path = f"{self.journal_path}.lock"
+        self.indent = indent  # Indentation used when the snapshot is rewritten
+        self.compact_every = compact_every  # Commits between snapshot compactions (0 disables)
+        self.fsync = fsync
+        self.group_commit_delay = group_commit_delay  # Seconds a sync leader waits for more commits to join
+        self.dataset = dataset  # sqlite_store.Dataset: records are loaded into a RecordTable (None keeps plain dicts)
+        self.mapped = mapped  # Map <snapshot>.snap instead of parsing the JSON (flat, read-mostly datasets)
+        self.name = os.path.basename(snapshot_path)  # Store label in the metrics
+        self.data = None
+        self.seq = 0  # Sequence number of the last journaled transaction
+        self.writer = None  # db_writer.DatabaseWriter when several readers share this store
+        self.commits = 0  # Transactions journaled
+        self.syncs = 0  # fsyncs that made them durable; commits / syncs is the mean group size
+        self.conflicts = 0  # Transactions rejected because a row changed under them
+        self.sealed = None  # Reason read from a seal record: the data has moved, commits raise JournalError
+        self.sync_failure = None  # Error of a failed fsync: memory may hold lost changes, commits raise until load()
+        self.row_versions = {}  # Row key -> seq of the last record that changed it (since load)
+        self._journal = None
+        self._reader = None  # Read position in the journal, for records appended by other processes
+        self._lock_file = None
+        self._lock_depth = 0
+        self._since_compaction = 0
+        self._lock = threading.RLock()  # Orders appends, compaction and the seq counter
+        self._sync_state = threading.Condition()
+        self._synced_seq = 0  # Highest seq known to be on disk
+        self._syncing = False  # A thread is fsyncing on behalf of the group
+        self._deferred = threading.local()
+        self._optimistic = threading.local()
+
+    def load(self):
+        """Reads the snapshot and replays the journal; returns the live data."""
+        with self._lock, self._file_lock():  # No other process compacts or appends half-way through
+            if self.mapped:
+                self.data = open_snapshot(self.snapshot_path, self.dataset)
+            else:
+                with open(self.snapshot_path, 'r') as f:
+                    self.data = json.load(f)
+                if self.dataset is not None:
+                    self.data = index_dataset(self.data, self.dataset)
+            self.seq = 0
+            self.row_versions = {}
+            self.sealed = None
+            self.sync_failure = None
+            self._reader = None
+            self._since_compaction = self._catch_up(track=False)
+            self._discard_torn_tail()
+        self._synced_seq = self.seq
+        return self.data
+
+    def refresh(self):
+        """Applies the transactions other processes have committed since the last refresh or commit."""
+        with self._lock:
+            self._catch_up()
+
+    @contextmanager
+    def optimistic(self):
+        """
+        Refreshes, then runs the block as one optimistic update: a transaction
+        committed inside it raises ConflictError if a row it writes was changed
+        by anyone after the block started.
+        """
+        with self._lock:
+            self._catch_up()
+            self._optimistic.base = self.seq
+        try:
+            yield
+        finally:
+            self._optimistic.base = None
+
+    def read_version(self):
+        """Version a transaction starting now has read: the optimistic block's start, else the current seq."""
+        base = getattr(self._optimistic, 'base', None)
+        return self.seq if base is None else base
+
+    def _check_conflicts(self, ops, read_version):
+        if read_version is not None and any(
+                self.row_versions.get(self._row_key(op[1]), 0) > read_version for op in ops):
+            self.conflicts += 1
+            metrics.db_conflicts.inc(self.name)
+            raise ConflictError("a row of this transaction was changed by another reader")
+
+    def _check_writable(self):
+        if self.sealed is not None:
+            raise JournalError(self.sealed)
+        if self.sync_failure is not None:
+            raise JournalError(f"an fsync of {self.name} failed ({self.sync_failure}): load() it before committing")
+
+    def _row_key(self, path):
+        if self.dataset is not None and self.dataset.root_key is not None and path[0] == self.dataset.root_key:
+            return tuple(path[:2])  # ("users", sin); other top-level keys (stations, fares) are one row each
+        return path[0]
+
+    def _apply_record(self, record, track=True):
+        root_key = self.dataset.root_key if self.dataset is not None and not self.mapped else None
+        for op in record["ops"]:
+            if root_key is not None and op[1][0] != root_key:
+                apply_static_op(self.data, op)
+            else:
+                apply_op(self.data, op)
+            if track:
+                self.row_versions[self._row_key(op[1])] = record["seq"]
+        self.seq = record["seq"]
+
+    def _catch_up(self, track=True):
+        """Applies complete journal records not seen yet, following compactions; returns how many."""
+        applied = 0
+        while True:
+            if self._reader is None:
+                if not os.path.exists(self.journal_path):
+                    return applied
+                self._reader = open(self.journal_path, 'rb')
+            for record in _complete_records(self._reader):
+                if "sealed" in record:
+                    self.sealed = record["sealed"]
+                    continue
+                if record["seq"] <= self.seq:
+                    continue  # This process's own commits, or a compaction it had caught up with
+                if track and (not record["ops"] or record["seq"] > self.seq + 1):
+                    return applied + self._resync()  # A compaction marker or gap: a whole journal went by unread
+                self._apply_record(record, track)
+                applied += 1
+            if same_file(self._reader, self.journal_path):
+                return applied
+            self._reader = None  # Another process compacted: its snapshot has been read up to here
+
+    def _resync(self):
+        """
+        After other processes compacted twice since this one last read the
+        journal: reads the current snapshot and journal, and replaces every
+        record that differs as a journaled "set" would.  Returns how many.
+        """
+        with self._file_lock():  # Snapshot and journal from the same compaction
+            with open(self.snapshot_path, 'r') as f:
+                fresh = json.load(f)
+            reader = open(self.journal_path, 'rb')
+            seq = self.seq
+            for record in _complete_records(reader):
+                if "sealed" in record:
+                    self.sealed = record["sealed"]
+                for op in record["ops"]:
+                    apply_op(fresh, op)
+                seq = max(seq, record["seq"])
+        root_key = self.dataset.root_key if self.dataset is not None else None
+        prefix, records = ([], self.data) if root_key is None else ([root_key], self.data[root_key])
+        changes = []
+        for key, record in (fresh if root_key is None else fresh[root_key]).items():
+            current = records.get(key)
+            if (current.to_json() if hasattr(current, 'to_json') else current) != record:
+                changes.append(prefix + [key])
+        if root_key is not None:
+            changes.extend([name] for name in fresh if name != root_key and self.data.get(name) != fresh[name])
+        for path in changes:
+            apply_op(self.data, ["set", path, _walk(fresh, path)])
+            self.row_versions[self._row_key(path)] = seq
+        self.seq = seq
+        self._reader = reader
+        return len(changes)
+
+    def _discard_torn_tail(self):
+        """Truncates whatever follows the last complete record (held lock only: no one is appending)."""
+        position = self._reader.tell() if self._reader is not None else 0
+        try:
+            size = os.stat(self.journal_path).st_size
+        except FileNotFoundError:
+            return
+        if size > position:
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(position)
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive cross-process lock; reentrant within the thread holding self._lock."""
+        if fcntl is None:
+            yield
+            return
+        if self._lock_depth == 0:
+            if self._lock_file is None:
+                self._lock_file = open(self.lock_path, 'ab')
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def transaction(self):
+        """
+        Context manager for one atomic change set:
+
+            with store.transaction() as tx:
+                tx.set([sin, "balance"], new_balance)
+                tx.append([sin, "history"], record)
+
+        On exit the record is appended to the journal, the operations are
+        applied to the in-memory data, and the block returns once the record
+        has been fsynced.  If the block raises, nothing is written or applied.
+        """
+        return TransactionContext(self)
+
+    def commit(self, ops, read_version=None):
+        """
+        Journals ops and applies them to the in-memory data; returns when they
+        are durable.  With read_version (see read_version()), raises
+        ConflictError if a row in ops has changed since then.
+        """
+        if not ops:
+            return
+        if self.data is None:
+            raise JournalError("load() must be called before committing")
+        with self._lock, self._file_lock():
+            start = time.perf_counter()
+            self._catch_up()
+            self._check_writable()
+            self._discard_torn_tail()
+            self._check_conflicts(ops, read_version)
+            record = {"seq": self.seq + 1, "ts": datetime.now().isoformat(), "ops": ops}
+            line = (json.dumps(record, separators=(',', ':'), default=to_json) + "\n").encode('utf-8')
+            journal = self._open_journal()
+            journal.write(line)
+            journal.flush()  # In the OS cache; sync() makes it durable
+            if self._reader is None:
+                self._reader = open(self.journal_path, 'rb')
+            self._reader.seek(0, os.SEEK_END)  # Past this record: nothing else was appended under the lock
+            self.commits += 1
+            self._apply_record(record)
+            seq = self.seq
+            metrics.db_commit_seconds.observe(time.perf_counter() - start, self.name, 'commit')
+            self._since_compaction += 1
+            if self.compact_every and self._since_compaction >= self.compact_every:
+                self.compact()
+        if not getattr(self._deferred, 'active', False):
+            self.sync(seq)
+
+    @contextmanager
+    def deferred_sync(self):
+        """Commits made by this thread inside the block return before their fsync; call sync() afterwards."""
+        previous = getattr(self._deferred, 'active', False)
+        self._deferred.active = True
+        try:
+            yield
+        finally:
+            self._deferred.active = previous
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Holds this store's thread and cross-process locks, e.g. to commit to
+        several stores as one, or to read and commit with nobody in between.
+        """
+        with self._lock, self._file_lock():
+            yield
+
+    def prepare(self, ops, read_version=None):
+        """
+        Inside exclusive(): catches up, raises ConflictError as commit() would,
+        and fsyncs what is journaled so far; returns the seq the next commit
+        will get.
+        """
+        self._catch_up()
+        self._check_writable()
+        self._discard_torn_tail()
+        self._check_conflicts(ops, read_version)
+        if self._synced_seq < self.seq:
+            if self.fsync:
+                os.fsync(self._open_journal().fileno())
+            with self._sync_state:
+                self._synced_seq = max(self._synced_seq, self.seq)
+                self._sync_state.notify_all()
+        return self.seq + 1
+
+    def sync(self, seq=None):
+        """
+        Blocks until the journal is on disk up to seq (default: everything
+        appended so far).  One waiting thread fsyncs for the whole group;
+        commits appended while it does are covered by the next fsync.
+        """
+        seq = self.seq if seq is None else seq
+        with self._sync_state:
+            while self._synced_seq < seq:
+                if self.sync_failure is not None:
+                    raise JournalError(f"an fsync of {self.name} failed ({self.sync_failure})")
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._sync_state.wait()
+            else:
+                return
+        synced = None
+        try:
+            if self.group_commit_delay:
+                time.sleep(self.group_commit_delay)  # Lets commits arriving within the window join this fsync
+            with self._lock:
+                target = self.seq
+                journal = self._open_journal()
+            start = time.perf_counter()
+            if self.fsync:
+                os.fsync(journal.fileno())
+            metrics.db_commit_seconds.observe(time.perf_counter() - start, self.name, 'sync')
+            metrics.db_syncs.inc(self.name)
+            synced = target
+        except OSError as e:
+            self.sync_failure = e  # The kernel may have dropped the dirty pages: retrying could report success
+            raise
+        finally:
+            with self._sync_state:
+                self._syncing = False
+                if synced is not None:
+                    self.syncs += 1
+                    self._synced_seq = max(self._synced_seq, synced)
+                self._sync_state.notify_all()  # Waiters see sync_failure and raise
+
+    def compact(self, data=None):
+        """Writes the current data as the new snapshot and starts an empty journal."""
+        with self._lock, self._file_lock():
+            self._catch_up()
+            self._check_writable()  # A new journal would drop the seal
+            if data is not None and data is not self.data:
+                self.data = data if self.dataset is None or self.mapped else index_dataset(data, self.dataset)
+            start = time.perf_counter()
+            records = self.data.to_json() if self.mapped else self.data
+            write_snapshot(self.snapshot_path, records, self.indent)
+            if self.mapped:
+                build_snapshot(self.snapshot_path, self.dataset, records)  # Matches the JSON just written
+            # A new file rather than truncate(0): other processes may not have read the old one to the end
+            tmp_path = f"{self.journal_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                # Carries the sequence on, so a process loading the new snapshot numbers after it
+                marker = {"seq": self.seq, "ts": datetime.now().isoformat(), "ops": []}
+                f.write((json.dumps(marker, separators=(',', ':')) + "\n").encode('utf-8'))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.journal_path)
+            fsync_directory(self.journal_path)
+            self._journal = None  # Not closed: a sync in progress may still hold it; dropped with its last reference
+            self._reader = open(self.journal_path, 'rb')
+            self._since_compaction = 0
+            metrics.db_commit_seconds.observe(time.perf_counter() - start, self.name, 'compact')
+            synced = self.seq
+        with self._sync_state:
+            self._synced_seq = max(self._synced_seq, synced)  # Everything so far is in the snapshot
+            self._sync_state.notify_all()
+
+    def seal(self, reason):
+        """
+        Inside exclusive(): journals a seal record, after which every process
+        can still load this store but gets JournalError(reason) when it
+        commits; for files whose data has moved elsewhere.
+        """
+        self._catch_up()
+        if self.sealed is not None:
+            return
+        self._discard_torn_tail()
+        record = {"seq": self.seq, "ts": datetime.now().isoformat(), "ops": [], "sealed": reason}
+        journal = self._open_journal()
+        journal.write((json.dumps(record, separators=(',', ':')) + "\n").encode('utf-8'))
+        journal.flush()
+        if self.fsync:
+            os.fsync(journal.fileno())
+        if self._reader is None:
+            self._reader = open(self.journal_path, 'rb')
+        self._reader.seek(0, os.SEEK_END)
+        self.sealed = reason
+
+    def close(self):
+        for name in ('_journal', '_reader', '_lock_file'):
+            f = getattr(self, name)
+            if f is not None:
+                f.close()
+                setattr(self, name, None)
+
+    def _open_journal(self):
+        if self._journal is None or (fcntl is not None and not same_file(self._journal, self.journal_path)):
+            self._journal = open(self.journal_path, 'ab')  # First append, or the journal was compacted
+        return self._journal
+
+
+class TransactionContext:
+    """Runs a Transaction against any store exposing `data` and `commit(ops)`."""
+
+    def __init__(self, store):
+        self.store = store
+        self.tx = None
+
+    def __enter__(self):
+        if self.store.data is None:
+            raise JournalError("load() must be called before starting a transaction")
+        self.tx = Transaction(self.store.data)
+        self.read_version = self.store.read_version()
+        return self.tx
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.store.commit(self.tx.ops, self.read_version)
+        return False
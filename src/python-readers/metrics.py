@@ -0,0 +1,268 @@
+"""
+Counters and latency histograms for the session engine, exported in the
+Prometheus text exposition format.
+
+reader_core records, for every session it runs:
+
+    reader_apdu_seconds{reader,ins}                 APDU round trip per INS code
+    reader_apdu_failures_total{reader,ins,sw}       non-9000 status words; sw="error" when transmit raised
+    reader_phase_seconds{phase}                     select ... decrypt, db_commit (card vs host time)
+    reader_sessions_total{reader,service,result}    ok, auth_failed, no_public_key, data_failed
+    reader_session_seconds{reader,service}          whole session, tap to verified payload
+    reader_auth_failures_total{reader,service}
+    reader_signature_failures_total{reader,service}
+
+and the stores add:
+
+    reader_db_commit_seconds{store,op}              op is 'commit' (one transaction appended),
+                                                    'sync' (one group commit fsync) or
+                                                    'compact' (snapshot rewrite every compact_every commits)
+    reader_db_syncs_total{store}                    journal fsyncs; with the commit count this
+                                                    gives the group commit batch size
+    reader_db_conflicts_total{store}                optimistic updates re-run because another
+                                                    reader changed the same account first
+
+`reader` is the terminal the card was tapped on, so a slow reader stands out
+from the others; comparing the APDU and card phases with verify/decrypt
+shows whether the card or the host is the bottleneck.
+
+render() returns the exposition text.  The reader daemon serves it over
+HTTP (GET /metrics) or rewrites a textfile for node_exporter's textfile
+collector, see reader_daemon.start_metrics_exporter.
+"""
+import os  # Atomic textfile replacement
+import time  # Round-trip timing
+import bisect  # Histogram bucket lookup
+import threading  # Per-metric locks and the exporter threads
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler  # GET /metrics
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds; covers a fast APDU (sub-millisecond) up to a slow journal fsync or snapshot rewrite
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count per label set."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}'
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """Observations bucketed by upper bound, per label set (cumulative on export, as Prometheus expects)."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.bounds = tuple(sorted(buckets))
+        self._series = {}  # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.bounds) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def count(self, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            return series[2] if series else 0
+
+    def samples(self):
+        with self._lock:
+            series = sorted((labels, (list(buckets), total, count))
+                            for labels, (buckets, total, count) in self._series.items())
+        for label_values, (buckets, total, count) in series:
+            cumulative = 0
+            for bound, bucket in zip(self.bounds + (float('inf'),), buckets):
+                cumulative += bucket
+                labels = _format_labels(self.labels, label_values, [('le', _format_value(float(bound)))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {count}'
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Registry:
+    """The metrics exported together by render()."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+apdu_seconds = REGISTRY.register(Histogram(
+    'reader_apdu_seconds', "APDU round-trip time by terminal and INS code.", ('reader', 'ins')))
+apdu_failures = REGISTRY.register(Counter(
+    'reader_apdu_failures_total', "APDUs answered with a status word other than 90 00.", ('reader', 'ins', 'sw')))
+phase_seconds = REGISTRY.register(Histogram(
+    'reader_phase_seconds', "Time spent in each session phase.", ('phase',)))
+sessions = REGISTRY.register(Counter(
+    'reader_sessions_total', "Card sessions by result.", ('reader', 'service', 'result')))
+session_seconds = REGISTRY.register(Histogram(
+    'reader_session_seconds', "Card session duration, authentication to decoded payload.", ('reader', 'service')))
+auth_failures = REGISTRY.register(Counter(
+    'reader_auth_failures_total', "Sessions whose mutual authentication failed.", ('reader', 'service')))
+signature_failures = REGISTRY.register(Counter(
+    'reader_signature_failures_total', "Card data whose ECDSA signature did not verify.", ('reader', 'service')))
+db_commit_seconds = REGISTRY.register(Histogram(
+    'reader_db_commit_seconds', "Database writes: transaction appends, group commit fsyncs and compactions.",
+    ('store', 'op')))
+db_syncs = REGISTRY.register(Counter(
+    'reader_db_syncs_total', "Journal fsyncs, each covering every transaction appended before it.", ('store',)))
+db_conflicts = REGISTRY.register(Counter(
+    'reader_db_conflicts_total', "Updates rejected because another reader changed the same row first.", ('store',)))
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    return REGISTRY.render()
+
+
+def transmit(conn, apdu):
+    """conn.transmit(apdu), recording its round trip and any failure status word."""
+    reader, ins = str(conn), f'{apdu[1]:02X}'
+    start = time.perf_counter()
+    try:
+        resp, sw1, sw2 = conn.transmit(apdu)
+    except Exception:
+        apdu_failures.inc(reader, ins, 'error')
+        raise
+    apdu_seconds.observe(time.perf_counter() - start, reader, ins)
+    if (sw1, sw2) != (0x90, 0x00):
+        apdu_failures.inc(reader, ins, f'{sw1:02X}{sw2:02X}')
+    return resp, sw1, sw2
+
+
+def session_finished(conn, service, result, seconds):
+    """Counts one session; result is 'ok' or the step that failed, as in session_log.log_session."""
+    reader = str(conn)
+    sessions.inc(reader, service, result)
+    session_seconds.observe(seconds, reader, service)
+    if result == 'auth_failed':
+        auth_failures.inc(reader, service)
+
+
+# --- Exporters ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the session log
+
+
+class HttpExporter:
+    """Serves GET /metrics on (host, port) from a background thread."""
+
+    def __init__(self, bind_address):
+        self.server = ThreadingHTTPServer(bind_address, _MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='reader-metrics', daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TextfileExporter:
+    """Rewrites path with the current metrics every `interval` seconds (temp file + rename)."""
+
+    def __init__(self, path, interval=15.0):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='reader-metrics', daemon=True)
+        self._thread.start()
+
+    def write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(render())
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()  # Final values, so the file matches what the process did
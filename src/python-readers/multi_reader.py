@@ -0,0 +1,202 @@
+"""
+Runs one service on every PC/SC reader attached to the host.
+
+Station controllers have 8-16 readers.  MultiReaderEngine starts one
+ReaderDaemon worker thread per reader, all sharing a single loaded
+database, the public key cache and one DatabaseWriter.  Card I/O and
+crypto run concurrently on the workers; balance updates (charge_meter,
+purchase_ticket) are handed to the writer thread, which applies them one at
+a time so two taps of the same account can never both spend its balance.
+
+The readers run unattended, so only non-interactive handlers are allowed:
+electricity charges the meter, transport sells a ticket to the gate's
+fixed --destination, priced from the --origin station.  Bank and voting need a person at the terminal and
+can only be run with --session-only.
+
+    python multi_reader.py electricity
+    python multi_reader.py transport --destination "Helwan"
+    python multi_reader.py transport --origin "Sadat" --destination "Helwan"
+    python multi_reader.py electricity --emulate 500 --readers 8 --latency 0.005
+    python multi_reader.py electricity --metrics 127.0.0.1:9464
+
+With --emulate the engine stops by itself once every emulated reader has
+made its taps; otherwise it runs until SIGTERM, Ctrl+C or the control
+socket's stop command.
+"""
+import sys  # Exit status
+import time  # Throughput measurement
+import signal  # SIGTERM shuts the engine down cleanly
+import argparse  # Command line options
+import threading  # One worker thread per reader
+from functools import partial  # Binds the gate origin and destination to purchase_ticket
+import Electricity_reader
+import transport_reader
+from card_transport import list_pcsc_readers
+from db_writer import DatabaseWriter
+from reader_core import public_key_cache, verification_cache, verification_tables, cipher_cache
+from session_audit import CaptureLog
+from session_log import configure_logging, MODES as LOG_MODES
+from reader_daemon import (SERVICES, ReaderDaemon, PcscCardEvents, EmulatedCardEvents,
+                           default_control_address, start_control_server, stop_control_server,
+                           start_metrics_exporter)
+
+
+def _charge_meter(card_details, user_db):
+    Electricity_reader.charge_meter(user_db, card_details)
+
+
+def unattended_handler(service, destination=None, origin=None):
+    """Returns the handler(card_details, database) a reader without an operator runs after a good session."""
+    if service == 'electricity':
+        return _charge_meter
+    if service == 'transport' and destination is not None:
+        return partial(transport_reader.purchase_ticket, destination=destination, origin=origin)
+    return None
+
+
+class MultiReaderEngine:
+    """A worker thread per reader, one shared database and one database writer."""
+
+    def __init__(self, service, event_sources, handler=None, session_only=False, pipelined=False, capture=None):
+        self.service = service
+        _, self.load_db, self.store = SERVICES[service]
+        self.writer = DatabaseWriter()
+        self.workers = [ReaderDaemon(service, events, session_only=session_only, handler=handler,
+                                     pipelined=pipelined, capture=capture) for events in event_sources]
+        self.started_at = time.time()
+        self._threads = []
+
+    def start(self):
+        """Loads the database once and starts every reader worker."""
+        database = self.load_db()
+        if database is None:
+            raise RuntimeError(f"could not load the {self.service} database")
+        self.store.writer = self.writer  # Balance updates from every worker now go through one thread
+        for index, worker in enumerate(self.workers):
+            worker.database = database
+            thread = threading.Thread(target=worker.serve_forever, name=f'reader-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wait(self):
+        """Blocks until every worker has stopped (Ctrl+C still reaches the main thread)."""
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(0.5)
+
+    def wait_for_taps(self, poll_interval=0.1):
+        """Stops the engine once every worker's (emulated) event source has run out of taps."""
+        while not all(worker.events.finished for worker in self.workers):
+            if not any(thread.is_alive() for thread in self._threads):
+                return  # Stopped some other way
+            time.sleep(poll_interval)
+        self.stop()  # Each worker handled its last tap before taking the card away
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def shutdown(self):
+        """Stops the workers, drains the writer and releases readers and database."""
+        self.stop()
+        self.wait()
+        for worker in self.workers:
+            worker.events.close()
+        self.writer.close()
+        self.store.writer = None
+        self.store.close()
+
+    def health(self):
+        states = [worker.state for worker in self.workers]
+        return {'service': self.service, 'readers': len(self.workers),
+                'state': 'running' if any(s in ('idle', 'processing') for s in states) else states[0],
+                'uptime_s': round(time.time() - self.started_at, 3),
+                'workers': [worker.health() for worker in self.workers]}
+
+    def stats(self):
+        per_reader = [worker.stats() for worker in self.workers]
+        totals = {}
+        for stats in per_reader:
+            for counter in ('taps', 'sessions_ok', 'sessions_failed', 'errors', 'removals'):
+                totals[counter] = totals.get(counter, 0) + stats[counter]
+        for stats, worker in zip(per_reader, self.workers):
+            stats['reader'] = worker.events.name
+            for shared in ('public_key_cache', 'verification_cache', 'verification_tables', 'cipher_cache', 'db_backend',
+                           'service'):
+                del stats[shared]
+        return {'service': self.service, **totals, 'db_updates': self.writer.applied,
+                'db_backend': type(self.store).__name__, 'public_key_cache': public_key_cache.stats(),
+                'verification_cache': verification_cache.stats(), 'verification_tables': verification_tables.stats(),
+                'cipher_cache': cipher_cache.stats(), 'readers': per_reader}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve one service on all attached card readers.")
+    parser.add_argument('service', choices=sorted(SERVICES))
+    parser.add_argument('--destination', help="transport: station sold by every gate")
+    parser.add_argument('--origin', help="transport: station the gates stand at (default: TRANSPORT_STATION, "
+                                         "else the head of the line)")
+    parser.add_argument('--session-only', action='store_true', help="authenticate and verify taps only")
+    parser.add_argument('--pipelined', action='store_true', help="overlap chunk processing with card I/O")
+    parser.add_argument('--control', help="control socket path or host:port")
+    parser.add_argument('--capture', metavar='FILE', help="append every session to FILE for session_audit.py")
+    parser.add_argument('--log', choices=LOG_MODES, default='console',
+                        help="console: every step; quiet: problems only; production: one JSON record per session")
+    parser.add_argument('--metrics', metavar='ADDRESS',
+                        help="export Prometheus metrics: host:port serves /metrics, a path is rewritten as a textfile")
+    parser.add_argument('--emulate', type=int, metavar='TAPS', help="emulated taps per reader instead of PC/SC")
+    parser.add_argument('--readers', type=int, default=4, help="emulated readers (with --emulate)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every emulated APDU")
+    args = parser.parse_args(argv)
+    configure_logging(args.log)
+
+    handler = unattended_handler(args.service, args.destination, args.origin)
+    if handler is None and not args.session_only:
+        print(f" Error: the {args.service} reader needs an operator; use --session-only"
+              + (" or --destination" if args.service == 'transport' else "") + ".")
+        return 1
+
+    if args.emulate is not None:
+        # Distinct card IDs per reader; every card carries the same holder, so all readers update one account
+        sources = [EmulatedCardEvents(args.service, args.emulate, latency=args.latency, name=f"emulated reader {i}",
+                                      first_card=i) for i in range(args.readers)]
+    else:
+        sources = [PcscCardEvents(index) for index in range(len(list_pcsc_readers()))]
+        if not sources:
+            print(" Error: No card reader found.")
+            return 1
+
+    capture = CaptureLog(args.capture, args.service) if args.capture else None
+    engine = MultiReaderEngine(args.service, sources, handler=handler, session_only=args.session_only,
+                               pipelined=args.pipelined, capture=capture)
+    control = args.control or default_control_address(f'{args.service}-multi')
+    server = start_control_server(engine, control)
+    exporter = start_metrics_exporter(args.metrics) if args.metrics else None
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop())
+    print(f" Serving {args.service} on {len(sources)} readers. Control socket: {control}")
+    try:
+        engine.start()
+        if args.emulate is not None:
+            engine.wait_for_taps()
+            elapsed = time.time() - engine.started_at
+            taps = engine.stats()['taps']
+            print(f" {taps} emulated taps on {len(sources)} readers in {elapsed:.2f} s ({taps / elapsed:.1f} taps/s)")
+        engine.wait()
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        print(f" Error: {e}")
+        return 1
+    finally:
+        stop_control_server(server, control)
+        engine.shutdown()
+        if exporter is not None:
+            exporter.close()
+        if capture is not None:
+            capture.close()
+        print("\nMulti-reader engine stopped.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
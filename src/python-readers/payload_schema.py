@@ -0,0 +1,57 @@
+"""
+Schema-aware decoding of decrypted card payloads.
+
+The generic path (reader_core.decode_card_payload) finds the end of the
+JSON object, copies and decodes it and hands it to json.loads, building a
+dict of every field on the card.  The services only use one or two of
+them: transport the SIN, electricity the SIN and Meter ID, voting the
+VoterID.  A PayloadSchema extracts just those fields, with one precompiled
+pattern each, straight from a memoryview of the plaintext, and checks each
+value against its kind:
+
+    PROFILE = ServiceProfile(..., payload_schema=PayloadSchema({'SIN': 'digits', 'Meter ID': 'digits'}))
+
+Kinds: 'digits' (a JSON string of 1-32 ASCII digits), 'int' (a JSON
+integer) and 'text' (a JSON string without escape sequences).  A missing
+or malformed field raises ValueError, like a payload that does not parse.
+"""
+import re  # Precompiled field extractors
+import json  # JSON spelling of the field names
+
+_VALUE_PATTERNS = {
+    'digits': rb'"([0-9]{1,32})"',
+    'int': rb'(-?[0-9]{1,18})(?![0-9.eE])',
+    'text': rb'"([^"\\\x00-\x1f]*)"',
+}
+_CONVERTERS = {
+    'digits': lambda raw: raw.decode('ascii'),
+    'int': int,
+    'text': lambda raw: raw.decode('utf-8'),
+}
+
+
+class PayloadSchema:
+    """The fields a service reads from its card payload, each with the kind of value it must hold."""
+
+    def __init__(self, fields):
+        self.fields = dict(fields)  # Field name -> kind
+        self._extractors = []
+        for name, kind in self.fields.items():
+            if kind not in _VALUE_PATTERNS:
+                raise ValueError(f"unknown kind '{kind}' for payload field '{name}'")
+            key = re.escape(json.dumps(name).encode('utf-8'))
+            self._extractors.append((name, re.compile(key + rb'\s*:\s*' + _VALUE_PATTERNS[kind]), _CONVERTERS[kind]))
+
+    def decode(self, decrypted_data):
+        """Returns {field: value} for the schema's fields; raises ValueError if one is missing or malformed."""
+        view = memoryview(decrypted_data)
+        card_details = {}
+        for name, pattern, convert in self._extractors:
+            match = pattern.search(view)
+            if match is None:
+                raise ValueError(f"card payload field '{name}' is missing or malformed")
+            card_details[name] = convert(match.group(1))
+        return card_details
+
+    def __repr__(self):
+        return f"PayloadSchema({self.fields!r})"
@@ -0,0 +1,730 @@
+"""
+Shared session engine for the service readers.
+
+Every applet speaks the same protocol: SELECT, GET NONCE, MUTUAL AUTH,
+RESPOND AUTH, GET PUBLIC KEY, a data read and a signature read.  Only the
+AID and a couple of INS bytes differ between services, so each reader now
+describes itself with a ServiceProfile and lets this module drive the card.
+"""
+import json  # JSON encoder and decoder for parsing the decrypted card payload
+import time  # High resolution timer for per-phase measurements
+import threading  # Thread-local phase recorder
+from contextvars import ContextVar  # Session capture per thread or asyncio task
+import logging  # Log levels of the session messages
+from contextlib import contextmanager  # Scoped phase timing
+from concurrent.futures import ThreadPoolExecutor  # APDUs in flight while the pipelined read processes chunks
+from dataclasses import dataclass  # Lightweight container for the per-service profile
+from card_transport import open_pcsc_transport, to_bytes  # Pluggable card link (PC/SC or emulator)
+from crypto_cache import PublicKeyCache, VerificationCache, VerificationTableCache, CipherCache  # Per-card crypto caches
+import ecc_tables  # Table-driven P-256 verification for frequently seen keys
+from payload_schema import PayloadSchema  # Fields a service extracts from its payload
+from session_log import log, TRACE, LazyHex, trace_apdu, trace_response, log_session  # Leveled session logging
+import metrics  # APDU, phase and session counters for the Prometheus export
+
+# --- DEPENDENCY NOTE ---
+# This module requires 'pycryptodome'. Install with: pip install pycryptodome
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS
+from Crypto.Hash import SHA256
+
+# --- Shared Configuration ---
+# The shared AES key (must be a bytes object) - 16-byte key provisioned in every applet
+AES_KEY = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0A\x0B\x0C\x0D\x0E\x0F'
+# Static reader nonce (16 bytes) for mutual authentication
+STATIC_READER_NONCE = bytes.fromhex("51525354554142434415212223242526")
+
+# --- APDU Instruction Constants (identical in every applet) ---
+INS_SELECT_APPLET = to_bytes("00 A4 04 00")  # Select the applet by AID
+INS_GET_NONCE = to_bytes("80 CA 00 00 05")  # Get card's challenge nonce for authentication
+INS_MUTUAL_AUTH = to_bytes("80 11 00 00")  # Send our encrypted challenge response
+INS_RESPOND_AUTH = to_bytes("80 12 00 00 00")  # Get card's challenge response
+INS_GET_PUBLIC_KEY = to_bytes("00 52 00 00")  # Get the card's ECDSA public key
+
+PUBLIC_KEY_LE = 0x41  # 65 bytes for an uncompressed P-256 key
+SIGNATURE_LE = 0x48  # 72 bytes is the max for a P-256 signature in DER format
+
+# Parsed public keys of recently seen cards, keyed by (card ID, applet AID).
+# Call public_key_cache.invalidate(card_id) when a card is reissued.
+public_key_cache = PublicKeyCache()
+# Payloads whose signature already verified under a given card key (see VerificationCache)
+verification_cache = VerificationCache()
+# Precomputed comb tables of hot card keys for new payloads; verification_tables.max_bytes = 0 turns them off
+verification_tables = VerificationTableCache()
+# AES-ECB cipher objects per service key, reused by every session in this process
+cipher_cache = CipherCache()
+
+# Threads that wait on the card for pipelined reads (one outstanding APDU per session)
+_apdu_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='apdu')
+
+# Response sizes tried for chunked data reads, largest first: (extended-length APDU, Le).
+# A reader starts at the first step and moves down when the card or reader rejects it.
+READ_SIZE_STEPS = ((True, 4096), (True, 1024), (False, 256), (False, 128), (False, 64))
+_read_size_steps = {}  # (reader name, applet AID) -> step that last worked on that reader
+
+
+@dataclass(frozen=True)
+class ServiceProfile:
+    """Everything that differs between the service readers."""
+    name: str  # Service name used in progress messages (e.g. "Bank")
+    aid: list  # Application Identifier of the service applet
+    data_ins: list  # CLA INS of the data read; P1 P2 Le are appended per request
+    signature_apdu: list  # CLA INS P1 P2 of the signature read; Le is appended
+    db_file: str  # Path of the service database backing this reader
+    chunked_data: bool = True  # Read data in offset-addressed chunks (P1|P2 = offset)
+    show_details: bool = True  # Print every decrypted field after a successful read
+    key: bytes = AES_KEY  # Shared AES key for this applet
+    reader_nonce: bytes = STATIC_READER_NONCE  # Reader's half of the mutual challenge
+    payload_schema: PayloadSchema = None  # Decode only these fields; None parses the whole JSON object
+
+
+# --- Phase Timing ---
+# Session phases, in protocol order: select, nonce, mutual_auth, pubkey,
+# data_read, signature, verify, decrypt.  Service code may add db_commit.
+# Every phase is also observed in metrics.phase_seconds.
+_phase_state = threading.local()
+
+
+@contextmanager
+def record_phases(recorder):
+    """Routes phase timings of sessions run in this thread to recorder(phase, seconds)."""
+    previous = getattr(_phase_state, 'recorder', None)
+    _phase_state.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _phase_state.recorder = previous
+
+
+@contextmanager
+def timed_phase(name):
+    """Times the enclosed block as the named phase, for the metrics and the active recorder if any."""
+    recorder = getattr(_phase_state, 'recorder', None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.phase_seconds.observe(seconds, name)
+        if recorder is not None:
+            recorder(name, seconds)
+
+
+# --- Session Capture ---
+# A session run under capture_sessions(sink) is handed to sink(capture) once
+# its data and signature have been read.  The capture is a dict of bytes:
+# card_id, public_key (raw uncompressed point), chunks (ciphertext as read)
+# and signature (DER), plus ok, the live verdict.  session_audit.py writes
+# captures to a JSON-lines log and re-verifies them offline.  Context
+# variables rather than thread-locals, so the sessions of one event loop
+# (async_session) each have their own.
+_capture_sink = ContextVar('capture_sink', default=None)
+_capture_current = ContextVar('capture_current', default=None)
+
+
+@contextmanager
+def capture_sessions(sink):
+    """Hands the sessions run in this thread (or asyncio task) to sink(capture); sink=None records nothing."""
+    token = _capture_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _capture_sink.reset(token)
+
+
+def _capture_chunk(chunk):
+    capture = _capture_current.get()
+    if capture is not None and chunk:
+        capture['chunks'].append(bytes(chunk))
+
+
+def _capture_signature(signature):
+    capture = _capture_current.get()
+    if capture is not None:
+        capture['signature'] = bytes(signature)
+
+
+def connect_to_card(transport=None):
+    """
+    Returns the card link the session runs over: the given transport (for
+    example a card_emulator.EmulatedCard) or the card in the first PC/SC reader.
+    """
+    if transport is not None:
+        return transport
+    return open_pcsc_transport(0)
+
+
+# --- Session Steps ---
+# Each protocol step is written once, as a generator that yields the
+# blocking calls it needs as (func, *args) - an APDU round trip through
+# transmit_apdu, or the ECDSA check - and is sent each call's result (or
+# has its exception thrown in).  run_steps makes the calls in this thread;
+# async_session.run_steps awaits them on an executor.  The sync and async
+# session APIs therefore share every check, size fallback and capture.
+def run_steps(steps):
+    """Runs a step generator, making the calls it yields in this thread; returns its result."""
+    result, error = None, None
+    while True:
+        try:
+            call = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = call[0](*call[1:]), None
+        except Exception as e:
+            result, error = None, e
+
+
+def transmit_apdu(conn, apdu, description):
+    """One APDU round trip: (resp, sw1, sw2), or ([], None, None) if the transmit itself failed."""
+    trace_apdu(description, apdu)
+    try:
+        return metrics.transmit(conn, apdu)
+    except Exception as e:
+        log.error(" Error transmitting APDU for '%s': %s", description, e)
+        return [], None, None
+
+
+def transmit_steps(conn, apdu, description):
+    """Steps of transmit_and_check."""
+    resp, sw1, sw2 = yield transmit_apdu, conn, apdu, description
+    if sw1 is None:
+        return None, False
+    return check_response(resp, sw1, sw2, description)
+
+
+def transmit_and_check(conn, apdu, description):
+    """Transmits an APDU and checks for a success (90 00) status word."""
+    return run_steps(transmit_steps(conn, apdu, description))
+
+
+def check_response(resp, sw1, sw2, description):
+    """Logs a card response and returns (resp, True) for 90 00, (None, False) otherwise."""
+    trace_response(resp, sw1, sw2)
+    if (sw1, sw2) != (0x90, 0x00):
+        log.warning(" Operation failed for: %s", description)
+        return None, False
+    return resp, True
+
+
+def run_authentication(conn, profile):
+    """
+    Runs the full mutual authentication sequence for the given service.
+    Returns the 16-byte card ID from the card's response, or None on failure.
+    """
+    return run_steps(authentication_steps(conn, profile))
+
+
+def authentication_steps(conn, profile):
+    """Steps of run_authentication."""
+    log.debug("--- 1. MUTUAL AUTHENTICATION ---")
+
+    # Step 1: Select Applet
+    select_apdu = list(INS_SELECT_APPLET) + [len(profile.aid)] + list(profile.aid)
+    with timed_phase('select'):
+        _, success = yield from transmit_steps(conn, select_apdu, "SELECT Applet")
+    if not success: return None
+
+    # Step 2: Get card's nonce (challenge)
+    with timed_phase('nonce'):
+        card_nonce_resp, success = yield from transmit_steps(conn, list(INS_GET_NONCE), "GET Card Nonce")
+    if not success: return None
+
+    with timed_phase('mutual_auth'):
+        # Step 3: Encrypt (card_nonce + reader_nonce) and send to card
+        cipher, mutual_auth_apdu = build_mutual_auth(profile, card_nonce_resp)
+        _, success = yield from transmit_steps(conn, mutual_auth_apdu, "SEND Mutual Auth Challenge")
+        if not success:
+            log.warning("   Authentication failed at step 3.")
+            return None
+
+        # Step 4: Ask card to respond to our challenge
+        respond_auth_resp, success = yield from transmit_steps(conn, list(INS_RESPOND_AUTH), "GET Respond Auth")
+        if not success:
+            log.warning("   Authentication failed at step 4.")
+            return None
+
+        # Step 5: Verify card's response (reader nonce || card ID)
+        decrypted_response = cipher.decrypt(bytes(respond_auth_resp))
+    return check_auth_response(profile, decrypted_response)
+
+
+def build_mutual_auth(profile, card_nonce_resp):
+    """Returns the session cipher and the MUTUAL AUTH APDU answering the card's nonce."""
+    cipher = cipher_cache.get(profile.key)
+    encrypted_data = cipher.encrypt(bytes(card_nonce_resp) + profile.reader_nonce)
+    return cipher, list(INS_MUTUAL_AUTH) + [len(encrypted_data)] + list(encrypted_data)
+
+
+def check_auth_response(profile, decrypted_response):
+    """Checks the card echoed our nonce; returns the card ID that follows it, or None."""
+    responded_reader_nonce = decrypted_response[:16]
+    responded_card_id = decrypted_response[16:32]
+    log.log(TRACE, "   Card ID Returned: %s", LazyHex(responded_card_id))
+
+    if responded_reader_nonce != profile.reader_nonce:
+        log.warning("   Verification Failed: Reader nonce mismatch!")
+        return None
+
+    log.debug("   Reader nonce verified successfully.")
+    log.debug(" Mutual Authentication successful!\n")
+    return bytes(responded_card_id)
+
+
+def get_public_key(conn):
+    """Retrieves the card's ECDSA public key."""
+    return run_steps(public_key_steps(conn))
+
+
+def public_key_steps(conn):
+    """Steps of get_public_key."""
+    log.debug("--- 2a. RETRIEVING PUBLIC KEY ---")
+    apdu = list(INS_GET_PUBLIC_KEY) + [PUBLIC_KEY_LE]
+    pub_key_bytes, success = yield from transmit_steps(conn, apdu, "GET Public Key")
+    if not success:
+        return None
+
+    return parse_public_key(pub_key_bytes)
+
+
+def parse_public_key(pub_key_bytes):
+    """Imports the raw key returned by GET PUBLIC KEY; None if it is malformed."""
+    # The first byte (0x04) indicates an uncompressed key.
+    try:
+        public_key = ECC.import_key(bytes(pub_key_bytes), curve_name='P-256')
+        log.debug(" Public Key retrieved and parsed successfully.\n")
+        return public_key
+    except Exception as e:
+        log.warning(" Error parsing public key: %s", e)
+        return None
+
+
+def get_data_signature(conn, profile):
+    """Retrieves the signature of the service data from the card."""
+    return run_steps(signature_steps(conn, profile))
+
+
+def signature_steps(conn, profile):
+    """Steps of get_data_signature."""
+    log.debug("--- 2c. RETRIEVING SIGNATURE ---")
+    apdu = list(profile.signature_apdu) + [SIGNATURE_LE]
+    signature, success = yield from transmit_steps(conn, apdu, f"GET {profile.name} Data Signature")
+    if not success:
+        return None
+    log.debug(" Signature retrieved successfully.\n")
+    return bytes(signature)
+
+
+def verify_data_signature(public_key, encrypted_data, signature):
+    """Checks the card's DER ECDSA-SHA256 signature over the encrypted data; raises ValueError if invalid."""
+    verify_digest_signature(public_key, SHA256.new(encrypted_data), signature)
+
+
+def verify_digest_signature(public_key, hash_obj, signature, cache=None):
+    """
+    Like verify_data_signature, for data already hashed into hash_obj.
+    A payload that already verified under this key is answered from cache
+    (default: verification_cache) without the ECDSA arithmetic; a new payload
+    under a hot key is checked with its precomputed table (verification_tables).
+    """
+    cache = verification_cache if cache is None else cache
+    cache_key = cache.key_for(public_key, hash_obj.digest(), signature)
+    if cache.check(cache_key):
+        return
+    signature_rs = der_to_concat_rs(signature)
+    table = verification_tables.get(cache_key[0], public_key)
+    if table is None:
+        DSS.new(public_key, 'fips-186-3').verify(hash_obj, signature_rs)
+    elif not ecc_tables.verify(table, hash_obj.digest(), signature_rs):
+        raise ValueError("The signature is not authentic")
+    cache.add(cache_key)
+
+
+def der_to_concat_rs(der_sig):
+    """
+    Convert DER-encoded ECDSA signature to raw concatenated r||s format for pycryptodome DSS.
+    """
+    if der_sig[0] != 0x30:
+        raise ValueError("Invalid DER encoding")
+
+    r_len = der_sig[3]
+    r_start = 4
+    r = der_sig[r_start : r_start + r_len]
+
+    s_len_pos = r_start + r_len + 1
+    s_len = der_sig[s_len_pos]
+    s_start = s_len_pos + 1
+    s = der_sig[s_start : s_start + s_len]
+
+    # Handle case where r or s are negative (high bit set) and DER adds a leading 0x00
+    if r[0] == 0x00 and r_len == 33:
+        r = r[1:]
+    if s[0] == 0x00 and s_len == 33:
+        s = s[1:]
+
+    # Pad with 0s if needed to make both r and s 32 bytes
+    return r.rjust(32, b'\x00') + s.rjust(32, b'\x00')
+
+
+class ReadSize:
+    """
+    Response size of the chunked data reads in one session.  Starts at the
+    step that last worked on this reader for this applet and steps down
+    through READ_SIZE_STEPS when a read is rejected.
+    """
+
+    def __init__(self, conn, profile):
+        self._key = (str(conn), bytes(profile.aid))
+        self.step = _read_size_steps.get(self._key, 0)
+        self.extended, self.le = READ_SIZE_STEPS[self.step]
+
+    def retry_after(self, sw1, sw2):
+        """
+        Adjusts the size after a rejected read and returns True if the read
+        should be retried.  sw1 None means the transmit itself failed.
+        """
+        if sw1 == 0x6C and (self.extended or self.le != (sw2 or 256)):
+            self.extended, self.le = False, sw2 or 256  # Wrong Le: SW2 is the exact length available
+            return True
+        if ((sw1, sw2) == (0x67, 0x00) or (sw1 is None and self.extended)) and self.step + 1 < len(READ_SIZE_STEPS):
+            self.step += 1
+            self.extended, self.le = READ_SIZE_STEPS[self.step]
+            _read_size_steps[self._key] = self.step  # Later sessions on this reader start here
+            return True
+        return False
+
+
+def data_read_apdu(profile, offset, size=None):
+    """Returns the data read APDU for offset (chunked reads: with the Le of size) and its description."""
+    if not profile.chunked_data:
+        return list(profile.data_ins) + [0x00, 0x00, 0x00], f"GET {profile.name} Data"
+    p1 = offset >> 8  # High byte of offset
+    p2 = offset & 0xFF  # Low byte of offset
+    if size.extended:
+        le = [0x00, (size.le >> 8) & 0xFF, size.le & 0xFF]  # Extended Le: 00 Le1 Le2
+    else:
+        le = [size.le & 0xFF]  # 256 is encoded as 00
+    return list(profile.data_ins) + [p1, p2] + le, f"GET {profile.name} Data (offset {offset}, Le {size.le})"
+
+
+def check_read_status(resp, sw1, sw2, description, offset, size):
+    """
+    Classifies the answer to a chunked data read: 'ok', 'end' (the previous
+    chunk was the last one), 'retry' (with the adjusted size) or 'failed'.
+    """
+    if sw1 is not None and (sw1, sw2) == (0x90, 0x00):
+        check_response(resp, sw1, sw2, description)
+        return 'ok'
+    if sw1 is not None:
+        trace_response(resp, sw1, sw2)
+    if offset and (sw1, sw2) == (0x6B, 0x00):  # Offset equals the data length
+        return 'end'
+    if size.retry_after(sw1, sw2):
+        log.debug("   Retrying with Le %d%s", size.le, ' (extended)' if size.extended else '')
+        return 'retry'
+    log.warning(" Operation failed for: %s", description)
+    return 'failed'
+
+
+def read_chunk(conn, profile, offset, size):
+    """
+    Reads the chunk at offset, falling back to smaller sizes on 6Cxx / 67 00.
+    Returns (resp, success); an empty resp means there is no more data.
+    """
+    return run_steps(read_chunk_steps(conn, profile, offset, size))
+
+
+def read_chunk_steps(conn, profile, offset, size):
+    """Steps of read_chunk."""
+    while True:
+        apdu, description = data_read_apdu(profile, offset, size)
+        resp, sw1, sw2 = yield transmit_apdu, conn, apdu, description
+        status = check_read_status(resp, sw1, sw2, description, offset, size)
+        if status == 'ok':
+            return resp, True
+        if status == 'end':
+            return [], True
+        if status == 'failed':
+            return None, False
+
+
+def read_card_data(conn, profile):
+    """Reads the encrypted service data, chunk by chunk if the applet supports offsets."""
+    return run_steps(read_card_data_steps(conn, profile))
+
+
+def read_card_data_steps(conn, profile):
+    """Steps of read_card_data."""
+    if not profile.chunked_data:
+        resp, success = yield from transmit_steps(conn, *data_read_apdu(profile, 0))
+        if success: _capture_chunk(resp)
+        return bytearray(resp) if success else None
+
+    encrypted_data = bytearray()
+    size = ReadSize(conn, profile)
+    offset = 0
+    while True:
+        resp, success = yield from read_chunk_steps(conn, profile, offset, size)
+        if not success: return None
+        if not resp: break
+        encrypted_data.extend(resp)
+        _capture_chunk(resp)
+        offset += len(resp)
+        if len(resp) < size.le: break  # Short chunk means end of data
+    return encrypted_data
+
+
+def decrypt_card_data(profile, encrypted_data):
+    """Decrypts the verified card data and parses the JSON payload."""
+    return decode_card_payload(cipher_cache.decrypt(profile.key, encrypted_data), profile.payload_schema)
+
+
+def decrypt_card_data_batch(profile, encrypted_payloads):
+    """
+    Decrypts and parses many verified payloads of one service with a single
+    cipher call.  Returns the card details in order, None for a payload that
+    does not parse.
+    """
+    results = []
+    for plaintext in cipher_cache.decrypt_batch(profile.key, encrypted_payloads):
+        try:
+            results.append(decode_card_payload(plaintext, profile.payload_schema))
+        except ValueError:  # Includes json.JSONDecodeError and UnicodeDecodeError
+            results.append(None)
+    return results
+
+
+def print_card_details(profile, card_details):
+    """Logs the decrypted fields at DEBUG level (console mode) if the profile shows them."""
+    log.debug(" Data decrypted and parsed as JSON.\n")
+    if profile.show_details and log.isEnabledFor(logging.DEBUG):
+        log.debug("   --- Decrypted Card Details ---")
+        for k, v in card_details.items():
+            log.debug("   %s: %s", k, v)
+        log.debug("   ------------------------------\n")
+
+
+def decode_card_payload(decrypted_data, schema=None):
+    """
+    Parses the decrypted payload, ignoring the block padding after the JSON
+    object.  With a PayloadSchema only its fields are extracted and checked.
+    """
+    if schema is not None:
+        return schema.decode(decrypted_data)
+    last_brace_index = decrypted_data.rfind(b'}')
+    if last_brace_index == -1:
+        raise ValueError("Could not find valid JSON object in decrypted data.")
+    return json.loads(decrypted_data[:last_brace_index + 1].decode('utf-8'))
+
+
+def retrieve_verify_and_decrypt_data(conn, profile, public_key):
+    """
+    Retrieves encrypted data, verifies its signature, and then decrypts it.
+    """
+    return run_steps(retrieve_steps(conn, profile, public_key))
+
+
+def retrieve_steps(conn, profile, public_key):
+    """Steps of retrieve_verify_and_decrypt_data."""
+    log.debug("--- 2. SECURE DATA RETRIEVAL & VERIFICATION ---")
+
+    # --- Step 2b: Retrieve the encrypted data ---
+    log.debug("--- 2b. RETRIEVING ENCRYPTED %s DATA ---", profile.name.upper())
+    with timed_phase('data_read'):
+        encrypted_data = yield from read_card_data_steps(conn, profile)
+    if encrypted_data is None:
+        return None
+    log.debug(" Full encrypted data retrieved (%d bytes).\n", len(encrypted_data))
+
+    # --- Step 2c: Get the signature for the data we just retrieved ---
+    with timed_phase('signature'):
+        signature = yield from signature_steps(conn, profile)
+    if not signature:
+        log.warning(" Failed to retrieve data signature. Aborting.")
+        return None
+    _capture_signature(signature)
+
+    # --- Step 2d: Verify the signature ---
+    log.debug("--- 2d. VERIFYING DATA SIGNATURE ---")
+    try:
+        with timed_phase('verify'):
+            yield verify_data_signature, public_key, bytes(encrypted_data), signature
+        log.debug(" SIGNATURE VERIFIED: The data is authentic and has not been tampered with.\n")
+    except (ValueError, TypeError, IndexError):
+        log.error(" VERIFICATION FAILED: The signature is invalid! Aborting.",
+                  exc_info=log.isEnabledFor(logging.DEBUG))
+        metrics.signature_failures.inc(str(conn), profile.name)
+        return None
+
+    # --- Step 2e: Decrypt the data (only if signature is valid) ---
+    log.debug("--- 2e. DECRYPTING CARD DATA ---")
+    try:
+        with timed_phase('decrypt'):
+            card_details = decrypt_card_data(profile, encrypted_data)
+    except Exception as e:
+        log.error(" An error occurred during decryption/parsing: %s", e)
+        return None
+
+    print_card_details(profile, card_details)
+    return card_details
+
+
+class ChunkPipeline:
+    """Hashes and decrypts the card data chunk by chunk as it arrives."""
+
+    def __init__(self, profile):
+        self.hash_obj = SHA256.new()
+        self.cipher = cipher_cache.get(profile.key)
+        self.plaintext = bytearray()
+        self.length = 0
+        self._partial_block = b''  # Bytes of an AES block split across two chunks
+
+    def feed(self, chunk):
+        chunk = bytes(chunk)
+        self.hash_obj.update(chunk)
+        self.length += len(chunk)
+        data = self._partial_block + chunk
+        aligned = len(data) - len(data) % 16
+        self.plaintext += self.cipher.decrypt(data[:aligned])
+        self._partial_block = data[aligned:]
+
+    def finish(self):
+        """Returns the decrypted data; valid only once the signature over it has been verified."""
+        if self._partial_block:
+            raise ValueError(f"card data length {self.length} is not a multiple of the AES block size")
+        return bytes(self.plaintext)
+
+
+def _submit_data_read(conn, profile, offset, size):
+    if not profile.chunked_data:
+        return _apdu_pool.submit(transmit_and_check, conn, *data_read_apdu(profile, offset))
+    return _apdu_pool.submit(read_chunk, conn, profile, offset, size)
+
+
+def retrieve_verify_and_decrypt_pipelined(conn, profile, public_key):
+    """
+    Pipelined retrieve_verify_and_decrypt_data.  The next data chunk - or,
+    after the last one, the signature - is requested on an APDU thread before
+    the current chunk is hashed and decrypted, so that work runs while the
+    card is busy.  When the signature arrives only the ECDSA check is left.
+    The plaintext is still used only after the signature has been verified.
+    """
+    log.debug("--- 2. SECURE DATA RETRIEVAL & VERIFICATION (pipelined) ---")
+    log.debug("--- 2b. RETRIEVING ENCRYPTED %s DATA ---", profile.name.upper())
+    pipeline = ChunkPipeline(profile)
+    size = ReadSize(conn, profile)
+    signature_request = None
+    with timed_phase('data_read'):
+        offset = 0
+        pending = _submit_data_read(conn, profile, offset, size)
+        while signature_request is None:
+            resp, success = pending.result()
+            if not success: return None
+            _capture_chunk(resp)
+            offset += len(resp)
+            if not profile.chunked_data or len(resp) < size.le:  # Short chunk means end of data
+                log.debug("--- 2c. RETRIEVING SIGNATURE ---")
+                signature_request = _apdu_pool.submit(transmit_and_check, conn,
+                                                      list(profile.signature_apdu) + [SIGNATURE_LE],
+                                                      f"GET {profile.name} Data Signature")
+            else:
+                pending = _submit_data_read(conn, profile, offset, size)
+            pipeline.feed(resp)  # Overlaps the request just submitted
+    log.debug(" Full encrypted data retrieved (%d bytes).\n", pipeline.length)
+
+    with timed_phase('signature'):
+        signature, success = signature_request.result()
+    if not success:
+        log.warning(" Failed to retrieve data signature. Aborting.")
+        return None
+    log.debug(" Signature retrieved successfully.\n")
+    _capture_signature(signature)
+
+    log.debug("--- 2d. VERIFYING DATA SIGNATURE ---")
+    try:
+        with timed_phase('verify'):
+            verify_digest_signature(public_key, pipeline.hash_obj, bytes(signature))
+        log.debug(" SIGNATURE VERIFIED: The data is authentic and has not been tampered with.\n")
+    except (ValueError, TypeError, IndexError):
+        log.error(" VERIFICATION FAILED: The signature is invalid! Aborting.",
+                  exc_info=log.isEnabledFor(logging.DEBUG))
+        metrics.signature_failures.inc(str(conn), profile.name)
+        return None
+
+    log.debug("--- 2e. DECRYPTING CARD DATA ---")
+    try:
+        with timed_phase('decrypt'):
+            card_details = decode_card_payload(pipeline.finish(), profile.payload_schema)
+    except Exception as e:
+        log.error(" An error occurred during decryption/parsing: %s", e)
+        return None
+
+    print_card_details(profile, card_details)
+    return card_details
+
+
+def finish_session(conn, profile, card_id, result, started):
+    """Logs and counts a finished session; result is 'ok' or the step that failed."""
+    metrics.session_finished(conn, profile.name, result, time.perf_counter() - started)
+    log_session(profile, card_id, result, started)
+
+
+def run_card_session(conn, profile, key_cache=None, pipelined=False):
+    """
+    Authenticates the card and returns its verified, decrypted details (or None).
+
+    The card's public key is taken from key_cache (default: the module-wide
+    public_key_cache) when the authenticated card ID has been seen before.
+    A session that fails with a cached key drops that entry, so the next tap
+    fetches the key from the card again.  pipelined=True reads the data with
+    retrieve_verify_and_decrypt_pipelined.  Under capture_sessions the
+    session's key, ciphertext and signature are handed to the sink.
+    """
+    return run_steps(session_steps(conn, profile, key_cache, pipelined))
+
+
+def session_steps(conn, profile, key_cache=None, pipelined=False):
+    """Steps of run_card_session."""
+    key_cache = public_key_cache if key_cache is None else key_cache
+    started = time.perf_counter()
+    card_id = yield from authentication_steps(conn, profile)
+    if card_id is None:
+        finish_session(conn, profile, None, 'auth_failed', started)
+        return None
+
+    with timed_phase('pubkey'):
+        public_key = key_cache.get(card_id, profile.aid)
+        from_cache = public_key is not None
+        if from_cache:
+            log.debug("--- 2a. PUBLIC KEY (cached for this card) ---\n")
+        else:
+            public_key = yield from public_key_steps(conn)
+            if public_key:
+                key_cache.put(card_id, profile.aid, public_key)
+    if not public_key:
+        log.warning("Could not retrieve a valid public key from the card. Aborting.")
+        finish_session(conn, profile, card_id, 'no_public_key', started)
+        return None
+
+    sink = _capture_sink.get()
+    capture = None
+    if sink is not None:
+        capture = {'card_id': bytes(card_id), 'public_key': public_key.export_key(format='raw'),
+                   'chunks': [], 'signature': None}
+    _capture_current.set(capture)
+    try:
+        if pipelined:  # Runs its own APDU threads: one blocking call
+            card_details = yield retrieve_verify_and_decrypt_pipelined, conn, profile, public_key
+        else:
+            card_details = yield from retrieve_steps(conn, profile, public_key)
+    finally:
+        _capture_current.set(None)
+    if capture is not None and capture['signature'] is not None:
+        capture['ok'] = bool(card_details)
+        sink(capture)
+    if not card_details:
+        if from_cache:
+            key_cache.invalidate(card_id, profile.aid)
+        log.debug("--- PROCESS FAILED ---")
+        log.debug("Failed to retrieve or verify data from the smart card.")
+    finish_session(conn, profile, card_id, 'ok' if card_details else 'data_failed', started)
+    return card_details
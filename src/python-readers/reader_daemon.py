@@ -0,0 +1,388 @@
+"""
+Long-running reader service.
+
+The reader scripts connect, run one card session and exit, so every tap
+pays for interpreter start-up, pycryptodome loading, reading the JSON
+database and opening the reader.  ReaderDaemon does that work once, then
+waits for card insert/remove events and processes taps back to back with
+the database, the public key cache and the reader context kept warm.
+
+A local control socket answers one-line commands with a JSON document:
+
+    health   daemon state, uptime and whether a card is on the reader
+    stats    tap counters, session latency and public key cache statistics
+    stop     finishes the current tap and shuts the daemon down
+
+--metrics exports the session metrics (metrics.py) in the Prometheus text
+format: 'host:port' serves GET /metrics, a path is rewritten every 15 s
+for node_exporter's textfile collector.
+
+    python reader_daemon.py electricity
+    python reader_daemon.py electricity --query stats
+    python reader_daemon.py bank --emulate 100 --session-only
+    python reader_daemon.py electricity --metrics 127.0.0.1:9464
+"""
+import os  # Socket file cleanup
+import sys  # Exit status
+import json  # Control socket replies
+import time  # Uptime and session timing
+import queue  # Card events handed from the PC/SC monitor thread
+import signal  # SIGTERM/SIGINT shut the daemon down cleanly
+import socket  # Control socket client and AF_UNIX detection
+import argparse  # Command line options
+import tempfile  # Default location of the control socket
+import threading  # Control server thread
+import socketserver  # Control socket server
+from collections import deque  # Bounded window of recent session latencies
+from Crypto.Hash import SHA256
+import bank_reader
+import Electricity_reader
+import transport_reader
+import voting_reader
+from card_transport import PcscTransport, list_pcsc_readers
+import ecc_tables
+import metrics
+from reader_core import (run_card_session, capture_sessions, public_key_cache, verification_cache, verification_tables,
+                         cipher_cache)
+from session_audit import CaptureLog
+from session_log import log, configure_logging, MODES as LOG_MODES
+
+SERVICES = {
+    # service: (reader module, database loader, store)
+    'bank': (bank_reader, bank_reader.load_accounts, bank_reader.ACCOUNTS_STORE),
+    'electricity': (Electricity_reader, Electricity_reader.load_user_database, Electricity_reader.USER_DB_STORE),
+    'transport': (transport_reader, transport_reader.USER_DB_STORE.load, transport_reader.USER_DB_STORE),
+    'voting': (voting_reader, voting_reader.load_database, voting_reader.VOTING_STORE),
+}
+LATENCY_WINDOW = 1000  # Recent sessions kept for the latency percentiles in 'stats'
+
+
+# --- Card event sources ---
+class PcscCardEvents:
+    """Card insert/remove events of one PC/SC reader, fed by pyscard's CardMonitor."""
+
+    def __init__(self, reader_index=0):
+        from smartcard.CardMonitoring import CardMonitor, CardObserver
+        self.reader = list_pcsc_readers()[reader_index]
+        self.name = str(self.reader)
+        self._events = queue.Queue()
+        events, reader_name = self._events, self.name
+
+        class _Observer(CardObserver):
+            def update(self, observable, actions):
+                added, removed = actions
+                for card in added:
+                    if str(card.reader) == reader_name:
+                        events.put(('insert', card))
+                for card in removed:
+                    if str(card.reader) == reader_name:
+                        events.put(('remove', card))
+
+        self._observer = _Observer()
+        self._monitor = CardMonitor()
+        self._monitor.addObserver(self._observer)  # Also reports a card already on the reader
+
+    def next_event(self, timeout):
+        """Returns ('insert' | 'remove', card) or None if nothing happened within timeout."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def connect(self, card):
+        return PcscTransport(self.reader)
+
+    def close(self):
+        self._monitor.deleteObserver(self._observer)
+
+
+class EmulatedCardEvents:
+    """Taps emulated cards in rotation, `count` times, `interval` seconds apart."""
+
+    def __init__(self, service, count, interval=0.0, cards=1, latency=0.0, name="emulated reader", first_card=0):
+        from card_emulator import EmulatedCard, CARD_ID
+        self.name = name
+        self.cards = [EmulatedCard(services=[service], card_id=CARD_ID[:12] + i.to_bytes(4, 'big'), latency=latency)
+                      for i in range(first_card, first_card + cards)]
+        for card in self.cards:
+            card.name = name  # Metrics label the APDUs with the terminal, like a PC/SC reader name
+        self.remaining = count
+        self.interval = interval
+        self._next_tap = 0
+        self._present = None
+
+    def next_event(self, timeout):
+        if self._present is not None:
+            card, self._present = self._present, None
+            return ('remove', card)
+        if self.remaining == 0:
+            time.sleep(timeout)
+            return None
+        time.sleep(self.interval)
+        self.remaining -= 1
+        self._present = self.cards[self._next_tap % len(self.cards)]
+        self._next_tap += 1
+        return ('insert', self._present)
+
+    @property
+    def finished(self):
+        """True once every tap has been made and its card removed."""
+        return self.remaining == 0 and self._present is None
+
+    def connect(self, card):
+        return card
+
+    def close(self):
+        pass
+
+
+# --- Daemon ---
+class ReaderDaemon:
+    """Processes card taps for one service until stopped."""
+
+    def __init__(self, service, events, session_only=False, database=None, handler=None, pipelined=False,
+                 capture=None):
+        self.service = service
+        self.reader, self.load_db, self.store = SERVICES[service]
+        self.profile = self.reader.PROFILE
+        self.events = events
+        self.session_only = session_only  # Authenticate and verify only, skip the service handler
+        self.database = database  # Loaded by warm_up unless shared with other readers
+        self.handler = handler or self.reader.handle_card  # handler(card_details, database)
+        self.pipelined = pipelined  # Overlap chunk hashing/decryption with card I/O
+        self.capture = capture  # Sink for reader_core.capture_sessions, e.g. a session_audit.CaptureLog
+        self.state = 'starting'
+        self.card_present = False
+        self.started_at = time.time()
+        self.counters = {'taps': 0, 'sessions_ok': 0, 'sessions_failed': 0, 'errors': 0, 'removals': 0}
+        self.last_tap_at = None
+        self.session_times = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()  # Guards counters and session_times against the control thread
+        self._stop = threading.Event()
+
+    def warm_up(self):
+        """Loads the database and the crypto primitives before the first tap."""
+        if self.database is None:
+            self.database = self.load_db()
+        if self.database is None:
+            raise RuntimeError(f"could not load the {self.service} database '{self.profile.db_file}'")
+        cipher_cache.get(self.profile.key).decrypt(bytes(16))  # Key schedule built before the first tap
+        SHA256.new(b'').digest()
+        if verification_tables.max_bytes > 0:
+            ecc_tables.generator_table()  # Shared G table (~150 ms) built before the first hot key
+
+    def serve_forever(self, poll_interval=0.5):
+        """Waits for card events and handles taps until stop() is called."""
+        self.warm_up()
+        self.state = 'idle'
+        print(f" {self.profile.name} reader ready on {self.events.name}. Waiting for a card...")
+        while not self._stop.is_set():
+            event = self.events.next_event(poll_interval)
+            if event is None:
+                continue
+            kind, card = event
+            if kind == 'remove':
+                self.card_present = False
+                with self._lock:
+                    self.counters['removals'] += 1
+                continue
+            self.card_present = True
+            self._handle_tap(card)
+        self.state = 'stopped'
+
+    def _handle_tap(self, card):
+        self.state = 'processing'
+        transport = None
+        with self._lock:
+            self.counters['taps'] += 1
+            self.last_tap_at = time.time()
+        try:
+            transport = self.events.connect(card)
+            started = time.perf_counter()
+            with capture_sessions(self.capture):
+                card_details = run_card_session(transport, self.profile, pipelined=self.pipelined)
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.counters['sessions_ok' if card_details else 'sessions_failed'] += 1
+                self.session_times.append(elapsed)
+            if card_details and not self.session_only:
+                self.handler(card_details, self.database)
+        except Exception as e:
+            with self._lock:
+                self.counters['errors'] += 1
+            log.error("\n An unexpected error occurred: %s", e, exc_info=True)
+        finally:
+            if transport is not None:
+                transport.disconnect()
+            self.state = 'idle' if not self._stop.is_set() else 'stopping'
+            log.debug("\n Waiting for the next card...")
+
+    def stop(self):
+        self._stop.set()
+        if self.state != 'stopped':
+            self.state = 'stopping'
+
+    def shutdown(self):
+        """Releases the reader and the database files."""
+        self.events.close()
+        self.store.close()
+
+    def health(self):
+        return {'service': self.service, 'state': self.state, 'card_present': self.card_present,
+                'reader': self.events.name, 'uptime_s': round(time.time() - self.started_at, 3),
+                'pid': os.getpid()}
+
+    def stats(self):
+        with self._lock:
+            times = sorted(self.session_times)
+            stats = {'service': self.service, **self.counters, 'last_tap_at': self.last_tap_at}
+        if times:
+            stats['session_ms'] = {'window': len(times), 'mean': sum(times) / len(times) * 1000,
+                                   'p50': times[len(times) // 2] * 1000,
+                                   'p99': times[min(len(times) - 1, len(times) * 99 // 100)] * 1000,
+                                   'max': times[-1] * 1000}
+        stats['public_key_cache'] = public_key_cache.stats()
+        stats['verification_cache'] = verification_cache.stats()
+        stats['verification_tables'] = verification_tables.stats()
+        stats['cipher_cache'] = cipher_cache.stats()
+        stats['db_backend'] = type(self.store).__name__
+        return stats
+
+
+# --- Control socket ---
+def parse_control_address(address):
+    """'host:port' selects TCP on that address, anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.sep not in address:
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+
+def default_control_address(service):
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(tempfile.gettempdir(), f'reader-{service}.sock')
+    return '127.0.0.1:8765'  # Windows without AF_UNIX support
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.reader_daemon
+        command = self.rfile.readline(64).decode('ascii', 'replace').strip().lower()
+        if command == 'health':
+            reply = daemon.health()
+        elif command == 'stats':
+            reply = daemon.stats()
+        elif command == 'stop':
+            daemon.stop()
+            reply = {'stopping': True}
+        else:
+            reply = {'error': f"unknown command '{command}'", 'commands': ['health', 'stats', 'stop']}
+        self.wfile.write((json.dumps(reply) + "\n").encode('utf-8'))
+
+
+def start_control_server(daemon, address):
+    """Serves the control socket from a background thread; returns the server."""
+    family, bind_address = parse_control_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)  # Left behind by a daemon that was killed
+        server = socketserver.ThreadingUnixStreamServer(bind_address, _ControlHandler)
+    else:
+        server = socketserver.ThreadingTCPServer(bind_address, _ControlHandler)
+    server.daemon_threads = True
+    server.reader_daemon = daemon
+    threading.Thread(target=server.serve_forever, name='reader-control', daemon=True).start()
+    return server
+
+
+def stop_control_server(server, address):
+    server.shutdown()
+    server.server_close()
+    family, bind_address = parse_control_address(address)
+    if family == socket.AF_UNIX and os.path.exists(bind_address):
+        os.unlink(bind_address)
+
+
+def start_metrics_exporter(address, interval=15.0):
+    """'host:port' serves GET /metrics over HTTP, anything else is a textfile rewritten every interval seconds."""
+    family, bind_address = parse_control_address(address)
+    if family == socket.AF_INET:
+        return metrics.HttpExporter(bind_address)
+    return metrics.TextfileExporter(bind_address, interval)
+
+
+def query(address, command, timeout=5.0):
+    """Sends one command to a running daemon and returns its decoded reply."""
+    family, connect_address = parse_control_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(connect_address)
+        sock.sendall(f"{command}\n".encode('ascii'))
+        with sock.makefile('rb') as reply:
+            return json.loads(reply.readline())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a card reader as a long-lived service.")
+    parser.add_argument('service', choices=sorted(SERVICES))
+    parser.add_argument('--reader', type=int, default=0, help="index of the PC/SC reader")
+    parser.add_argument('--control', help="control socket path or host:port (default: per-service socket in the temp dir)")
+    parser.add_argument('--query', choices=['health', 'stats', 'stop'], help="query a running daemon and exit")
+    parser.add_argument('--emulate', type=int, metavar='TAPS', help="tap emulated cards instead of using PC/SC")
+    parser.add_argument('--interval', type=float, default=0.0, help="seconds between emulated taps")
+    parser.add_argument('--session-only', action='store_true',
+                        help="authenticate and verify taps without running the interactive service handler")
+    parser.add_argument('--pipelined', action='store_true', help="overlap chunk processing with card I/O")
+    parser.add_argument('--capture', metavar='FILE', help="append every session to FILE for session_audit.py")
+    parser.add_argument('--log', choices=LOG_MODES, default='console',
+                        help="console: every step; quiet: problems only; production: one JSON record per session")
+    parser.add_argument('--metrics', metavar='ADDRESS',
+                        help="export Prometheus metrics: host:port serves /metrics, a path is rewritten as a textfile")
+    args = parser.parse_args(argv)
+    control = args.control or default_control_address(args.service)
+    configure_logging(args.log)
+
+    if args.query:
+        try:
+            print(json.dumps(query(control, args.query), indent=2))
+        except OSError as e:
+            print(f" Error: no reader daemon answering on {control}: {e}")
+            return 1
+        return 0
+
+    if args.emulate is not None:
+        events = EmulatedCardEvents(args.service, args.emulate, args.interval)
+    else:
+        try:
+            events = PcscCardEvents(args.reader)
+        except IndexError:
+            print(" Error: No card reader found.")
+            return 1
+
+    capture = CaptureLog(args.capture, args.service) if args.capture else None
+    daemon = ReaderDaemon(args.service, events, session_only=args.session_only, pipelined=args.pipelined,
+                          capture=capture)
+    server = start_control_server(daemon, control)
+    exporter = start_metrics_exporter(args.metrics) if args.metrics else None
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    print(f" Control socket: {control}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        daemon.stop()
+    except RuntimeError as e:
+        print(f" Error: {e}")
+        return 1
+    finally:
+        stop_control_server(server, control)
+        daemon.shutdown()
+        if exporter is not None:
+            exporter.close()
+        if capture is not None:
+            capture.close()
+        print("\nReader daemon stopped.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""
+Memory-mapped binary snapshots of the read-mostly reader databases.
+
+DB_Voting.json and electricity_db.json are parsed in full by every reader
+process at start-up, although a tap only ever looks at one record.  This
+module compiles such a database into <database>.snap:
+
+    header      magic, key width, record count, source file size and mtime
+    key index   (key, record offset, record length) rows of fixed width,
+                sorted by key
+    value index one per TableSpec index column (meter ID, National ID):
+                (value, record number) rows sorted by value
+    records     one compact JSON object per record
+
+SnapshotTable maps the file and answers accounts[key], key in accounts and
+find(field, value) with a binary search over the fixed-width rows,
+decoding only the record that was hit.  Start-up is an open and an mmap
+whatever the size of the database, and reader processes on one host share
+the mapped pages.
+
+Records that were read are kept decoded, so journaled updates (a meter
+charge) apply to them in memory exactly as with the parsed JSON.  Their
+indexed fields are also kept in a value -> key dict, updated by every
+write, so find() answers from it before searching the mapped index and
+never scans the decoded records.  The
+snapshot is rebuilt when its source JSON has changed - on the first load
+after an edit, or right after JournaledStore compacts into a new JSON
+snapshot - so it never disagrees with the JSON file plus its journal.
+
+    python record_snapshot.py ../../data/DB_Voting.json ../../data/electricity_db.json
+"""
+import os  # Source file stat and atomic replacement
+import sys  # Command line arguments
+import json  # Record encoding
+import mmap  # Shared, lazily paged snapshot file
+import struct  # Fixed-width header and index rows
+from collections.abc import Mapping  # Dict interface of the table
+
+MAGIC = b'RSNP'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHIIIqq')  # magic, version, key width, records, indexes, meta length, source size, mtime
+_POSITION = struct.Struct('<II')  # record offset and length, or record number (+ unused)
+
+
+def snapshot_path(json_path):
+    return f"{json_path}.snap"
+
+
+def _source_stamp(json_path):
+    stat = os.stat(json_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _pad(text, width):
+    return text.encode('utf-8').ljust(width, b'\0')
+
+
+def build_snapshot(json_path, dataset, records=None):
+    """
+    Writes <json_path>.snap for the records of a flat dataset (default: read
+    from json_path).  The snapshot is stamped with json_path's size and
+    mtime, so pass records only when they match the file as written.
+    """
+    if dataset.root_key is not None:
+        raise ValueError("only datasets stored as one flat record table can be snapshotted")
+    if records is None:
+        with open(json_path, 'r') as f:
+            records = json.load(f)
+    keys = sorted(records, key=lambda key: key.encode('utf-8'))
+    key_width = max((len(key.encode('utf-8')) for key in keys), default=1)
+    blobs = [json.dumps(records[key], separators=(',', ':')).encode('utf-8') for key in keys]
+
+    indexes = []  # (JSON field, value width, sorted (value bytes, record number))
+    for json_field, column, _ in dataset.records.columns:
+        if column not in dataset.records.indexes:
+            continue
+        values = [(record_number, records[key].get(json_field)) for record_number, key in enumerate(keys)]
+        values = [(value, record_number) for record_number, value in values if isinstance(value, str)]
+        width = max((len(value.encode('utf-8')) for value, _ in values), default=1)
+        indexes.append((json_field, width, sorted((_pad(value, width), number) for value, number in values)))
+
+    meta = json.dumps({'indexes': [[json_field, width, len(rows)] for json_field, width, rows in indexes]}).encode()
+    size, mtime_ns = _source_stamp(json_path)
+    tmp_path = f"{snapshot_path(json_path)}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, key_width, len(keys), len(indexes), len(meta), size, mtime_ns))
+        f.write(meta)
+        offset = 0
+        for key, blob in zip(keys, blobs):
+            f.write(_pad(key, key_width) + _POSITION.pack(offset, len(blob)))
+            offset += len(blob)
+        for _, _, rows in indexes:
+            for value, record_number in rows:
+                f.write(value + _POSITION.pack(record_number, 0))
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, snapshot_path(json_path))
+    fsync_directory(json_path)  # Else a crash can bring back the old .snap next to a newer journal
+
+
+def fsync_directory(path):
+    """Makes a rename or file creation in path's directory durable (POSIX; a no-op elsewhere)."""
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _SortedRows:
+    """Fixed-width rows in the mapped file, sorted by their leading `width` bytes."""
+
+    def __init__(self, view, start, count, width):
+        self.view = view
+        self.start = start
+        self.count = count
+        self.width = width
+        self.row_size = width + _POSITION.size
+
+    def key_at(self, i):
+        position = self.start + i * self.row_size
+        return self.view[position:position + self.width]
+
+    def position_at(self, i):
+        return _POSITION.unpack_from(self.view, self.start + i * self.row_size + self.width)
+
+    def lower_bound(self, target):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def equal_range(self, target):
+        """Row numbers whose key equals target (padded to width)."""
+        if len(target) > self.width:
+            return range(0)
+        target = target.ljust(self.width, b'\0')
+        first = self.lower_bound(target)
+        last = first
+        while last < self.count and self.key_at(last) == target:
+            last += 1
+        return range(first, last)
+
+
+class _SnapshotRecord(dict):
+    """A decoded record; writing an indexed field keeps its table's value -> key dict in step."""
+
+    __slots__ = ('key', '_table')
+
+    def __setitem__(self, name, value):
+        if name in self._table._found:
+            self._table._reindex(self, name, value)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        if name in self._table._found:
+            self._table._reindex(self, name, None)
+        dict.__delitem__(self, name)
+
+
+class SnapshotTable(Mapping):
+    """Read-mostly record table over a mapped snapshot; see the module docstring."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, key_width, count, index_count, meta_length, self.source_size, self.source_mtime_ns = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"'{path}' is not a version {VERSION} record snapshot")
+        position = _HEADER.size
+        meta = json.loads(self._map[position:position + meta_length])
+        position += meta_length
+        self._keys = _SortedRows(self._map, position, count, key_width)
+        position += count * self._keys.row_size
+        self._indexes = {}
+        for json_field, width, rows in meta['indexes']:
+            self._indexes[json_field] = _SortedRows(self._map, position, rows, width)
+            position += rows * self._indexes[json_field].row_size
+        self._records_start = position
+        self._records = {}  # Records read so far (and new ones), kept decoded so updates apply to them
+        self._found = {json_field: {} for json_field in self._indexes}  # Indexed value -> key of those records
+
+    def _row_of(self, key):
+        if not isinstance(key, str):
+            return None
+        rows = self._keys.equal_range(key.encode('utf-8'))
+        return rows.start if rows else None
+
+    def _decode(self, row):
+        offset, length = self._keys.position_at(row)
+        start = self._records_start + offset
+        return json.loads(self._map[start:start + length])
+
+    def _adopt(self, key, fields):
+        record = _SnapshotRecord(fields)
+        record.key, record._table = key, self
+        return record
+
+    def _index(self, record):
+        for json_field, found in self._found.items():
+            value = record.get(json_field)
+            if isinstance(value, str):
+                found[value] = record.key
+
+    def _reindex(self, record, json_field, value):
+        found = self._found[json_field]
+        old = record.get(json_field)
+        if isinstance(old, str) and found.get(old) == record.key:
+            del found[old]
+        if isinstance(value, str):
+            found[value] = record.key
+
+    def _key_at(self, row):
+        return bytes(self._keys.key_at(row)).rstrip(b'\0').decode('utf-8')
+
+    def __getitem__(self, key):
+        record = self._records.get(key)
+        if record is not None:
+            return record
+        row = self._row_of(key)
+        if row is None:
+            raise KeyError(key)
+        record = self._records.setdefault(key, self._adopt(key, self._decode(row)))  # One record if two threads race
+        self._index(record)
+        return record
+
+    def __setitem__(self, key, fields):
+        previous = self._records.get(key)
+        if previous is not None:
+            for json_field in self._found:
+                self._reindex(previous, json_field, None)
+        record = self._records[key] = self._adopt(key, fields)
+        self._index(record)
+
+    def __contains__(self, key):
+        return key in self._records or self._row_of(key) is not None
+
+    def __iter__(self):
+        for row in range(self._keys.count):
+            yield self._key_at(row)
+        for key in list(self._records):
+            if self._row_of(key) is None:
+                yield key  # Added since the snapshot was built
+
+    def __len__(self):
+        return self._keys.count + sum(1 for key in list(self._records) if self._row_of(key) is None)
+
+    def find(self, json_field, value):
+        """
+        Returns the key of a record whose field equals value.  Indexed fields
+        are a dict lookup among the decoded records, then a binary search.
+        """
+        found = self._found.get(json_field)
+        if found is None or not isinstance(value, str):
+            for key, record in list(self._records.items()):
+                if record.get(json_field) == value:
+                    return key
+        else:
+            key = found.get(value)
+            if key is not None and self._records[key].get(json_field) == value:
+                return key
+        index = self._indexes.get(json_field)
+        if index is None or not isinstance(value, str):
+            candidates = range(self._keys.count)
+        else:
+            candidates = (index.position_at(i)[0] for i in index.equal_range(value.encode('utf-8')))
+        for row in candidates:
+            key = self._key_at(row)
+            if key not in self._records and self._decode(row).get(json_field) == value:
+                return key
+        return None
+
+    def to_json(self):
+        """All records as a dict (for the JSON snapshot); unread records are decoded without being kept."""
+        records = {}
+        for row in range(self._keys.count):
+            key = self._key_at(row)
+            record = self._records.get(key)
+            records[key] = record if record is not None else self._decode(row)
+        records.update(self._records)
+        return records
+
+    def close(self):
+        self._map.close()
+
+
+def open_snapshot(json_path, dataset):
+    """Maps <json_path>.snap, (re)building it first if it is missing or older than json_path."""
+    path = snapshot_path(json_path)
+    if os.path.exists(path):
+        table = SnapshotTable(path)
+        if (table.source_size, table.source_mtime_ns) == _source_stamp(json_path):
+            return table
+        table.close()
+    build_snapshot(json_path, dataset)
+    return SnapshotTable(path)
+
+
+def _dataset_for(json_path):
+    from sqlite_store import DATASETS  # Imported here: sqlite_store imports journal, which imports this module
+    name = os.path.basename(json_path)
+    for dataset in DATASETS.values():
+        if dataset.json_file == name:
+            return dataset
+    raise ValueError(f"no dataset is stored in '{name}'")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python record_snapshot.py <database.json> [<database.json> ...]")
+        sys.exit(1)
+    for json_path in sys.argv[1:]:
+        build_snapshot(json_path, _dataset_for(json_path))
+        print(f"{json_path} -> {snapshot_path(json_path)} ({os.path.getsize(snapshot_path(json_path))} bytes)")
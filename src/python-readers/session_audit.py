@@ -0,0 +1,205 @@
+"""
+Offline audit of recorded card sessions.
+
+A reader started with --capture (reader_daemon.py, multi_reader.py) appends
+one JSON line per tap: the card's public key, the ciphertext chunks exactly
+as read and the DER signature, all hex encoded, plus the live verdict.
+
+    {"ts": "...", "service": "transport", "card_id": "...", "public_key": "04...",
+     "chunks": ["...", "..."], "signature": "3045...", "ok": true}
+
+session_audit.py replays such logs through the same pipeline as a live
+session - der_to_concat_rs + DSS verification, then AES decryption and the
+JSON decode - on a process pool across all cores, and streams one JSON line
+per session, in input order:
+
+    python session_audit.py gate-*.jsonl -o audit.jsonl
+    python session_audit.py captures.jsonl --workers 8 --details
+
+status is ok, bad_signature, bad_payload (verified but does not decrypt
+and parse) or malformed (the capture line itself is broken).  A summary
+goes to stderr and the exit status is 1 if any session did not pass.
+"""
+import os  # CPU count for the default pool size
+import sys  # Result stream, summary and exit status
+import json  # Capture and result lines
+import time  # Audit throughput
+import argparse  # Command line options
+import threading  # CaptureLog is shared by the reader threads
+from collections import deque  # Batches in flight on the pool
+from datetime import datetime  # Timestamp of every capture
+from concurrent.futures import ProcessPoolExecutor  # Verification across cores
+from Crypto.PublicKey import ECC
+from reader_core import verify_data_signature, decrypt_card_data_batch
+
+
+class CaptureLog:
+    """
+    Capture sink for reader_core.capture_sessions that appends one JSON line
+    per session to path.  One log can be shared by every reader thread of a
+    process.
+    """
+
+    def __init__(self, path, service):
+        self.path = path
+        self.service = service
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def __call__(self, capture):
+        record = {'ts': datetime.now().isoformat(), 'service': self.service, 'card_id': capture['card_id'].hex(),
+                  'public_key': capture['public_key'].hex(), 'chunks': [chunk.hex() for chunk in capture['chunks']],
+                  'signature': capture['signature'].hex(), 'ok': capture['ok']}
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.written += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# --- Worker side (runs in the pool processes) ---
+_public_keys = {}  # Raw key hex -> imported key, so cache lookups see the same key object
+
+
+def _profile(service):
+    from reader_daemon import SERVICES  # Imported here: reader_daemon imports this module for CaptureLog
+    return SERVICES[service][0].PROFILE
+
+
+def _public_key(key_hex):
+    public_key = _public_keys.get(key_hex)
+    if public_key is None:
+        if len(_public_keys) >= 10000:
+            _public_keys.clear()
+        public_key = _public_keys[key_hex] = ECC.import_key(bytes.fromhex(key_hex), curve_name='P-256')
+    return public_key
+
+
+def audit_batch(batch, details=False):
+    """
+    Audits [(source, line number, capture line), ...] and returns one result
+    dict per line, in order.  The payloads that verified are decrypted per
+    service with a single cipher call.
+    """
+    results = []
+    verified = {}  # service -> [(result, ciphertext)]
+    for source, line_no, line in batch:
+        result = {'source': source, 'line': line_no}
+        results.append(result)
+        try:
+            capture = json.loads(line)
+            result.update(ts=capture.get('ts'), service=capture['service'], card_id=capture.get('card_id'),
+                          live_ok=capture.get('ok'))
+            _profile(capture['service'])  # An unknown service is a malformed capture
+            public_key = _public_key(capture['public_key'])
+            ciphertext = b''.join(bytes.fromhex(chunk) for chunk in capture['chunks'])
+            signature = bytes.fromhex(capture['signature'])
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            result.update(status='malformed', error=f"{type(e).__name__}: {e}")
+            continue
+
+        try:
+            verify_data_signature(public_key, ciphertext, signature)
+        except (ValueError, TypeError, IndexError) as e:
+            result.update(status='bad_signature', error=str(e))
+            continue
+        if len(ciphertext) % 16:
+            result.update(status='bad_payload', error=f"ciphertext length {len(ciphertext)} is not block aligned")
+            continue
+        verified.setdefault(capture['service'], []).append((result, ciphertext))
+
+    for service, entries in verified.items():
+        decoded = decrypt_card_data_batch(_profile(service), [ciphertext for _, ciphertext in entries])
+        for (result, _), card_details in zip(entries, decoded):
+            if card_details is None:
+                result.update(status='bad_payload', error="decrypted data is not a JSON object")
+            else:
+                result['status'] = 'ok'
+                if details:
+                    result['details'] = card_details
+    return results
+
+
+# --- Driver ---
+def read_captures(paths, batch_size):
+    """Yields batches of (source, line number, line) from the capture files ('-' reads stdin)."""
+    batch = []
+    for path in paths:
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        try:
+            for line_no, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                batch.append((path, line_no, line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+    if batch:
+        yield batch
+
+
+def audit_captures(batches, workers=None, details=False):
+    """
+    Yields the audit result of every capture in input order.  Batches are
+    verified on a pool of worker processes with at most two batches per
+    worker in flight, so memory stays flat however long the log is.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for batch in batches:
+            yield from audit_batch(batch, details)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(audit_batch, batch, details))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-verify recorded card sessions offline.")
+    parser.add_argument('captures', nargs='+', help="capture files written with --capture ('-' for stdin)")
+    parser.add_argument('-o', '--output', help="write the JSON-lines results here instead of stdout")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per core)")
+    parser.add_argument('--batch', type=int, default=256, help="sessions per work unit")
+    parser.add_argument('--details', action='store_true', help="include the decrypted card details")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    counts = {'ok': 0, 'bad_signature': 0, 'bad_payload': 0, 'malformed': 0}
+    disagreements = 0
+    started = time.perf_counter()
+    try:
+        for result in audit_captures(read_captures(args.captures, args.batch), args.workers, args.details):
+            counts[result['status']] += 1
+            if result.get('live_ok') is not None and result['live_ok'] != (result['status'] == 'ok'):
+                disagreements += 1
+            out.write(json.dumps(result, separators=(',', ':')) + "\n")
+    except OSError as e:
+        print(f" Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    print(f" Audited {total} sessions in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f}/s): "
+          + ", ".join(f"{count} {status}" for status, count in counts.items())
+          + f", {disagreements} disagree with the live reader", file=sys.stderr)
+    return 0 if counts['ok'] == total else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
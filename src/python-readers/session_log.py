@@ -0,0 +1,146 @@
+"""
+Leveled, structured logging for card sessions.
+
+The session engine (reader_core, async_session) and the reader daemon log
+through two loggers instead of printing:
+
+* reader.protocol - the steps of each session.  APDU and response hex
+  dumps are at TRACE, step banners and decrypted card fields at DEBUG,
+  failures at WARNING and ERROR.
+* reader.sessions - one INFO record per session: service, card ID,
+  result and duration.
+
+configure_logging(mode) selects what is shown and how:
+
+    console     every protocol line (TRACE) on stdout, exactly as the
+                readers used to print them.  The default.
+    quiet       warnings and errors only, as plain lines.
+    production  the per-session record plus warnings and errors as JSON
+                lines; no hex dumps and no card fields.
+
+In quiet and production mode records go through a QueueHandler and are
+written by a QueueListener thread, so a tap never waits on the console.
+Hex dumps are only formatted when TRACE is enabled.
+
+    configure_logging('production')
+"""
+import sys  # Console stream
+import json  # Production records
+import time  # Session durations
+import queue  # Hand-off to the listener thread
+import atexit  # Flush queued records at exit
+import logging  # Leveled loggers and handlers
+import logging.handlers  # QueueHandler / QueueListener
+from datetime import datetime  # Record timestamps
+from card_transport import to_hex
+
+TRACE = 5  # Below DEBUG: APDU and response hex dumps
+logging.addLevelName(TRACE, 'TRACE')
+MODES = ('console', 'quiet', 'production')
+
+log = logging.getLogger('reader.protocol')
+session_log = logging.getLogger('reader.sessions')
+
+_listener = None
+
+
+class LazyHex:
+    """Formats APDU bytes as hex only when the record is actually written."""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return to_hex(self.data)
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    """Writes to the current sys.stdout, like print, so redirect_stdout still applies."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+    def flush(self):
+        pass  # Buffered like print; a terminal's stdout is line buffered anyway
+
+
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per record; structured records carry their fields in record.fields."""
+
+    def format(self, record):
+        entry = {'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'level': record.levelname.lower()}
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        else:
+            entry['msg'] = record.getMessage().strip()
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+def configure_logging(mode='console', stream=None):
+    """Routes the reader loggers for the given mode (see the module docstring)."""
+    if mode not in MODES:
+        raise ValueError(f"unknown logging mode '{mode}' (expected one of {', '.join(MODES)})")
+    global _listener
+    stop_logging()
+    for logger in (log, session_log):
+        logger.handlers.clear()
+        logger.propagate = False
+
+    if mode == 'console':
+        handler = _ConsoleHandler() if stream is None else logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log.setLevel(TRACE)
+        session_log.setLevel(logging.WARNING)  # The step lines already tell the whole story
+        log.addHandler(handler)
+        return
+
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JsonFormatter() if mode == 'production' else logging.Formatter('%(message)s'))
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, target)
+    _listener.start()
+    handler = logging.handlers.QueueHandler(records)
+    log.setLevel(logging.WARNING)
+    session_log.setLevel(logging.INFO if mode == 'production' else logging.WARNING)
+    log.addHandler(handler)
+    session_log.addHandler(handler)
+
+
+def stop_logging():
+    """Writes out the queued records and stops the listener thread, if one is running."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def trace_apdu(description, apdu):
+    if log.isEnabledFor(TRACE):
+        log.log(TRACE, "▶ %s: %s", description, LazyHex(apdu))
+
+
+def trace_response(resp, sw1, sw2):
+    if log.isEnabledFor(TRACE):
+        log.log(TRACE, "   Response: %s, SW: %02X%02X", LazyHex(resp), sw1, sw2)
+
+
+def log_session(profile, card_id, result, started):
+    """Emits the compact per-session record; result is 'ok' or the step that failed."""
+    if session_log.isEnabledFor(logging.INFO):
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 3)
+        session_log.info("%s session %s in %.1f ms", profile.name, result, elapsed_ms,
+                         extra={'fields': {'event': 'session', 'service': profile.name,
+                                           'card_id': bytes(card_id).hex() if card_id else None,
+                                           'result': result, 'ms': elapsed_ms}})
+
+
+configure_logging('console')
+atexit.register(stop_logging)
@@ -0,0 +1,493 @@
+"""
+Hash-partitioned journal store for the large account databases.
+
+user_account.json and transport_db.json keep every customer in one
+document with one journal, so the taps of every reader process queue on
+the same lock and the same fsync.  ShardedStore splits the records by SIN
+into N shards, <database>.shard<i>of<N>.json, each a JournaledStore with
+its own journal, lock and group commit:
+
+    shard = crc32(SIN) % N      (stable across processes and runs, unlike hash())
+
+load() returns the database in its original shape: accounts[sin] and
+db["users"][sin] are routed to the owning shard by a ShardedTable, and
+transport's stations and fares stay in shard 0.  A transaction touching
+one shard commits on that shard alone, so taps on different shards never
+wait for each other.
+
+A transaction spanning shards (a bank transfer between customers in two
+shards) locks its shards in index order, checks them all for conflicts,
+appends its parts with the seq each will get to the intent log
+<database>.shards<N>.xlog, fsyncs it, and only then commits the parts.
+If a process dies half-way, the next commit on an affected shard - or the
+next load - finds the intent and commits the missing part, so a transfer
+is never kept half done.  Every `compact_every` intents, and on compact(),
+the shards are locked and resolved and an empty intent log replaces the
+old one, so it stays short however many transfers are made.
+
+The shards are split from the original JSON file and its journal the
+first time the store is loaded, or beforehand with:
+
+    python sharded_store.py ../../data/user_account.json bank 4
+
+The split writes the manifest <database>.json.shards with the shard count
+and seals the original file's journal (JournaledStore.seal), so a process
+still using it gets JournalError instead of a ledger of its own.  From
+then on the database opens only with that count: storage.open_store and
+load() raise JournalError for any other, including 1.  To change the
+count, stop every reader and run the command above with the new one; it
+re-shards from the current shards (1 merges them back into the JSON file)
+and seals the files it leaves.
+"""
+import os  # Shard file names, intent log replacement
+import sys  # Command line arguments
+import json  # Intent log records
+import zlib  # crc32: shard of a key
+import threading  # Guards the intents read so far
+from contextlib import ExitStack, contextmanager  # Several shards locked as one
+from collections.abc import Mapping  # Dict interface of the routed views
+from journal import JournaledStore, JournalError, TransactionContext, write_snapshot, fsync_directory, same_file
+from account_store import to_json  # Records inside intent ops
+
+try:
+    import fcntl  # Cross-process intent log lock
+except ImportError:  # Windows: no lock, one process per store (as with JournaledStore)
+    fcntl = None
+
+
+def shard_of(key, count):
+    """Index of the shard holding a record key."""
+    return zlib.crc32(str(key).encode('utf-8')) % count
+
+
+def shard_paths(json_path, count):
+    root, ext = os.path.splitext(json_path)
+    return [f"{root}.shard{index}of{count}{ext}" for index in range(count)]
+
+
+def partition(data, dataset, count):
+    """Splits a database in its JSON shape into `count` shard documents; other top-level values go to shard 0."""
+    records = data if dataset.root_key is None else data[dataset.root_key]
+    parts = [{} for _ in range(count)]
+    for key, record in records.items():
+        parts[shard_of(key, count)][key] = record
+    if dataset.root_key is None:
+        return parts
+    shards = [{dataset.root_key: part} for part in parts]
+    shards[0] = {name: parts[0] if name == dataset.root_key else value for name, value in data.items()}
+    return shards
+
+
+def manifest_path(json_path):
+    return f"{json_path}.shards"
+
+
+def shard_count(json_path):
+    """Shard count recorded in json_path's manifest; None while the database is not split."""
+    try:
+        with open(manifest_path(json_path)) as f:
+            return json.load(f)["shards"]
+    except FileNotFoundError:
+        return None
+
+
+def check_shard_count(json_path, count):
+    """Raises JournalError if json_path is split, but not into `count` shards (1: opened unsharded)."""
+    current = shard_count(json_path)
+    if current is not None and current != count:
+        raise JournalError(f"{json_path} is split into {current} shards, not {count}: set READER_DB_SHARDS={current}, "
+                           f"or stop every reader and run python sharded_store.py {json_path} <dataset> {count}")
+
+
+def _write_shards(json_path, documents, indent=None):
+    """Writes one shard file per document with an empty journal, and an empty intent log."""
+    count = len(documents)
+    for path, document in zip(shard_paths(json_path, count), documents):
+        write_snapshot(path, document, indent)
+        _empty(f"{path}.journal")  # A journal left by an earlier layout with this count is sealed and stale
+    _empty(f"{os.path.splitext(json_path)[0]}.shards{count}.xlog")
+
+
+def _empty(path):
+    tmp_path = f"{path}.tmp"
+    open(tmp_path, 'wb').close()
+    os.replace(tmp_path, path)
+    fsync_directory(path)
+
+
+def split_database(json_path, dataset, count, indent=None):
+    """
+    Writes the shard files of json_path unless it is split already; returns
+    True if it did.  Its journal is sealed before the shards are written,
+    and the manifest, written last, marks a complete split.
+    """
+    source = JournaledStore(json_path, indent=indent)
+    try:
+        with source.exclusive():  # One process splits; the others find the manifest afterwards
+            if shard_count(json_path) is not None:
+                check_shard_count(json_path, count)
+                return False
+            documents = partition(source.load(), dataset, count)
+            source.seal(f"{json_path} is split into {count} shards: set READER_DB_SHARDS={count}")
+            _write_shards(json_path, documents, indent)
+            write_snapshot(manifest_path(json_path), {"shards": count})
+            return True
+    finally:
+        source.close()
+
+
+def reshard(json_path, dataset, count, indent=None):
+    """
+    Moves a database to `count` shards, or back into json_path for 1, and
+    seals the shards it leaves; returns False if it has that count already.
+    Every reader must be stopped first, and started with the new count.
+    """
+    current = shard_count(json_path)
+    if current is None:
+        return count > 1 and split_database(json_path, dataset, count, indent)
+    if current == count:
+        return False
+    source = JournaledStore(json_path, indent=indent)
+    old = ShardedStore(json_path, dataset, current, indent)
+    try:
+        with source.exclusive(), old.exclusive():  # The split's lock first, as split_database takes it
+            old.load_shards()
+            records = {}
+            for shard in old.shards:
+                records.update(shard.data if dataset.root_key is None else shard.data[dataset.root_key])
+            document = records
+            if dataset.root_key is not None:
+                document = {name: records if name == dataset.root_key else value
+                            for name, value in old.shards[0].data.items()}
+            reason = (f"{json_path} is split into {count} shards: set READER_DB_SHARDS={count}" if count > 1 else
+                      f"{json_path} is no longer sharded: unset READER_DB_SHARDS")
+            for shard in old.shards:
+                shard.seal(reason)
+            if count > 1:
+                _write_shards(json_path, partition(document, dataset, count), indent)
+                write_snapshot(manifest_path(json_path), {"shards": count})
+            else:
+                write_snapshot(json_path, document, indent)
+                _empty(source.journal_path)  # Drops the seal and the changes from before the split
+                os.remove(manifest_path(json_path))
+                fsync_directory(json_path)
+            return True
+    finally:
+        old.close()
+        source.close()
+
+
+class ShardedTable(Mapping):
+    """The record table of a sharded database; every key is looked up in its own shard only."""
+
+    def __init__(self, shards, root_key=None):
+        self.shards = shards
+        self.root_key = root_key
+
+    def _table(self, shard):
+        return shard.data if self.root_key is None else shard.data[self.root_key]
+
+    def _owner(self, key):
+        return self._table(self.shards[shard_of(key, len(self.shards))])
+
+    def __getitem__(self, key):
+        return self._owner(key)[key]
+
+    def __contains__(self, key):
+        return key in self._owner(key)
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from self._table(shard)
+
+    def __len__(self):
+        return sum(len(self._table(shard)) for shard in self.shards)
+
+    def find(self, json_field, value):
+        """Returns the key of a record whose field equals value (asks every shard's index)."""
+        for shard in self.shards:
+            key = self._table(shard).find(json_field, value)
+            if key is not None:
+                return key
+        return None
+
+
+class _ShardedRoot(Mapping):
+    """Top level of a sharded database with a root key: the sharded records and shard 0's other values."""
+
+    def __init__(self, records, first_shard, root_key):
+        self.records = records
+        self.first_shard = first_shard
+        self.root_key = root_key
+
+    def __getitem__(self, name):
+        return self.records if name == self.root_key else self.first_shard.data[name]
+
+    def __iter__(self):
+        return iter(self.first_shard.data)
+
+    def __len__(self):
+        return len(self.first_shard.data)
+
+
+class ShardedStore:
+    """JournaledStore interface over hash-partitioned JournaledStores (see the module docstring)."""
+
+    def __init__(self, json_path, dataset, shards, indent=None, group_commit_delay=0.0, compact_every=1000):
+        self.json_path = json_path
+        self.dataset = dataset
+        self.indent = indent
+        self.name = os.path.basename(json_path)
+        self.shards = [JournaledStore(path, indent=indent, dataset=dataset, group_commit_delay=group_commit_delay,
+                                      compact_every=compact_every) for path in shard_paths(json_path, shards)]
+        self.compact_every = compact_every  # Intents logged before the intent log is replaced (0 disables)
+        self.intent_path = f"{os.path.splitext(json_path)[0]}.shards{shards}.xlog"
+        self.data = None
+        self.writer = None  # db_writer.DatabaseWriter when several readers share this store
+        self.cross_shard_commits = 0
+        self._intents = []  # Intent log records ({shard: [seq, ops]}) not yet seen complete on every shard
+        self._intent_lock = threading.Lock()
+        self._intent_reader = None
+        self._intent_count = 0  # Intents in the current intent log
+        self._intent_lock_file = None
+        self._deferred = threading.local()
+
+    # --- Loading ---
+    def load(self):
+        """Splits the database on first use, loads every shard and finishes interrupted cross-shard commits."""
+        split_database(self.json_path, self.dataset, len(self.shards), self.indent)
+        self.load_shards()
+        records = ShardedTable(self.shards, self.dataset.root_key)
+        self.data = records if self.dataset.root_key is None else _ShardedRoot(records, self.shards[0],
+                                                                               self.dataset.root_key)
+        return self.data
+
+    def load_shards(self):
+        """Loads every shard of a split database and finishes interrupted cross-shard commits."""
+        for index, shard in enumerate(self.shards):
+            shard.load()
+            with shard.exclusive():
+                self._resolve(index)
+
+    def refresh(self):
+        for shard in self.shards:
+            shard.refresh()
+
+    # --- Writing ---
+    def transaction(self):
+        """Same contract as JournaledStore.transaction(), also when the changes span shards."""
+        return TransactionContext(self)
+
+    @contextmanager
+    def optimistic(self):
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.optimistic())
+            yield
+
+    @contextmanager
+    def exclusive(self):
+        """Holds every shard's locks, taken in index order as commit() takes them."""
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.exclusive())
+            yield
+
+    def read_version(self):
+        return [shard.read_version() for shard in self.shards]
+
+    def commit(self, ops, read_version=None):
+        """Commits ops on the shards owning their records, atomically across shards; returns when durable."""
+        if not ops:
+            return
+        if self.data is None:
+            raise JournalError("load() must be called before committing")
+        parts = {}
+        for op in ops:
+            parts.setdefault(self._shard_of_path(op[1]), []).append(op)
+        versions = read_version or [None] * len(self.shards)
+        with ExitStack() as stack:
+            for index in sorted(parts):  # Always in index order, so two cross-shard commits cannot deadlock
+                stack.enter_context(self.shards[index].exclusive())
+                stack.enter_context(self.shards[index].deferred_sync())
+            for index in sorted(parts):
+                self._resolve(index)
+            if len(parts) > 1:
+                intent = {str(index): [self.shards[index].prepare(part, versions[index]), part]
+                          for index, part in parts.items()}  # Raises ConflictError before anything is written
+                self._log_intent(intent)
+                versions = [None] * len(self.shards)  # Checked above, with every shard locked
+                self.cross_shard_commits += 1
+            for index in sorted(parts):
+                self.shards[index].commit(parts[index], versions[index])
+            seqs = {index: self.shards[index].seq for index in parts}
+        if not getattr(self._deferred, 'active', False):
+            for index, seq in seqs.items():
+                self.shards[index].sync(seq)
+        if len(parts) > 1 and self.compact_every and self._intent_count >= self.compact_every:
+            self._rotate_intents()
+
+    @property
+    def seq(self):
+        return [shard.seq for shard in self.shards]
+
+    @contextmanager
+    def deferred_sync(self):
+        previous = getattr(self._deferred, 'active', False)
+        self._deferred.active = True
+        try:
+            yield
+        finally:
+            self._deferred.active = previous
+
+    def sync(self, seq=None):
+        """Blocks until every shard is on disk up to its entry in seq (default: everything so far)."""
+        for shard, shard_seq in zip(self.shards, seq or [None] * len(self.shards)):
+            shard.sync(shard_seq)
+
+    @property
+    def commits(self):
+        return sum(shard.commits for shard in self.shards)
+
+    @property
+    def syncs(self):
+        return sum(shard.syncs for shard in self.shards)
+
+    @property
+    def conflicts(self):
+        return sum(shard.conflicts for shard in self.shards)
+
+    def _shard_of_path(self, path):
+        if self.dataset.root_key is not None:
+            return shard_of(path[1], len(self.shards)) if path[0] == self.dataset.root_key else 0
+        return shard_of(path[0], len(self.shards))
+
+    # --- Intent log ---
+    def _resolve(self, index):
+        """Inside shards[index].exclusive(): commits that shard's part of any interrupted cross-shard commit."""
+        shard = self.shards[index]
+        shard.refresh()
+        with self._intent_lock:
+            self._read_intents()
+            pending = [intent for intent in self._intents if str(index) in intent]
+        for intent in pending:
+            seq, ops = intent[str(index)]
+            if shard.seq == seq - 1:
+                shard.commit(ops)  # Its writer died between the intent and this part
+            elif shard.seq < seq - 1:
+                raise JournalError(f"shard {index} of '{self.name}' lacks transactions before intent seq {seq}")
+            with self._intent_lock:
+                intent.pop(str(index), None)
+                self._intents = [intent for intent in self._intents if intent]
+
+    def _read_intents(self):
+        while True:
+            if self._intent_reader is None:
+                if not os.path.exists(self.intent_path):
+                    return
+                self._intent_reader = open(self.intent_path, 'rb')
+            while True:
+                position = self._intent_reader.tell()
+                line = self._intent_reader.readline()
+                if not line.endswith(b"\n"):  # End, or an intent still being written
+                    self._intent_reader.seek(position)
+                    break
+                self._intent_count += 1
+                try:
+                    self._intents.append(json.loads(line))
+                except ValueError:
+                    pass  # Torn by a crash before its fsync: none of its parts was committed
+            if same_file(self._intent_reader, self.intent_path):
+                return
+            self._intent_reader = None  # Replaced by a compaction after every intent completed
+            self._intent_count = 0
+
+    def _log_intent(self, intent):
+        line = (json.dumps(intent, separators=(',', ':'), default=to_json) + "\n").encode('utf-8')
+        with self._intent_lock, self._intent_file_lock():
+            self._read_intents()
+            created = not os.path.exists(self.intent_path)
+            with open(self.intent_path, 'ab') as f:
+                if self._intent_reader is not None and f.tell() > self._intent_reader.tell():
+                    f.truncate(self._intent_reader.tell())  # Torn tail of a crashed writer
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            if created:
+                fsync_directory(self.intent_path)
+            if self._intent_reader is None:
+                self._intent_reader = open(self.intent_path, 'rb')
+            self._intent_reader.seek(0, os.SEEK_END)  # Our own intent completes before the shard locks are released
+            self._intent_count += 1
+
+    @contextmanager
+    def _intent_file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        if self._intent_lock_file is None:
+            self._intent_lock_file = open(f"{self.intent_path}.lock", 'ab')
+        fcntl.flock(self._intent_lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._intent_lock_file.fileno(), fcntl.LOCK_UN)
+
+    # --- Maintenance ---
+    def compact(self, data=None):
+        """Compacts every shard (splitting data first if a whole database is given) and empties the intent log."""
+        documents = [None] * len(self.shards)
+        if data is not None and data is not self.data:
+            documents = partition(data, self.dataset, len(self.shards))
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.exclusive())
+            for index, (shard, document) in enumerate(zip(self.shards, documents)):
+                self._resolve(index)
+                shard.compact(document)
+            self._empty_intent_log()
+
+    def _rotate_intents(self):
+        """Resolves every shard and starts an empty intent log (called holding no shard lock)."""
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.exclusive())
+            for index in range(len(self.shards)):
+                self._resolve(index)
+            self._empty_intent_log()
+
+    def _empty_intent_log(self):
+        """Holding every shard's lock, after _resolve on each: every intent is complete on every shard."""
+        with self._intent_lock, self._intent_file_lock():
+            tmp_path = f"{self.intent_path}.tmp"
+            open(tmp_path, 'wb').close()
+            os.replace(tmp_path, self.intent_path)
+            fsync_directory(self.intent_path)
+            self._intents = []
+            if self._intent_reader is not None:
+                self._intent_reader.close()
+            self._intent_reader = open(self.intent_path, 'rb')
+            self._intent_count = 0
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        for name in ('_intent_reader', '_intent_lock_file'):
+            f = getattr(self, name)
+            if f is not None:
+                f.close()
+                setattr(self, name, None)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Usage: python sharded_store.py <database.json> <bank|transport|...> <shard count>")
+        sys.exit(1)
+    from sqlite_store import DATASETS  # Only the command line needs the dataset names
+    json_path, dataset_name, count = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    if not reshard(json_path, DATASETS[dataset_name], count):
+        print(f"{json_path} is already split into {count} shards." if count > 1 else f"{json_path} is not sharded.")
+    elif count > 1:
+        print(f"{json_path} -> {', '.join(shard_paths(json_path, count))}")
+    else:
+        print(f"Shards merged back into {json_path}.")
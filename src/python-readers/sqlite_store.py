@@ -0,0 +1,567 @@
+"""
+SQLite storage backend for the reader databases.
+
+The JSON databases are parsed in full at start-up and kept in memory.
+SqliteStore serves the same lookups from an indexed SQLite file instead:
+load() returns lightweight mapping views (accounts[sin], sin in accounts,
+db["users"][sin], database[voter_id], ...) that fetch one row per lookup,
+so start-up time and memory no longer grow with the number of customers.
+Writes use the same transaction() API as journal.JournaledStore.
+
+Several reader processes can share the file.  Rows handed out are cached,
+so optimistic() first drops the cache if PRAGMA data_version shows that
+another connection has committed, and commit() compares the rows it
+writes with the database inside its write transaction: if another
+process changed one of them since it was read, the commit is rolled back
+with journal.ConflictError and db_writer.run_update re-runs the update.
+data_version does not change for the store's own connection, so threads
+of one process are checked as in JournaledStore: every commit records the
+seq it gave each row it wrote, and a commit raises ConflictError if one
+of its rows got a newer seq after its optimistic() block began.
+
+Commits follow the journal's group commit contract.  A commit returns
+once it is durable (synchronous=FULL fsyncs the WAL on COMMIT).  Inside
+deferred_sync() it is committed with synchronous=NORMAL, which writes the
+WAL without an fsync, and sync(seq) then fsyncs the WAL once for every
+commit made so far; threads waiting meanwhile share the next fsync.  An
+fsync of the WAL is what synchronous=FULL itself does at COMMIT.  As in
+JournaledStore, a failed fsync is kept in sync_failure and every later
+commit raises JournalError until load() is called again.
+
+One-shot import of the existing JSON files:
+    python sqlite_store.py ../../data ../../data/reader_data.sqlite
+"""
+import os  # Existence checks before connecting
+import sys  # Command line arguments for the importer
+import time  # Commit latency
+import json  # Extra fields and history entries are stored as JSON text
+import sqlite3  # Standard library SQLite driver
+import threading  # One connection shared by all sessions of a reader process
+from contextlib import contextmanager  # deferred_sync, optimistic
+from collections.abc import Mapping  # Read-only dict interface of the table views
+from dataclasses import dataclass, field  # Table descriptions
+from journal import TransactionContext, ConflictError, JournalError, apply_op, apply_static_op  # Shared transaction API
+import metrics  # reader_db_commit_seconds
+
+
+@dataclass(frozen=True)
+class TableSpec:
+    """How one JSON collection maps onto a SQLite table."""
+    table: str  # Table holding one row per record
+    key_column: str  # Primary key (the JSON object key: SIN or VoterID)
+    columns: tuple  # (JSON field, column, SQL type) stored as typed columns
+    indexes: tuple = ()  # Columns with a secondary index
+    history_table: str = None  # Table holding the record's 'history' list, if any
+
+
+@dataclass(frozen=True)
+class Dataset:
+    """A service database: one record table plus optional small static values."""
+    records: TableSpec
+    root_key: str = None  # JSON key the records live under (transport: "users")
+    static_keys: tuple = field(default=())  # Small top-level values kept as JSON (stations, fares)
+    json_file: str = None  # Source file for the importer
+
+
+DATASETS = {
+    "bank": Dataset(
+        records=TableSpec("bank_accounts", "sin",
+                          (("account_holder", "account_holder", "TEXT"), ("balance", "balance", "REAL")),
+                          history_table="bank_history"),
+        json_file="user_account.json"),
+    "electricity": Dataset(
+        records=TableSpec("meter_accounts", "sin",
+                          (("owner_name", "owner_name", "TEXT"), ("authorized_meter", "meter_id", "TEXT"),
+                           ("balance", "balance", "REAL")),
+                          indexes=("meter_id",)),
+        json_file="electricity_db.json"),
+    "voting": Dataset(
+        records=TableSpec("voters", "voter_id",
+                          (("National ID", "national_id", "TEXT"),),
+                          indexes=("national_id",)),
+        json_file="DB_Voting.json"),
+    "transport": Dataset(
+        records=TableSpec("transit_users", "sin",
+                          (("name", "name", "TEXT"), ("balance", "balance", "REAL")),
+                          history_table="transit_history"),
+        root_key="users", static_keys=("stations", "fares"),
+        json_file="transport_db.json"),
+}
+
+
+def connect(path):
+    """
+    Opens the database in WAL mode so readers never block the writer, with
+    the WAL fsynced on every commit (NORMAL would only sync at checkpoints,
+    so a power loss could drop committed balance updates).
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")  # Durable on COMMIT, like a journal append followed by its fsync
+    return conn
+
+
+def create_schema(conn, dataset):
+    spec = dataset.records
+    columns = "".join(f", {column} {sql_type}" for _, column, sql_type in spec.columns)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {spec.table} "
+                 f"({spec.key_column} TEXT PRIMARY KEY{columns}, extra TEXT NOT NULL DEFAULT '{{}}')")
+    for column in spec.indexes:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{spec.table}_{column} ON {spec.table}({column})")
+    if spec.history_table:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {spec.history_table} "
+                     f"(owner TEXT NOT NULL, seq INTEGER NOT NULL, entry TEXT NOT NULL, PRIMARY KEY (owner, seq))")
+    conn.execute("CREATE TABLE IF NOT EXISTS static_values "
+                 "(dataset TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (dataset, name))")
+
+
+def _split_record(spec, record):
+    """Splits a JSON record into (typed column values, extra JSON, history list)."""
+    extra = dict(record)
+    history = extra.pop("history", None) if spec.history_table else None
+    values = [extra.pop(json_field, None) for json_field, _, _ in spec.columns]
+    return values, json.dumps(extra), history
+
+
+def import_dataset(conn, name, data):
+    """Loads one parsed JSON database into its tables (replacing existing rows)."""
+    dataset = DATASETS[name]
+    spec = dataset.records
+    create_schema(conn, dataset)
+    records = data[dataset.root_key] if dataset.root_key else data
+    column_names = ", ".join(column for _, column, _ in spec.columns)
+    placeholders = ", ".join("?" * (len(spec.columns) + 2))
+    conn.execute("BEGIN")
+    try:
+        for key, record in records.items():
+            values, extra, history = _split_record(spec, record)
+            conn.execute(f"INSERT OR REPLACE INTO {spec.table} ({spec.key_column}, {column_names}, extra) "
+                         f"VALUES ({placeholders})", [key, *values, extra])
+            if spec.history_table:
+                conn.execute(f"DELETE FROM {spec.history_table} WHERE owner = ?", (key,))
+                conn.executemany(f"INSERT INTO {spec.history_table} (owner, seq, entry) VALUES (?, ?, ?)",
+                                 [(key, seq, json.dumps(entry)) for seq, entry in enumerate(history or [])])
+        for static_key in dataset.static_keys:
+            conn.execute("INSERT OR REPLACE INTO static_values (dataset, name, value) VALUES (?, ?, ?)",
+                         (name, static_key, json.dumps(data.get(static_key))))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(records)
+
+
+def import_json_files(data_dir, sqlite_path):
+    """Imports every known JSON database found in data_dir; returns {dataset: rows}."""
+    conn = connect(sqlite_path)
+    imported = {}
+    try:
+        for name, dataset in DATASETS.items():
+            json_path = os.path.join(data_dir, dataset.json_file)
+            if not os.path.exists(json_path):
+                continue
+            with open(json_path, 'r') as f:
+                imported[name] = import_dataset(conn, name, json.load(f))
+    finally:
+        conn.close()
+    return imported
+
+
+class RecordView(Mapping):
+    """Dict-like, lazily loaded view of one record table."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getitem__(self, key):
+        return self._store.get_record(key)
+
+    def __contains__(self, key):
+        return self._store.has_record(key)
+
+    def __iter__(self):
+        return iter(self._store.record_keys())
+
+    def __len__(self):
+        return self._store.record_count()
+
+    def find(self, json_field, value):
+        """Returns the key of the first record whose field equals value (uses the column index)."""
+        return self._store.find_key(json_field, value)
+
+
+class SqliteStore:
+    """Store with the JournaledStore interface, backed by SQLite tables."""
+
+    def __init__(self, sqlite_path, dataset_name, row_cache_size=4096, group_commit_delay=0.0):
+        self.sqlite_path = sqlite_path
+        self.wal_path = f"{sqlite_path}-wal"
+        self.group_commit_delay = group_commit_delay  # Seconds a sync leader waits for more commits to join
+        self.name = dataset_name
+        self.dataset = DATASETS[dataset_name]
+        self.spec = self.dataset.records
+        self.row_cache_size = row_cache_size
+        self.conn = None
+        self.data = None
+        self.writer = None  # db_writer.DatabaseWriter when several readers share this store
+        self.seq = 0  # Commits made through this store; sync(seq) waits for the first seq of them
+        self.commits = 0  # Transactions committed
+        self.syncs = 0  # WAL fsyncs that made them durable; commits / syncs is the mean group size
+        self.conflicts = 0  # Commits rolled back because a row changed under them
+        self.row_versions = {}  # Row key -> seq of this store's last commit that changed it
+        self.sync_failure = None  # Error of a failed WAL fsync: commits raise until load()
+        self._rows = {}  # Records handed out this run; kept in step with committed updates
+        self._data_version = None  # PRAGMA data_version when the cached rows were last known current
+        self._lock = threading.RLock()
+        self._synchronous = "FULL"  # The connection's current PRAGMA synchronous (see connect)
+        self._exclusive = False  # Inside exclusive(): commits are savepoints of its transaction
+        self._sync_state = threading.Condition()
+        self._synced_seq = 0  # Highest seq known to be on disk
+        self._syncing = False  # A thread is fsyncing on behalf of the group
+        self._deferred = threading.local()
+        self._optimistic = threading.local()
+        self._fields = {json_field: column for json_field, column, _ in self.spec.columns}
+
+    # --- Loading ---
+    def load(self):
+        """Connects and returns the root view (same shape as the JSON database)."""
+        if not os.path.exists(self.sqlite_path):
+            raise FileNotFoundError(f"SQLite database '{self.sqlite_path}' not found (run the importer first)")
+        self.conn = connect(self.sqlite_path)
+        self.sync_failure = None
+        self._rows.clear()
+        self._data_version = self._current_data_version()
+        records = RecordView(self)
+        if self.dataset.root_key is None:
+            self.data = records
+            return self.data
+        self.data = {self.dataset.root_key: records}
+        for name, value in self.conn.execute("SELECT name, value FROM static_values WHERE dataset = ?", (self.name,)):
+            self.data[name] = json.loads(value)
+        return self.data
+
+    def get_record(self, key):
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                return row
+            column_names = ", ".join(column for _, column, _ in self.spec.columns)
+            result = self.conn.execute(f"SELECT {column_names}, extra FROM {self.spec.table} "
+                                       f"WHERE {self.spec.key_column} = ?", (key,)).fetchone()
+            if result is None:
+                raise KeyError(key)
+            row = json.loads(result[-1])
+            for (json_field, _, _), value in zip(self.spec.columns, result):
+                row[json_field] = value
+            if self.spec.history_table:
+                row["history"] = [json.loads(entry) for (entry,) in self.conn.execute(
+                    f"SELECT entry FROM {self.spec.history_table} WHERE owner = ? ORDER BY seq", (key,))]
+            if len(self._rows) >= self.row_cache_size:
+                self._rows.pop(next(iter(self._rows)))
+            self._rows[key] = row
+            return row
+
+    def has_record(self, key):
+        if not isinstance(key, str):
+            return False
+        with self._lock:
+            return key in self._rows or self.conn.execute(
+                f"SELECT 1 FROM {self.spec.table} WHERE {self.spec.key_column} = ?", (key,)).fetchone() is not None
+
+    def record_keys(self):
+        with self._lock:
+            return [key for (key,) in self.conn.execute(f"SELECT {self.spec.key_column} FROM {self.spec.table}")]
+
+    def record_count(self):
+        with self._lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {self.spec.table}").fetchone()[0]
+
+    def find_key(self, json_field, value):
+        column = self._fields[json_field]
+        with self._lock:
+            result = self.conn.execute(f"SELECT {self.spec.key_column} FROM {self.spec.table} "
+                                       f"WHERE {column} = ? LIMIT 1", (value,)).fetchone()
+        return result[0] if result else None
+
+    # --- Writing ---
+    def transaction(self):
+        """Same contract as JournaledStore.transaction(): all ops commit together or not at all."""
+        return TransactionContext(self)
+
+    def read_version(self):
+        """Version a transaction starting now has read: the optimistic block's start, else the current seq."""
+        base = getattr(self._optimistic, 'base', None)
+        return self.seq if base is None else base
+
+    def refresh(self):
+        """Drops the cached rows if another connection has committed since they were read."""
+        with self._lock:
+            version = self._current_data_version()
+            if version != self._data_version:
+                self._rows.clear()
+                self._data_version = version
+
+    @contextmanager
+    def optimistic(self):
+        """Same contract as JournaledStore.optimistic()."""
+        with self._lock:
+            self.refresh()
+            self._optimistic.base = self.seq
+        try:
+            yield
+        finally:
+            self._optimistic.base = None
+
+    def commit(self, ops, read_version=None):
+        """
+        Applies journal-style ops as one SQLite transaction, then to the cached
+        rows; returns when they are durable, or inside deferred_sync() once
+        they are committed.  Raises ConflictError if another process changed
+        a written row after it was cached, or another thread committed it
+        after read_version.
+        """
+        if not ops:
+            return
+        deferred = getattr(self._deferred, 'active', False)
+        with self._lock:
+            start = time.perf_counter()
+            if self.sync_failure is not None:
+                raise JournalError(f"an fsync of {self.wal_path} failed ({self.sync_failure}): load() it before committing")
+            if read_version is not None and any(
+                    self.row_versions.get(self._row_key(op[1]), 0) > read_version for op in ops):
+                self.conflicts += 1
+                metrics.db_conflicts.inc(self.name)
+                raise ConflictError("a row of this transaction was changed by another reader")
+            nested = self._exclusive
+            if nested:
+                self.conn.execute("SAVEPOINT tx")
+            else:
+                self._set_synchronous(deferred)
+                self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = self._current_data_version()
+                if version != self._data_version:
+                    self._check_rows(ops)
+                    self._data_version = version
+                for op in ops:
+                    self._apply_sql(op)
+                self.conn.execute("RELEASE tx" if nested else "COMMIT")
+            except Exception:
+                if nested:
+                    self.conn.execute("ROLLBACK TO tx")
+                    self.conn.execute("RELEASE tx")
+                else:
+                    self.conn.execute("ROLLBACK")
+                raise
+            metrics.db_commit_seconds.observe(time.perf_counter() - start, self.name, 'commit')
+            for op in ops:
+                self._apply_cached(op)
+            self.commits += 1
+            self.seq += 1
+            seq = self.seq
+            for op in ops:
+                self.row_versions[self._row_key(op[1])] = seq
+        if not deferred and not nested:
+            self._synced(seq)  # The COMMIT's fsync also covered every deferred commit before it
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Holds SQLite's write lock (BEGIN IMMEDIATE) for the whole block, so
+        nothing it reads can be changed by another process before it
+        commits; commits inside the block are savepoints of that transaction.
+        """
+        deferred = getattr(self._deferred, 'active', False)
+        with self._lock:
+            self._set_synchronous(deferred)
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._exclusive = True
+            try:
+                yield
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                self._rows.clear()  # They may hold a savepoint's changes that were just rolled back
+                raise
+            finally:
+                self._exclusive = False
+            seq = self.seq
+        if not deferred:
+            self._synced(seq)
+
+    def _set_synchronous(self, deferred):
+        synchronous = "NORMAL" if deferred else "FULL"
+        if synchronous != self._synchronous:
+            self.conn.execute(f"PRAGMA synchronous={synchronous}")
+            self._synchronous = synchronous
+
+    def _synced(self, seq):
+        with self._sync_state:
+            self._synced_seq = max(self._synced_seq, seq)
+            self._sync_state.notify_all()
+
+    def _current_data_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _check_rows(self, ops):
+        """Another connection has committed: keeps the cached rows ops write if they are unchanged, drops the rest."""
+        keys = {key for key in (self._record_path(op[1])[0] for op in ops) if key is not None}
+        column_names = ", ".join(column for _, column, _ in self.spec.columns)
+        for key in keys:
+            cached = self._rows.get(key)
+            if cached is None:
+                continue  # Not read through this store, so nothing was decided on a stale value
+            result = self.conn.execute(f"SELECT {column_names} FROM {self.spec.table} "
+                                       f"WHERE {self.spec.key_column} = ?", (key,)).fetchone()
+            current = None if result is None else dict(zip([json_field for json_field, _, _ in self.spec.columns],
+                                                            result))
+            stale = current is None or any(cached.get(name) != value for name, value in current.items())
+            if not stale and self.spec.history_table:
+                count = self.conn.execute(f"SELECT COUNT(*) FROM {self.spec.history_table} WHERE owner = ?",
+                                          (key,)).fetchone()[0]
+                stale = count != len(cached.get("history", []))
+            if stale:
+                self._rows.clear()
+                self.conflicts += 1
+                metrics.db_conflicts.inc(self.name)
+                raise ConflictError(f"record '{key}' was changed by another reader")
+        self._rows = {key: row for key, row in self._rows.items() if key in keys}
+
+    @contextmanager
+    def deferred_sync(self):
+        """Commits made by this thread inside the block return before their fsync; call sync() afterwards."""
+        previous = getattr(self._deferred, 'active', False)
+        self._deferred.active = True
+        try:
+            yield
+        finally:
+            self._deferred.active = previous
+
+    def sync(self, seq=None):
+        """
+        Blocks until this store's commits are on disk up to seq (default:
+        all so far).  One waiting thread fsyncs the WAL for the whole group,
+        as JournaledStore.sync does for the journal.
+        """
+        seq = self.seq if seq is None else seq
+        with self._sync_state:
+            while self._synced_seq < seq:
+                if self.sync_failure is not None:
+                    raise JournalError(f"an fsync of {self.wal_path} failed ({self.sync_failure})")
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._sync_state.wait()
+            else:
+                return
+        synced = None
+        try:
+            if self.group_commit_delay:
+                time.sleep(self.group_commit_delay)  # Lets commits arriving within the window join this fsync
+            with self._lock:
+                target = self.seq  # Every commit up to here has written its WAL frames
+            start = time.perf_counter()
+            self._fsync_wal()
+            metrics.db_commit_seconds.observe(time.perf_counter() - start, self.name, 'sync')
+            metrics.db_syncs.inc(self.name)
+            synced = target
+        except OSError as e:
+            with self._lock:
+                self.sync_failure = e
+                self._rows.clear()  # May hold changes the WAL lost
+            raise
+        finally:
+            with self._sync_state:
+                self._syncing = False
+                if synced is not None:
+                    self.syncs += 1
+                    self._synced_seq = max(self._synced_seq, synced)
+                self._sync_state.notify_all()  # Waiters see sync_failure and raise
+
+    def _fsync_wal(self):
+        try:
+            fd = os.open(self.wal_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return  # Checkpointed and removed by SQLite, which syncs the database first
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _row_key(self, path):
+        key, _ = self._record_path(path)
+        return (None, path[0]) if key is None else key  # Static values (stations, fares) are one row each
+
+    def _record_path(self, path):
+        """Strips the root key: returns (record key, field path) or (None, path) for static values."""
+        if self.dataset.root_key is not None:
+            if path[0] != self.dataset.root_key:
+                return None, path
+            path = path[1:]
+        return path[0], path[1:]
+
+    def _apply_sql(self, op):
+        kind, path = op[0], op[1]
+        key, field_path = self._record_path(path)
+        if key is None:  # Static top-level value (stations, fares)
+            value = json.loads(self.conn.execute("SELECT value FROM static_values WHERE dataset = ? AND name = ?",
+                                                 (self.name, path[0])).fetchone()[0])
+            holder = {path[0]: value}
+            apply_op(holder, op)
+            self.conn.execute("UPDATE static_values SET value = ? WHERE dataset = ? AND name = ?",
+                              (json.dumps(holder[path[0]]), self.name, path[0]))
+            return
+        if kind == "insert" and field_path == ["history"]:
+            self.conn.execute(f"INSERT OR REPLACE INTO {self.spec.history_table} (owner, seq, entry) VALUES (?, ?, ?)",
+                              (key, op[2], json.dumps(op[3])))
+        elif kind == "set" and not field_path:  # Whole record (new account)
+            values, extra, history = _split_record(self.spec, op[2])
+            column_names = ", ".join(column for _, column, _ in self.spec.columns)
+            placeholders = ", ".join("?" * (len(self.spec.columns) + 2))
+            self.conn.execute(f"INSERT OR REPLACE INTO {self.spec.table} ({self.spec.key_column}, {column_names}, extra) "
+                              f"VALUES ({placeholders})", [key, *values, extra])
+            if self.spec.history_table:
+                self._replace_history(key, history or [])
+        elif kind == "set" and len(field_path) == 1 and field_path[0] in self._fields:
+            self.conn.execute(f"UPDATE {self.spec.table} SET {self._fields[field_path[0]]} = ? "
+                              f"WHERE {self.spec.key_column} = ?", (op[2], key))
+        elif kind == "set" and field_path == ["history"] and self.spec.history_table:
+            self._replace_history(key, op[2])
+        elif kind == "set" and len(field_path) == 1:
+            extra = json.loads(self.conn.execute(f"SELECT extra FROM {self.spec.table} WHERE {self.spec.key_column} = ?",
+                                                 (key,)).fetchone()[0])
+            extra[field_path[0]] = op[2]
+            self.conn.execute(f"UPDATE {self.spec.table} SET extra = ? WHERE {self.spec.key_column} = ?",
+                              (json.dumps(extra), key))
+        else:
+            raise ValueError(f"unsupported storage operation {kind} {path}")
+
+    def _replace_history(self, key, entries):
+        self.conn.execute(f"DELETE FROM {self.spec.history_table} WHERE owner = ?", (key,))
+        self.conn.executemany(f"INSERT INTO {self.spec.history_table} (owner, seq, entry) VALUES (?, ?, ?)",
+                              [(key, seq, json.dumps(entry)) for seq, entry in enumerate(entries)])
+
+    def _apply_cached(self, op):
+        key, field_path = self._record_path(op[1])
+        if key is None:
+            apply_static_op(self.data, op)
+        elif not field_path:
+            self._rows.pop(key, None)  # Reloaded on next access
+        elif key in self._rows:
+            apply_op(self._rows[key], [op[0], field_path, *op[2:]])
+
+    def compact(self, data=None):
+        """Nothing to compact: every commit is already in place (WAL is checkpointed by SQLite)."""
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python sqlite_store.py <json data dir> <sqlite file>")
+        sys.exit(1)
+    for dataset_name, rows in import_json_files(sys.argv[1], sys.argv[2]).items():
+        print(f" Imported {rows} {dataset_name} records into '{sys.argv[2]}'.")
@@ -0,0 +1,49 @@
+"""
+Selects the storage backend behind the reader databases.
+
+Every backend exposes the same interface: load() returns the database in the
+shape of the original JSON file, and transaction() / commit(ops) apply
+changes.  The backend is chosen with the READER_DB_BACKEND environment
+variable:
+
+    journal  JSON snapshot + append-only journal, records held in memory in
+             indexed slotted tables (default, see journal.py, account_store.py)
+    sqlite   indexed SQLite file, READER_SQLITE_DB (default 'reader_data.sqlite')
+
+READER_GROUP_COMMIT_MS (default 0) makes each group commit
+wait that many milliseconds for more taps to share its fsync.
+
+READER_DB_SHARDS (journal backend, default 1) splits the account databases
+by SIN into that many shards with their own journals and locks, see
+sharded_store.py.  Mapped, read-mostly databases are never sharded.  Once
+a database is split, it must be opened with the same count (JournalError
+otherwise); sharded_store.py changes it.
+"""
+import os  # Environment variables selecting the backend
+from journal import JournaledStore
+from sharded_store import ShardedStore, check_shard_count
+from sqlite_store import SqliteStore, DATASETS
+
+DEFAULT_SQLITE_DB_FILE = 'reader_data.sqlite'
+
+
+def open_store(json_path, dataset, indent=None, mapped=False):
+    """
+    Returns the configured store for one service database.  mapped=True
+    (journal backend only) maps a binary snapshot of a read-mostly database
+    instead of parsing the JSON, see record_snapshot.py.
+    """
+    backend = os.environ.get('READER_DB_BACKEND', 'journal')
+    delay = float(os.environ.get('READER_GROUP_COMMIT_MS', '0')) / 1000
+    if backend == 'journal':
+        shards = int(os.environ.get('READER_DB_SHARDS', '1'))
+        if not mapped:
+            check_shard_count(json_path, shards)  # Opening a split database with another count splits its ledger
+        if shards > 1 and not mapped:
+            return ShardedStore(json_path, DATASETS[dataset], shards, indent=indent, group_commit_delay=delay)
+        return JournaledStore(json_path, indent=indent, dataset=DATASETS[dataset], mapped=mapped,
+                              group_commit_delay=delay)
+    if backend == 'sqlite':
+        return SqliteStore(os.environ.get('READER_SQLITE_DB', DEFAULT_SQLITE_DB_FILE), dataset,
+                           group_commit_delay=delay)
+    raise ValueError(f"Unknown READER_DB_BACKEND '{backend}'")
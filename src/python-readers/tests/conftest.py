@@ -0,0 +1,11 @@
+"""
+Tests for the Python readers.  The reader modules import each other by
+name, so their directory goes on sys.path as when a reader is started
+from it:
+
+    cd src/python-readers && python -m pytest -q tests
+"""
+import os  # Reader directory relative to this file
+import sys  # Module search path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
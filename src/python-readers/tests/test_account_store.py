@@ -0,0 +1,37 @@
+"""
+History rows pack the type and shape as 16-bit codes: running out of them
+must keep entries as they are, never make a commit or a replay fail.
+"""
+import json
+import account_store
+from account_store import History, _Interner
+from journal import JournaledStore
+from sqlite_store import DATASETS
+
+SIN = "1001"
+
+
+def test_many_references_leave_type_codes_small(monkeypatch):
+    monkeypatch.setattr(account_store, '_strings', _Interner(None, *(f"S{i}" for i in range(70000))))
+    history = History([{"type": "refund", "amount": 1.0, "timestamp": "2024-01-01T10:00:00", "from": "S69999"}])
+    assert history._raw is None  # Packed: the type got its code from the types, not from 70000 SINs
+    assert history[0]['from'] == "S69999"
+
+
+def test_type_codes_past_16_bits_are_kept_as_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(account_store, '_types', _Interner(*range(account_store._MAX_SMALL_CODE + 1)))
+    entry = {"type": "chargeback", "amount": 2.5, "timestamp": "2024-01-01T10:00:00"}
+    history = History([entry])
+    assert history._raw == {0: entry}
+    assert history.to_json() == [entry]
+
+    json_path = tmp_path / 'user_account.json'
+    json_path.write_text(json.dumps({SIN: {"account_holder": "Holder", "balance": 10.0, "history": []}}))
+    store = JournaledStore(str(json_path), dataset=DATASETS['bank'])
+    store.load()
+    with store.transaction() as tx:
+        tx.append([SIN, "history"], entry)
+    store.close()
+    reopened = JournaledStore(str(json_path), dataset=DATASETS['bank'])
+    assert list(reopened.load()[SIN]['history']) == [entry]  # Replayed from the journal
+    reopened.close()
@@ -0,0 +1,60 @@
+"""
+async_session drives reader_core's own session steps: the same APDUs, the
+same read size fallback and the same capture_sessions records as a
+synchronous session, also with many sessions on one event loop.
+"""
+import asyncio
+import pytest
+import reader_core
+import async_session
+from reader_core import capture_sessions, verify_data_signature
+from card_emulator import EmulatedCard, CARD_ID
+from crypto_cache import PublicKeyCache
+from transport_reader import PROFILE
+
+
+@pytest.fixture(autouse=True)
+def fresh_read_sizes(monkeypatch):
+    monkeypatch.setattr(reader_core, '_read_size_steps', {})
+
+
+def _session(mode, card):
+    if mode == 'sync':
+        return reader_core.run_card_session(card, PROFILE, key_cache=PublicKeyCache())
+    return asyncio.run(async_session.run_card_session(card, PROFILE, key_cache=PublicKeyCache()))
+
+
+def test_async_session_matches_sync_session():
+    results = {}
+    for mode in ('sync', 'async'):
+        reader_core._read_size_steps.clear()
+        card = EmulatedCard(services=['transport'])  # Rejects extended-length reads with 67 00
+        results[mode] = _session(mode, card), card.apdu_count
+    assert results['sync'] == results['async']
+    assert results['async'][0]['SIN']
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_session_is_captured(mode):
+    card = EmulatedCard(services=['transport'])
+    captures = []
+    with capture_sessions(captures.append):
+        assert _session(mode, card)
+    assert len(captures) == 1 and captures[0]['ok']
+    verify_data_signature(card.public_key('transport'), b''.join(captures[0]['chunks']), captures[0]['signature'])
+    assert list(reader_core._read_size_steps.values()) == [2]  # Fell back past both extended-length sizes
+
+
+def test_concurrent_async_sessions_are_captured_apart():
+    cards = [EmulatedCard(services=['transport'], card_id=CARD_ID[:12] + i.to_bytes(4, 'big')) for i in range(4)]
+    captures = []
+
+    async def tap_all():
+        with capture_sessions(captures.append):
+            return await asyncio.gather(*(async_session.run_card_session(card, PROFILE, key_cache=PublicKeyCache())
+                                          for card in cards))
+
+    assert all(asyncio.run(tap_all()))
+    assert sorted(capture['card_id'] for capture in captures) == sorted(card.card_id for card in cards)
+    for capture, card in zip(sorted(captures, key=lambda c: c['card_id']), sorted(cards, key=lambda c: c.card_id)):
+        verify_data_signature(card.public_key('transport'), b''.join(capture['chunks']), capture['signature'])
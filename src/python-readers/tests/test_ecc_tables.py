@@ -0,0 +1,180 @@
+"""
+ecc_tables.verify answers ahead of pycryptodome's DSS for hot keys, so it
+must accept and reject exactly the signatures DSS does.
+"""
+import pytest
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS
+import ecc_tables
+from ecc_tables import CombTable, N
+
+KEY_D = 0xC9AFA9D845BA75166B5C215767B1D6934E50C3DB36E89B127B8A622B120F6721
+OTHER_D = 0x519B423D715F8B581F4FA8EE59F4771A5B44C8130B4E3EACCA54A56DDA72B464
+
+
+class _Digest:
+    """A precomputed SHA-256 digest in the hash-object shape DSS expects (any 32 bytes, not just real hashes)."""
+
+    oid = SHA256.new().oid
+    digest_size = 32
+
+    def __init__(self, value):
+        self.value = value
+
+    def digest(self):
+        return self.value
+
+
+def _point(d):
+    """(x, y) of d * G."""
+    q = ECC.construct(curve='P-256', d=d).pointQ
+    return int(q.x), int(q.y)
+
+
+def _sign(d, e, k):
+    """Raw r||s of the ECDSA signature with private key d and nonce k over the digest integer e."""
+    r = _point(k)[0] % N
+    s = pow(k, -1, N) * (e + r * d) % N
+    return r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+
+
+def _rs(r, s):
+    return r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+
+
+def _dss_accepts(d, digest, signature_rs):
+    x, y = _point(d)
+    try:
+        DSS.new(ECC.construct(curve='P-256', point_x=x, point_y=y), 'fips-186-3').verify(_Digest(digest), signature_rs)
+        return True
+    except ValueError:
+        return False
+
+
+@pytest.fixture(scope='module')
+def tables():
+    return {d: CombTable(*_point(d)) for d in (KEY_D, OTHER_D)}
+
+
+def _check(tables, d, digest, signature_rs, expected):
+    assert _dss_accepts(d, digest, signature_rs) is expected
+    assert ecc_tables.verify(tables[d], digest, signature_rs) is expected
+
+
+@pytest.mark.parametrize('message', [b'', b'card payload', bytes(range(256)) * 4])
+def test_accepts_pycryptodome_signatures(tables, message):
+    key = ECC.construct(curve='P-256', d=KEY_D)
+    hash_obj = SHA256.new(message)
+    signature = DSS.new(key, 'fips-186-3').sign(hash_obj)
+    _check(tables, KEY_D, hash_obj.digest(), signature, True)
+
+
+@pytest.mark.parametrize('window', [4, 5, 8])
+def test_table_window_does_not_change_the_result(window):
+    digest = SHA256.new(b'window').digest()
+    signature = _sign(KEY_D, int.from_bytes(digest, 'big'), 0x1234567)
+    assert ecc_tables.verify(CombTable(*_point(KEY_D), window=window), digest, signature)
+
+
+@pytest.mark.parametrize('tamper', ['digest', 'r', 's'])
+def test_rejects_tampered_signatures(tables, tamper):
+    digest = SHA256.new(b'balance 100.00').digest()
+    signature = bytearray(_sign(KEY_D, int.from_bytes(digest, 'big'), 0xA5A5A5A5))
+    if tamper == 'digest':
+        digest = bytes([digest[0] ^ 0x01]) + digest[1:]
+    else:
+        signature[0 if tamper == 'r' else 63] ^= 0x01
+    _check(tables, KEY_D, digest, bytes(signature), False)
+
+
+def test_rejects_signature_under_another_key(tables):
+    digest = SHA256.new(b'payload').digest()
+    signature = _sign(KEY_D, int.from_bytes(digest, 'big'), 0xBEEF)
+    _check(tables, KEY_D, digest, signature, True)
+    _check(tables, OTHER_D, digest, signature, False)
+
+
+@pytest.mark.parametrize('r, s', [(0, 1), (1, 0), (0, 0), (N, 1), (1, N), (N + 1, 1), (1, 2 ** 256 - 1)])
+def test_rejects_r_or_s_out_of_range(tables, r, s):
+    _check(tables, KEY_D, SHA256.new(b'range').digest(), _rs(r, s), False)
+
+
+def test_rejects_r_or_s_reduced_by_n(tables):
+    digest = SHA256.new(b'reduced').digest()
+    signature = _sign(KEY_D, int.from_bytes(digest, 'big'), 0x77)
+    r, s = int.from_bytes(signature[:32], 'big'), int.from_bytes(signature[32:], 'big')
+    if s + N < 2 ** 256:
+        _check(tables, KEY_D, digest, _rs(r, s + N), False)
+    if r + N < 2 ** 256:
+        _check(tables, KEY_D, digest, _rs(r + N, s), False)
+
+
+def test_accepts_negated_s(tables):
+    digest = SHA256.new(b'malleable').digest()
+    signature = _sign(KEY_D, int.from_bytes(digest, 'big'), 0xC0FFEE)
+    r, s = int.from_bytes(signature[:32], 'big'), int.from_bytes(signature[32:], 'big')
+    _check(tables, KEY_D, digest, _rs(r, N - s), True)  # ECDSA has no low-s rule, in either verifier
+
+
+@pytest.mark.parametrize('e', [0, N])
+def test_u1_zero(tables, e):
+    """A digest that is 0 mod n makes u1 = 0: the result is u2 * Q alone."""
+    digest = e.to_bytes(32, 'big')
+    signature = _sign(KEY_D, e, 0x31337)
+    _check(tables, KEY_D, digest, signature, True)
+    _check(tables, KEY_D, digest, _rs(int.from_bytes(signature[:32], 'big'), 1), False)
+
+
+def test_rejects_sum_at_infinity(tables):
+    """e = -r*d mod n makes u1*G + u2*Q the point at infinity, which has no x to compare with r."""
+    r = 0x1D1D1D
+    digest = (-r * KEY_D % N).to_bytes(32, 'big')
+    for s in (1, 2, N - 1):
+        _check(tables, KEY_D, digest, _rs(r, s), False)
+
+
+def test_rejects_r_matching_infinity_coordinates(tables):
+    """With the sum at infinity, r equal to the Jacobian placeholder X = 1 must not slip through."""
+    r = 1
+    digest = (-r * KEY_D % N).to_bytes(32, 'big')
+    _check(tables, KEY_D, digest, _rs(r, 5), False)
+
+
+def test_u1_g_equal_to_u2_q(tables):
+    """e = r*d makes u1*G and u2*Q the same point, so the sum is its double."""
+    r = 0x2468
+    digest = (r * KEY_D % N).to_bytes(32, 'big')
+    for s in (1, 3, 0xABCDEF):
+        expected = _point(2 * r * KEY_D * pow(s, -1, N) % N)[0] % N == r
+        _check(tables, KEY_D, digest, _rs(r, s), expected)
+
+
+def _affine(point):
+    x, y, z = point
+    z_inv = pow(z, -1, ecc_tables.P)
+    return x * z_inv * z_inv % ecc_tables.P, y * z_inv ** 3 % ecc_tables.P
+
+
+def test_mixed_addition_special_cases():
+    g = _point(1)
+    assert ecc_tables._add_affine(ecc_tables.INFINITY, g) == (g[0], g[1], 1)
+    assert _affine(ecc_tables._add_affine((g[0], g[1], 1), g)) == _point(2)  # P + P doubles
+    assert ecc_tables._add_affine((g[0], g[1], 1), (g[0], ecc_tables.P - g[1]))[2] == 0  # P + (-P) is infinity
+    assert _affine(ecc_tables._add_affine((*_point(5), 1), _point(7))) == _point(12)
+
+
+def test_reader_core_uses_the_table_for_hot_keys(monkeypatch):
+    import reader_core
+    from crypto_cache import VerificationCache, VerificationTableCache
+    tables = VerificationTableCache(build_after=1)
+    monkeypatch.setattr(reader_core, 'verification_tables', tables)
+    key = ECC.construct(curve='P-256', d=KEY_D)
+    hash_obj = SHA256.new(b'encrypted card data')
+    signature = DSS.new(key, 'fips-186-3', encoding='der').sign(hash_obj)
+    reader_core.verify_digest_signature(key.public_key(), hash_obj, signature, cache=VerificationCache())
+    assert tables.builds == 1
+    with pytest.raises(ValueError):
+        reader_core.verify_digest_signature(key.public_key(), SHA256.new(b'forged card data'), signature,
+                                            cache=VerificationCache())
+    assert tables.hits == 1
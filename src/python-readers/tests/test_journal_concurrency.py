@@ -0,0 +1,225 @@
+"""
+Several reader processes sharing one store: optimistic updates through
+db_writer.run_update must never lose a tap, and a process that missed
+compactions must catch up from the new snapshot.
+"""
+import os
+import json
+import time
+import threading
+import multiprocessing
+import pytest
+import journal
+import db_writer
+from datetime import datetime
+from db_writer import DatabaseWriter, run_update
+from journal import JournaledStore, ConflictError, JournalError
+from sharded_store import ShardedStore
+from sqlite_store import DATASETS, SqliteStore, connect, import_dataset
+
+pytestmark = pytest.mark.skipif(journal.fcntl is None, reason="cross-process journal lock needs fcntl")
+
+BANK = DATASETS['bank']
+SIN = "1001"
+START_BALANCE = 10000.0
+
+
+def _accounts():
+    return {SIN: {"account_holder": "Shared", "balance": START_BALANCE, "history": []},
+            "2002": {"account_holder": "Other", "balance": 50.0, "history": []}}
+
+
+@pytest.fixture(params=['journal', 'sharded', 'sqlite'])
+def database(request, tmp_path):
+    json_path = tmp_path / 'user_account.json'
+    json_path.write_text(json.dumps(_accounts()))
+    if request.param == 'sqlite':
+        conn = connect(str(tmp_path / 'reader_data.sqlite'))
+        import_dataset(conn, 'bank', _accounts())
+        conn.close()
+    return request.param, tmp_path
+
+
+def _open(backend, directory, compact_every=7):
+    if backend == 'sqlite':
+        return SqliteStore(str(directory / 'reader_data.sqlite'), 'bank')
+    if backend == 'sharded':
+        return ShardedStore(str(directory / 'user_account.json'), BANK, 3)
+    return JournaledStore(str(directory / 'user_account.json'), dataset=BANK, compact_every=compact_every)
+
+
+def _withdraw(store, sin, amount):
+    balance = store.data[sin]['balance']
+    with store.transaction() as tx:
+        tx.set([sin, 'balance'], balance - amount)
+        tx.append([sin, 'history'], {"type": "withdrawal", "amount": amount, "timestamp": datetime.now().isoformat()})
+    return balance - amount
+
+
+def _race(backend, directory, taps, threads, start):
+    store = _open(backend, directory)
+    store.load()
+    if threads > 1:
+        store.writer = DatabaseWriter()  # As multi_reader.py: deferred commits, shared fsyncs
+    start.wait()
+    workers = [threading.Thread(target=lambda: [run_update(store, _withdraw, store, SIN, 1.0) for _ in range(taps)])
+               for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if store.writer is not None:
+        store.writer.close()
+    store.close()
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_processes_racing_on_one_account_lose_no_update(database, threads):
+    backend, directory = database
+    processes, taps = 4, 40
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(processes)
+    workers = [context.Process(target=_race, args=(backend, directory, taps, threads, start)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(120)
+        assert worker.exitcode == 0
+
+    store = _open(backend, directory)
+    accounts = store.load()
+    total = processes * threads * taps
+    assert accounts[SIN]['balance'] == START_BALANCE - total
+    assert len(accounts[SIN]['history']) == total
+    assert accounts["2002"]['balance'] == 50.0
+    store.close()
+
+
+def _slow_withdraw(store, sin, amount):
+    balance = store.data[sin]['balance']
+    time.sleep(0.001)  # Other threads commit meanwhile, against the same cached record
+    with store.transaction() as tx:
+        tx.set([sin, 'balance'], balance - amount)
+    return balance - amount
+
+
+def test_threads_of_one_process_lose_no_update(database):
+    """Inline run_update from several threads (async_session, or no DatabaseWriter) on one store."""
+    backend, directory = database
+    store = _open(backend, directory)
+    store.load()
+    threads, taps = 4, 50
+    workers = [threading.Thread(target=lambda: [run_update(store, _slow_withdraw, store, SIN, 1.0)
+                                                for _ in range(taps)]) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert store.data[SIN]['balance'] == START_BALANCE - threads * taps
+    store.close()
+    assert _open(backend, directory).load()[SIN]['balance'] == START_BALANCE - threads * taps
+
+
+def test_stale_transaction_raises_conflict(database):
+    backend, directory = database
+    first, second = _open(backend, directory), _open(backend, directory)
+    first.load()
+    second.load()
+    first.data[SIN]['balance']  # Cached by the first store, as a tap that read the balance
+    with pytest.raises(ConflictError):
+        with first.optimistic():
+            balance = first.data[SIN]['balance']
+            _withdraw(second, SIN, 5.0)  # Another terminal commits in between
+            with first.transaction() as tx:
+                tx.set([SIN, 'balance'], balance - 1.0)
+    assert run_update(first, _withdraw, first, SIN, 1.0) == START_BALANCE - 6.0
+    assert first.conflicts == 1
+    first.close()
+    second.close()
+
+
+def test_failed_fsync_stops_commits_until_reload(database, monkeypatch):
+    backend, directory = database
+    store = _open(backend, directory)
+    store.load()
+
+    def failing_fsync(fd):
+        raise OSError(5, "Input/output error")
+
+    monkeypatch.setattr(os, 'fsync', failing_fsync)
+    with store.deferred_sync():  # As under a DatabaseWriter: applied in memory, fsynced afterwards
+        _withdraw(store, SIN, 1.0)
+    with pytest.raises(OSError):
+        store.sync()
+    monkeypatch.undo()
+    with pytest.raises(JournalError):  # The disk works again, but memory may hold a tap it lost
+        _withdraw(store, SIN, 1.0)
+    store.load()
+    assert _withdraw(store, SIN, 1.0) == START_BALANCE - 2.0  # The page cache still held the first tap
+    store.close()
+
+
+def test_update_under_the_write_lock(database, monkeypatch):
+    """After OPTIMISTIC_ATTEMPTS conflicts the update holds store.exclusive(); here it goes there at once."""
+    monkeypatch.setattr(db_writer, 'OPTIMISTIC_ATTEMPTS', 0)
+    backend, directory = database
+    store, other = _open(backend, directory), _open(backend, directory)
+    store.load()
+    other.load()
+    assert run_update(store, _withdraw, store, SIN, 1.0) == START_BALANCE - 1.0
+    run_update(other, _withdraw, other, SIN, 2.0)
+    assert run_update(store, _withdraw, store, SIN, 4.0) == START_BALANCE - 7.0  # Read under the lock: no conflict
+
+    store.close()
+    other.close()
+
+
+@pytest.mark.parametrize('compactions', [1, 2, 3])
+def test_catch_up_across_compactions(tmp_path, compactions):
+    """A store holding the old journal open follows one compaction, and resyncs after several."""
+    (tmp_path / 'user_account.json').write_text(json.dumps(_accounts()))
+    reader, writer = _open('journal', tmp_path, compact_every=0), _open('journal', tmp_path, compact_every=0)
+    reader.load()
+    writer.load()
+    run_update(reader, _withdraw, reader, SIN, 1.0)  # The reader now has the journal open part-way
+    writer.refresh()
+    for _ in range(compactions):
+        run_update(writer, _withdraw, writer, SIN, 2.0)
+        run_update(writer, _withdraw, writer, "2002", 1.0)
+        writer.compact()
+    run_update(writer, _withdraw, writer, SIN, 4.0)  # After the last compaction: only in the new journal
+
+    expected = START_BALANCE - 1.0 - 2.0 * compactions - 4.0
+    reader.refresh()
+    assert reader.data[SIN]['balance'] == expected
+    assert reader.data["2002"]['balance'] == 50.0 - compactions
+    assert len(reader.data[SIN]['history']) == 2 + compactions
+    assert reader.seq == writer.seq
+
+    # A transaction the reader prepared before refreshing is stale
+    with pytest.raises(ConflictError):
+        reader.commit([["set", [SIN, "balance"], 0.0]], read_version=1)
+    assert run_update(reader, _withdraw, reader, SIN, 8.0) == expected - 8.0
+    writer.refresh()
+    assert writer.data[SIN]['balance'] == expected - 8.0
+    reader.close()
+    writer.close()
+
+
+def test_load_after_compaction_and_torn_tail(tmp_path):
+    (tmp_path / 'user_account.json').write_text(json.dumps(_accounts()))
+    store = _open('journal', tmp_path, compact_every=3)
+    store.load()
+    for _ in range(5):
+        run_update(store, _withdraw, store, SIN, 1.0)
+    store.close()
+    with open(tmp_path / 'user_account.json.journal', 'ab') as f:
+        f.write(b'{"seq": 6, "ops": [["set", ["1001", "bal')  # A crash in the middle of an append
+
+    reopened = _open('journal', tmp_path)
+    accounts = reopened.load()
+    assert accounts[SIN]['balance'] == START_BALANCE - 5.0
+    assert reopened.seq == 5
+    assert run_update(reopened, _withdraw, reopened, SIN, 1.0) == START_BALANCE - 6.0
+    reopened.close()
+    assert _open('journal', tmp_path).load()[SIN]['balance'] == START_BALANCE - 6.0
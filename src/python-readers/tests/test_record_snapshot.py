@@ -0,0 +1,66 @@
+"""SnapshotTable.find has to see the decoded records' current values, not the mapped ones."""
+import os
+import json
+import pytest
+import record_snapshot
+from record_snapshot import build_snapshot, open_snapshot, snapshot_path
+from sqlite_store import DATASETS
+
+ELECTRICITY = DATASETS['electricity']
+
+
+@pytest.fixture
+def table(tmp_path):
+    records = {f"{sin:04d}": {"owner_name": f"owner {sin}", "authorized_meter": f"M{sin:04d}", "balance": 100.0}
+               for sin in range(50)}
+    path = tmp_path / 'electricity_db.json'
+    path.write_text(json.dumps(records))
+    table = open_snapshot(str(path), ELECTRICITY)
+    yield table
+    table.close()
+
+
+def test_find_reads_the_mapped_index(table):
+    assert table.find("authorized_meter", "M0007") == "0007"
+    assert table.find("authorized_meter", "M9999") is None
+
+
+def test_find_follows_updates_to_decoded_records(table):
+    table["0007"]["balance"] = 50.0
+    assert table.find("authorized_meter", "M0007") == "0007"
+    table["0007"]["authorized_meter"] = "M7777"
+    assert table.find("authorized_meter", "M7777") == "0007"
+    assert table.find("authorized_meter", "M0007") is None  # The mapped row is stale once the record is decoded
+
+
+def test_find_follows_whole_record_writes(table):
+    table["0003"] = {"owner_name": "moved", "authorized_meter": "M3333", "balance": 0.0}
+    table["9000"] = {"owner_name": "new", "authorized_meter": "M9000", "balance": 0.0}
+    assert table.find("authorized_meter", "M3333") == "0003"
+    assert table.find("authorized_meter", "M0003") is None
+    assert table.find("authorized_meter", "M9000") == "9000"
+    table["9000"] = {"owner_name": "new", "authorized_meter": "M9001", "balance": 0.0}
+    assert table.find("authorized_meter", "M9000") is None
+    assert table.find("authorized_meter", "M9001") == "9000"
+
+
+def test_find_on_unindexed_fields(table):
+    table["0010"]["owner_name"] = "renamed"
+    assert table.find("owner_name", "renamed") == "0010"
+    assert table.find("owner_name", "owner 11") == "0011"
+    assert table.find("owner_name", "owner 10") is None
+
+
+def test_decoded_records_stay_json(table):
+    table["0001"]["balance"] = 1.5
+    assert json.loads(json.dumps(table.to_json()))["0001"]["balance"] == 1.5
+
+
+def test_build_syncs_the_directory_after_the_rename(tmp_path, monkeypatch):
+    path = str(tmp_path / 'electricity_db.json')
+    with open(path, 'w') as f:
+        json.dump({"0001": {"owner_name": "owner", "authorized_meter": "M0001", "balance": 1.0}}, f)
+    synced = []
+    monkeypatch.setattr(record_snapshot, 'fsync_directory', lambda p: synced.append(os.path.exists(snapshot_path(p))))
+    build_snapshot(path, ELECTRICITY)
+    assert synced == [True]
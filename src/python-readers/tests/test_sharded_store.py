@@ -0,0 +1,198 @@
+"""
+ShardedStore: a split database opens with its shard count only, re-sharding
+keeps every balance, and a transfer interrupted by a crash half-way through
+is completed (or dropped, if its intent never reached the disk) on reopening.
+"""
+import os
+import json
+import multiprocessing
+import pytest
+import journal
+import storage
+from journal import JournaledStore, JournalError
+from sharded_store import ShardedStore, reshard, shard_count, shard_of
+from sqlite_store import DATASETS
+
+BANK = DATASETS['bank']
+TRANSPORT = DATASETS['transport']
+
+
+def _accounts():
+    return {str(1000 + i): {"account_holder": f"Holder {i}", "balance": 100.0 * i, "history": []} for i in range(12)}
+
+
+def _balances(store):
+    return {sin: store.data[sin]['balance'] for sin in store.data}
+
+
+@pytest.fixture
+def bank(tmp_path):
+    json_path = tmp_path / 'user_account.json'
+    json_path.write_text(json.dumps(_accounts()))
+    return str(json_path)
+
+
+def test_split_seals_the_original_file(bank):
+    store = ShardedStore(bank, BANK, 3)
+    store.load()
+    assert shard_count(bank) == 3
+    with store.transaction() as tx:
+        tx.set(["1001", "balance"], 1.0)
+    store.close()
+
+    unsharded = JournaledStore(bank, dataset=BANK)
+    assert unsharded.load()["1001"]['balance'] == 100.0  # Readable, but no longer the database
+    with pytest.raises(JournalError):
+        with unsharded.transaction() as tx:
+            tx.set(["1001", "balance"], 2.0)
+    unsharded.close()
+    assert ShardedStore(bank, BANK, 3).load()["1001"]['balance'] == 1.0
+
+
+@pytest.mark.parametrize('shards', ['1', '2', '4'])
+def test_open_store_refuses_another_shard_count(bank, monkeypatch, shards):
+    ShardedStore(bank, BANK, 3).load()
+    monkeypatch.setenv('READER_DB_BACKEND', 'journal')
+    monkeypatch.setenv('READER_DB_SHARDS', shards)
+    with pytest.raises(JournalError):
+        storage.open_store(bank, 'bank')
+    with pytest.raises(JournalError):
+        ShardedStore(bank, BANK, int(shards)).load()
+    monkeypatch.setenv('READER_DB_SHARDS', '3')
+    assert isinstance(storage.open_store(bank, 'bank'), ShardedStore)
+
+
+def test_reshard_keeps_every_balance(bank):
+    store = ShardedStore(bank, BANK, 3)
+    store.load()
+    for sin in ("1001", "1005", "1010"):
+        with store.transaction() as tx:
+            tx.set([sin, "balance"], store.data[sin]['balance'] - 0.5)
+            tx.append([sin, "history"], {"type": "withdrawal", "amount": 0.5})
+    expected = _balances(store)
+
+    assert reshard(bank, BANK, 2)
+    with pytest.raises(JournalError):  # The running 3-shard process is stopped at its next commit
+        with store.transaction() as tx:
+            tx.set(["1001", "balance"], 0.0)
+    store.close()
+    assert shard_count(bank) == 2
+    resharded = ShardedStore(bank, BANK, 2)
+    resharded.load()
+    assert _balances(resharded) == expected
+    assert len(resharded.data["1005"]['history']) == 1
+    resharded.close()
+
+    assert reshard(bank, BANK, 1)
+    assert shard_count(bank) is None
+    merged = JournaledStore(bank, dataset=BANK)
+    merged.load()
+    assert _balances(merged) == expected
+    with merged.transaction() as tx:  # The seal of the first split is gone
+        tx.set(["1001", "balance"], 7.0)
+    merged.close()
+
+    assert reshard(bank, BANK, 3)  # Same count as the first layout: its sealed files are replaced
+    again = ShardedStore(bank, BANK, 3)
+    again.load()
+    assert again.data["1001"]['balance'] == 7.0
+    assert again.data["1010"]['balance'] == expected["1010"]
+    again.close()
+    assert not reshard(bank, BANK, 3)
+
+
+def test_reshard_transport_keeps_stations(tmp_path):
+    json_path = str(tmp_path / 'transport_db.json')
+    db = {"users": {str(1000 + i): {"name": f"User {i}", "balance": 10.0 * i} for i in range(8)},
+          "stations": ["North", "Central", "South"]}
+    with open(json_path, 'w') as f:
+        json.dump(db, f)
+    ShardedStore(json_path, TRANSPORT, 3).load()
+    assert reshard(json_path, TRANSPORT, 1)
+    merged = JournaledStore(json_path, dataset=TRANSPORT).load()
+    assert list(merged["stations"]) == db["stations"]
+    assert {sin: merged["users"][sin]['balance'] for sin in merged["users"]} == \
+        {sin: user["balance"] for sin, user in db["users"].items()}
+
+
+def _two_shards(store):
+    """Two SINs owned by different shards, the one in the lower shard first."""
+    by_shard = {}
+    for sin in sorted(store.data):
+        by_shard.setdefault(shard_of(sin, len(store.shards)), sin)
+    low, high = sorted(by_shard)[:2]
+    return by_shard[low], by_shard[high]
+
+
+def test_intent_log_stays_short(bank):
+    store, other = ShardedStore(bank, BANK, 3, compact_every=4), ShardedStore(bank, BANK, 3, compact_every=4)
+    store.load()
+    other.load()
+    payer, payee = _two_shards(store)
+    for tap in range(25):
+        writer = store if tap % 3 else other  # Intents of both stores share one log
+        writer.refresh()
+        with writer.transaction() as tx:
+            tx.set([payer, "balance"], writer.data[payer]['balance'] - 1.0)
+            tx.set([payee, "balance"], writer.data[payee]['balance'] + 1.0)
+        with open(store.intent_path, 'rb') as f:
+            assert len(f.readlines()) <= 4
+    store.close()
+    other.close()
+    reopened = ShardedStore(bank, BANK, 3)
+    reopened.load()
+    assert reopened.data[payer]['balance'] == _accounts()[payer]['balance'] - 25.0
+    assert reopened.data[payee]['balance'] == _accounts()[payee]['balance'] + 25.0
+    reopened.close()
+
+
+def _crashing_transfer(json_path, crash_at):
+    store = ShardedStore(json_path, BANK, 3)
+    store.load()
+    payer, payee = _two_shards(store)
+    if crash_at == 'intent':
+        def torn_intent(intent):  # Dies in the middle of the intent's write, before its fsync
+            with open(store.intent_path, 'ab') as f:
+                f.write(json.dumps(intent).encode('utf-8')[:20])
+            os._exit(1)
+        store._log_intent = torn_intent
+    else:
+        shard = store.shards[shard_of(payer if crash_at == 'first' else payee, 3)]
+        shard.commit = lambda *args, **kwargs: os._exit(1)
+    with store.transaction() as tx:
+        tx.set([payer, "balance"], store.data[payer]['balance'] - 25.0)
+        tx.set([payee, "balance"], store.data[payee]['balance'] + 25.0)
+    os._exit(0)  # Not reached
+
+
+@pytest.mark.skipif(journal.fcntl is None, reason="needs fork")
+@pytest.mark.parametrize('crash_at', ['intent', 'first', 'second'])
+def test_transfer_interrupted_by_a_crash(bank, crash_at):
+    """Killed after the intent: reopening commits the missing parts.  Killed before it: nothing was committed."""
+    store = ShardedStore(bank, BANK, 3)
+    store.load()
+    payer, payee = _two_shards(store)
+    before = _balances(store)
+    store.close()
+
+    child = multiprocessing.get_context('fork').Process(target=_crashing_transfer, args=(bank, crash_at))
+    child.start()
+    child.join(60)
+    assert child.exitcode == 1
+
+    reopened = ShardedStore(bank, BANK, 3)
+    reopened.load()
+    expected = dict(before)
+    if crash_at != 'intent':
+        expected[payer] -= 25.0
+        expected[payee] += 25.0
+    assert _balances(reopened) == expected
+    with reopened.transaction() as tx:  # The shards and the intent log take new commits afterwards
+        tx.set([payer, "balance"], 0.0)
+        tx.set([payee, "balance"], 0.0)
+    reopened.compact()
+    reopened.close()
+    final = ShardedStore(bank, BANK, 3)
+    final.load()
+    assert final.data[payer]['balance'] == final.data[payee]['balance'] == 0.0
+    final.close()
@@ -0,0 +1,81 @@
+"""
+Ticket sales: an attended reader asks for the destination and a
+confirmation, a gate sells to its fixed destination without asking, and
+the fare engine follows station and fare changes.
+"""
+import json
+import pytest
+import transport_reader
+from fare_engine import fare_engine_for
+from journal import JournaledStore
+from sqlite_store import DATASETS, SqliteStore, connect, import_dataset
+
+SIN = "1001"
+FARES = {"9_stations_or_less": 8.0, "16_stations_or_less": 10.0, "more_than_16_stations": 15.0}
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    json_path = tmp_path / 'transport_db.json'
+    json_path.write_text(json.dumps({"users": {SIN: {"name": "Rider", "balance": 50.0, "history": []}},
+                                     "stations": ["North", "Central", "South"], "fares": FARES}))
+    store = JournaledStore(str(json_path), dataset=DATASETS['transport'])
+    monkeypatch.setattr(transport_reader, 'USER_DB_STORE', store)
+    monkeypatch.setattr(transport_reader, 'ORIGIN_STATION', None)
+    yield store.load()
+    store.close()
+
+
+def _answers(monkeypatch, *answers):
+    asked = list(answers)
+    monkeypatch.setattr('builtins.input', lambda prompt: asked.pop(0))
+    return asked
+
+
+@pytest.mark.parametrize('confirm, balance', [('no', 50.0), ('yes', 42.0)])
+def test_attended_purchase_asks_for_confirmation(db, monkeypatch, confirm, balance):
+    asked = _answers(monkeypatch, "2", confirm)
+    transport_reader.purchase_ticket({"SIN": SIN}, db)
+    assert asked == []
+    assert db["users"][SIN]['balance'] == balance
+    assert len(db["users"][SIN]['history']) == (confirm == 'yes')
+
+
+def test_gate_sells_without_asking(db, monkeypatch):
+    asked = _answers(monkeypatch)  # input() would fail on the empty list
+    transport_reader.purchase_ticket({"SIN": SIN}, db, destination="South")
+    assert asked == []
+    assert db["users"][SIN]['balance'] == 42.0
+    assert db["users"][SIN]['history'][0]['destination'] == "South"
+
+
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_fare_engine_follows_station_and_fare_writes(tmp_path, backend):
+    data = {"users": {SIN: {"name": "Rider", "balance": 50.0, "history": []}},
+            "stations": ["North", "Central", "South"], "fares": FARES}
+    if backend == 'sqlite':
+        conn = connect(str(tmp_path / 'reader_data.sqlite'))
+        import_dataset(conn, 'transport', data)
+        conn.close()
+        store = SqliteStore(str(tmp_path / 'reader_data.sqlite'), 'transport')
+    else:
+        (tmp_path / 'transport_db.json').write_text(json.dumps(data))
+        store = JournaledStore(str(tmp_path / 'transport_db.json'), dataset=DATASETS['transport'])
+    db = store.load()
+    engine = fare_engine_for(db)
+    assert fare_engine_for(db) is engine
+    with store.transaction() as tx:  # Renamed in place: same list, same length
+        tx.set(["stations", 1], "Tahrir")
+    assert fare_engine_for(db).station("Tahrir") == 1
+    with store.transaction() as tx:
+        tx.set(["fares", "9_stations_or_less"], 9.0)
+    assert fare_engine_for(db).fare(0, 2) == 9.0
+    store.close()
+
+
+def test_fare_engines_of_two_databases_are_kept_apart():
+    first = {"stations": ["North", "Central", "South"], "fares": dict(FARES)}
+    second = {"stations": ["East", "West"], "fares": dict(FARES)}
+    engines = fare_engine_for(first), fare_engine_for(second)
+    assert (fare_engine_for(first), fare_engine_for(second)) == engines  # Alternating builds nothing
+    assert engines[1].station("West") == 1